@@ -8,20 +8,73 @@
 """
 from urllib.parse import quote_plus as qp
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 
 
 class MongoDBConnector:
-    def __init__(self, user, password, host, port, database=None):
+    def __init__(self, user, password, host, port, database=None, document_class=dict):
+        """
+        :param document_class: 返回文档的类型，RawBSONDocument 表示不解码
+        """
         # mongodb://[username:password@]host1[:port1][,host2[:port2],…[,hostN[:portN]]][/[database][?options]]
         self.uri = f'mongodb://{qp(user)}:{qp(password)}@{host}:{port}/'
         self.database = database
         if self.database:
             self.uri += self.database
 
-        self.client = MongoClient(self.uri)
+        self.client = MongoClient(self.uri, document_class=document_class)
 
-    def watch(self, *args, **kwargs):
-        return self.client.watch(*args, **kwargs)
+    def watch(self, *args, database=None, **kwargs):
+        """打开 change stream
+        :param database: 指定时只监听该库，否则监听整个集群
+        """
+        target = self.client[database] if database else self.client
+        return target.watch(*args, **kwargs)
+
+    def get_collection_size(self, database, collection):
+        """基于 collStats 获取集合大小(字节)"""
+        stats = self.client[database].command('collStats', collection)
+        return stats.get('size') or 0
+
+    def get_split_points(self, database, collection, chunk_docs):
+        """按 _id 切分集合，每个分片约 chunk_docs 条文档
+        优先使用 splitVector，没有权限或者不支持时（例如 mongos），使用 $sample 采样后 $bucketAuto 分桶
+        :return: 按顺序排列的 _id 分界点
+        """
+        stats = self.client[database].command('collStats', collection)
+        count = stats.get('count') or 0
+        if count <= chunk_docs:
+            return []
+
+        try:
+            ret = self.client[database].command(
+                'splitVector', f'{database}.{collection}',
+                keyPattern={'_id': 1},
+                maxChunkSizeBytes=max(int(stats.get('avgObjSize') or 1) * chunk_docs, 1),
+            )
+            return [item['_id'] for item in ret.get('splitKeys') or []]
+        except OperationFailure:
+            pass
+
+        buckets = -(-count // chunk_docs)
+        pipeline = [
+            {'$sample': {'size': min(count, buckets * 100)}},
+            {'$bucketAuto': {'groupBy': '$_id', 'buckets': buckets}},
+        ]
+        ret = list(self.client[database][collection].aggregate(pipeline, allowDiskUse=True))
+        # 最后一个桶的上界是采样中最大的 _id，不作为分界点
+        return [item['_id']['max'] for item in ret[:-1]]
+
+    def get_replication_lag(self):
+        """基于 replSetGetStatus 获取从节点的最大复制延迟（秒），非副本集返回 None"""
+        status = self.client.admin.command('replSetGetStatus')
+        members = status.get('members') or []
+        primary = [m['optimeDate'] for m in members if m.get('stateStr') == 'PRIMARY']
+        secondaries = [m['optimeDate'] for m in members
+                       if m.get('stateStr') == 'SECONDARY']
+        if not primary or not secondaries:
+            return None
+        return max((primary[0] - optime).total_seconds() for optime in secondaries)
 
     def close(self):
         self.client.close()
@@ -12,6 +12,9 @@ from pymysql.err import Error, OperationalError
 
 
 class MySQLConnector:
+    # 查询复制状态的语句，第一次查询时按服务端版本确定
+    replica_status_sql = None
+
     def __init__(self, cursorclass=DictCursor, **kwargs):
         kwargs['cursorclass'] = cursorclass
         self.conn = pymysql.connect(**kwargs)
@@ -62,6 +65,17 @@ class MySQLConnector:
 
         yield from fetch()
 
+    def read_tuples(self, sql: str, args=None):
+        """使用非缓冲的元组游标读取，每行是一个元组，不重复保存列名
+        游标与当前连接共用同一个事务，可以在快照连接上使用
+        """
+        cursor = self.conn.cursor(SSCursor)
+        try:
+            cursor.execute(sql, args)
+            yield from cursor.fetchall_unbuffered()
+        finally:
+            cursor.close()
+
     def get_create_table(self, database, table):
         """加载数据表 schema 信息 """
         schema = ''
@@ -79,10 +93,73 @@ class MySQLConnector:
                  ,data_type
              from information_schema.columns 
              where table_schema='{database}' and table_name='{table}'
+             order by ordinal_position
          """
         ret = self.read(sql)
         return {item['column_name']: item['data_type'] for item in ret}
 
+    def get_primary_keys(self, database, table):
+        """加载数据表主键列"""
+        sql = f"""
+             select
+                 column_name as column_name
+             from information_schema.key_column_usage
+             where table_schema='{database}' and table_name='{table}'
+                 and constraint_name='PRIMARY'
+             order by ordinal_position
+         """
+        ret = self.read(sql)
+        return [item['column_name'] for item in ret]
+
+    def get_tables_size(self, tables):
+        """估算数据表大小(字节)
+        :param tables: list, 格式 schema.table
+        :return: {schema.table: size}
+        """
+        if not tables:
+            return {}
+        conditions = ' or '.join(
+            f"(table_schema='{schema}' and table_name='{table}')"
+            for schema, table in (key.split('.') for key in tables)
+        )
+        sql = f"""
+             select
+                 table_schema as table_schema
+                 ,table_name as table_name
+                 ,data_length + index_length as size
+             from information_schema.tables
+             where {conditions}
+         """
+        ret = self.read(sql)
+        return {f"{item['table_schema']}.{item['table_name']}": int(item['size'] or 0)
+                for item in ret}
+
+    def get_table_rows(self, database, table):
+        """估算数据表行数，数据来自 information_schema.tables"""
+        sql = f"""
+             select
+                 table_rows as table_rows
+             from information_schema.tables
+             where table_schema='{database}' and table_name='{table}'
+         """
+        ret = list(self.read(sql))
+        if ret:
+            return int(ret[0].get('table_rows') or 0)
+        return 0
+
+    def get_column_range(self, database, table, column):
+        """获取某一列的最小值与最大值"""
+        sql = f"""
+             select
+                 min(`{column}`) as min_value
+                 ,max(`{column}`) as max_value
+             from {database}.{table}
+         """
+        ret = list(self.read(sql))
+        if ret:
+            return ret[0].get('min_value'), ret[0].get('max_value')
+        return None, None
+
     def get_tx_isolation(self):
         tx_isolation = ''
         sql = 'select @@session.tx_isolation as tx_isolation'
@@ -119,6 +196,36 @@ class MySQLConnector:
         sql = 'unlock tables'
         self.execute(sql)
 
+    def write_watermark(self, table, watermark_id, value):
+        """写入水位线，每个客户端只占用一行
+        :param table: 水位线表，格式 schema.table
+        :param watermark_id: 客户端的标识
+        :param value: 水位线的值
+        """
+        sql = f"""
+             insert into {table} (id, value) values (%s, %s)
+             on duplicate key update value=values(value)
+         """
+        self.execute(sql, (watermark_id, value))
+        self.conn.commit()
+
+    def get_replica_lag(self):
+        """获取从库的复制延迟（秒），不是从库或者复制未运行时返回 None"""
+        if self.replica_status_sql is None:
+            try:
+                ret = list(self.read('show replica status'))
+                self.replica_status_sql = 'show replica status'
+            except Error:
+                # MySQL 8.0.22 之前的版本
+                self.replica_status_sql = 'show slave status'
+                ret = list(self.read(self.replica_status_sql))
+        else:
+            ret = list(self.read(self.replica_status_sql))
+        if not ret:
+            return None
+        lag = ret[0].get('Seconds_Behind_Source', ret[0].get('Seconds_Behind_Master'))
+        return None if lag is None else int(lag)
+
     def get_binlog_file_position(self):
         sql = 'show master status;'
         ret = list(self.read(sql))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: bench_codecs
+@date: 2019-09-30
+@note: 比较各编码方式对 MySQL 行数据的编码、解码速度与消息大小
+export PYTHONPATH={pwd}
+"""
+import time
+import logging
+from decimal import Decimal
+from datetime import datetime, date
+
+from utils.codec import CODECS, available_codecs, get_codec
+from utils.log import configure_logging
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+
+def make_row(i):
+    """与 MySQLReader 输出相同结构的一条 insert 数据"""
+    now = datetime(2019, 9, 30, 12, 0, 0)
+    return {
+        'database': 'statistics',
+        'table': 'StarUser',
+        'topic': 'statistics-StarUser',
+        'type': 'insert',
+        'ts': 1569816000 + i,
+        'xid': 100000 + i,
+        'offset': i,
+        'data': {
+            'id': i,
+            'mobile': f'155{i:08d}',
+            'gender': 'other',
+            'utm_source': '小白信用分',
+            'app_source': '',
+            'birthday': date(1992, 1, 1),
+            'balance': Decimal('1234.56'),
+            'avatar': bytes(range(64)),
+            'created_time': now,
+            'updated_time': now,
+        },
+    }
+
+
+def make_batch(n):
+    """与 binlog_batch 模式相同结构的一条批量数据"""
+    event = make_row(0)
+    event.pop('data')
+    event.pop('offset')
+    event['commit'] = True
+    event['rows'] = [make_row(i)['data'] for i in range(n)]
+    return event
+
+
+def bench(name, obj, rounds):
+    """:return: (每秒编码次数, 每秒解码次数, 消息字节数)"""
+    codec = get_codec(name)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        bts = codec.encode(obj)
+    encode = rounds / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        codec.decode(bts)
+    decode = rounds / (time.perf_counter() - start)
+    return encode, decode, len(bts)
+
+
+def main(rounds=20_000):
+    # bson 只用于原始 BSON 文档，不能编码 Decimal 与 date
+    names = [name for name in available_codecs() if name != 'bson']
+    missing = [name for name in CODECS if name not in names and name != 'bson']
+    if missing:
+        logger.info(f'Skip codecs not installed: {missing}')
+
+    for shape, obj, n in (('row', make_row(1), rounds),
+                          ('batch-100', make_batch(100), rounds // 100)):
+        print(f'{shape:<10}{"codec":<10}{"encode/s":>12}{"decode/s":>12}{"bytes":>8}')
+        for name in names:
+            encode, decode, size = bench(name, obj, n)
+            print(f'{"":<10}{name:<10}{encode:>12.0f}{decode:>12.0f}{size:>8}')
+
+
+if __name__ == '__main__':
+    main()
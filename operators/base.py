@@ -12,17 +12,21 @@ import logging
 from threading import Thread
 
 from operators.common import Buffer, BreakPoint
-from config.sys_config import MAX_BUF_SIZE
+from config.sys_config import MAX_BUF_SIZE, BATCH_MODE
 
 logger = logging.getLogger(__name__)
 
 
 class Base(metaclass=abc.ABCMeta):
-    def __init__(self, reader, writer):
+    def __init__(self, reader, writer, batch_mode=BATCH_MODE):
         # 缓冲队列最大值
         self.max_buf_size = MAX_BUF_SIZE
-        # 消息会产生大量数据，需要一个缓冲队列
+        # 是否按批读取，按批读取时缓冲队列中的每一项都是一批数据
+        self.batch_mode = batch_mode
+        # 消息会产生大量数据，需要一个缓冲队列，按数据条数限制大小
         self.buffer = Buffer(self.max_buf_size)
+        # 按批路由时暂存路由产生的数据，之后整批放入缓冲队列
+        self.staging = None
 
         # 数据获取者
         self.reader = reader
@@ -35,13 +39,47 @@ class Base(metaclass=abc.ABCMeta):
         self.writer_thread = Thread(target=self.write, daemon=True)
 
         self.is_running = False
+        # 写线程的异常，写入失败后不再继续读取
+        self.error = None
 
     def read(self):
         """子线程负责获取数据"""
-        for obj in self.reader.read():
-            self.route(obj)
-            if isinstance(obj, BreakPoint):
-                break
+        objs = self.reader.read_batches() if self.batch_mode else self.reader.read()
+        try:
+            for obj in objs:
+                if isinstance(obj, list):
+                    self.route_batch(obj)
+                    continue
+                self.route(obj)
+                if isinstance(obj, BreakPoint):
+                    break
+        except Exception as e:
+            # 读取失败时写线程写完已经读取的数据后结束，异常继续抛出
+            logger.error(f'Reader error: {e}')
+            self.buffer.put(BreakPoint())
+            raise
+
+    def route_batch(self, objs):
+        """按批路由，路由产生的数据先暂存，再整批放入缓冲队列"""
+        self.staging = []
+        try:
+            for obj in objs:
+                self.route(obj)
+        finally:
+            staging, self.staging = self.staging, None
+        if staging:
+            self.buffer.put(staging)
+
+    def put(self, obj):
+        """放入缓冲队列，按批路由时先暂存"""
+        if self.staging is None:
+            self.buffer.put(obj)
+        else:
+            self.staging.append(obj)
+
+    def size(self):
+        """缓冲队列与暂存中的数据条数"""
+        return self.buffer.qsize() + len(self.staging or ())
 
     @abc.abstractmethod
     def route(self, obj):
@@ -60,8 +98,16 @@ class Base(metaclass=abc.ABCMeta):
                 logger.error(e)
                 break
             else:
-                self.delegate(obj)
-                if isinstance(obj, BreakPoint):
+                objs = obj if isinstance(obj, list) else [obj]
+                try:
+                    for o in objs:
+                        self.delegate(o)
+                except Exception as e:
+                    # 写入失败时之后的断点都不能保存，结束写线程，由主线程抛出异常
+                    logger.error(f'Writer error: {e}')
+                    self.error = e
+                    break
+                if isinstance(objs[-1], BreakPoint):
                     break
 
     @abc.abstractmethod
@@ -75,15 +121,18 @@ class Base(metaclass=abc.ABCMeta):
         self.writer_thread.start()
 
         self.is_running = True
-        self.reader_thread.join()
         self.writer_thread.join()
+        if self.error is not None:
+            # 读线程可能阻塞在已满的缓冲队列上，不再等待，由调用方 stop
+            raise self.error
+        self.reader_thread.join()
 
     def stop(self):
         if self.is_running:
             self.reader.disconnect()
-            self.buffer.put(BreakPoint())
 
             if self.writer_thread.is_alive():
+                self.buffer.put(BreakPoint())
                 while not self.buffer.empty():
                     logger.info(f'Buffer size is {self.buffer.qsize()}')
                     time.sleep(0.5)
@@ -6,16 +6,98 @@
 @module: common
 @date: 2019-06-16
 """
+import pickle
 from queue import Queue
 from munch import Munch
 
+from readers.base import RowBatch
+from utils.spool import Spool
+
+
+def weight(obj):
+    """缓冲队列中一项数据的条数，一批数据按其中的条数计算"""
+    if isinstance(obj, list):
+        return sum(weight(o) for o in obj)
+    if isinstance(obj, RowBatch):
+        return len(obj)
+    return 1
+
 
 class Buffer(Queue):
-    """基于 Queue 的 put 与 get"""
+    """\
+    基于 Queue 的 put 与 get
+    maxsize 与 qsize 按数据条数计算，而不是按队列中的项数，
+    按批读取时单条的数据与成批的数据共用一个队列，内存占用都以条数为上限
+    """
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.rows = 0
+
+    def _qsize(self):
+        return self.rows
+
+    def _put(self, item):
+        super()._put(item)
+        self.rows += weight(item)
+
+    def _get(self):
+        item = super()._get()
+        self.rows -= weight(item)
+        return item
+
+
+class SpoolBuffer:
+    """\
+    基于本地 spool 的缓冲队列，接口与 Buffer 相同
+    put 只追加到本地文件，不会因为 writer 变慢而阻塞；
+    BreakPoint 只用于结束本次运行，不写入文件，在文件中的数据全部取出后返回
+    """
+    def __init__(self, path, segment_size):
+        """
+        :param path: str, spool 目录
+        :param segment_size: int, 每个 segment 文件的大小（字节）
+        """
+        self.spool = Spool(path, segment_size)
+        self.break_point = None
+
+    def put(self, obj):
+        if isinstance(obj, BreakPoint):
+            self.break_point = obj
+            return
+        self.spool.append(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def get(self):
+        while True:
+            data = self.spool.read(timeout=0.5)
+            if data is not None:
+                return pickle.loads(data)
+            if self.break_point is not None:
+                return self.break_point
+
+    def ack(self):
+        """已经取出的数据都已送达，可以从文件中删除"""
+        self.spool.ack()
+
+    def sync(self):
+        self.spool.sync()
+
+    def qsize(self):
+        return len(self.spool)
+
+    def empty(self):
+        return not len(self.spool)
+
+    def close(self):
+        self.spool.close()
 
 
 class CommitPoint:
     """用于判断缓存需要提交的节点"""
+    def __init__(self, token=None, position=None):
+        # 提交时需要一并保存的断点信息
+        self.token = token
+        # 插入节点时 reader 读取到的位置，提交后保存
+        self.position = position
 
 
 class DateNode(Munch):
@@ -7,8 +7,14 @@
 @date: 2019-06-29 
 """
 import abc
+import copy
+import zlib
 import logging
+from threading import Thread, Lock
+
 from operators.base import Base
+from operators.common import Buffer, BreakPoint, CommitPoint
+from config.sys_config import CONSUMER_LANES
 
 logger = logging.getLogger(__name__)
 
@@ -18,18 +24,122 @@ class BaseConsumer(Base, metaclass=abc.ABCMeta):
     每接受一条数据，经过路由处理，添加到缓存 buffer: dict，添加的数据结构为 {key: value}
     每次处理完一条都要根据上下文，通常是缓存 buffer 的长度以及是否在数据库事务当中，
     来判断出是否需要添加一个 CommitPoint，用来强制刷新 buffer，防止 OOM 以及保证事务性
+    通道数大于 1 时，分区按哈希分配到多个通道，每个通道有自己的缓冲队列、写线程与 writer，
+    同一个分区的消息总在同一个通道中按顺序写入，各通道只提交自己分区的断点，
+    各通道共用一个 reader，提交断点时互斥
     """
 
-    def __init__(self, reader, writer):
+    def __init__(self, reader, writer, lanes=CONSUMER_LANES):
+        """
+        :param lanes: 并行写入的通道数，1 表示单线程写入
+        """
         super().__init__(reader, writer)
+        self.lane_count = lanes
+        # 各通道，运行时创建
+        self.lanes = None
         # 记录上一条处理的消息, 根据消息来源不同可能有不同的属性，
         # 但至少有 token 属性，并且值为字典类型，用与保存断点续传的表示
         self.last = None
+        # 上次提交之后处理的消息中，每个分区最新的 token
+        self.tokens = {}
+        # 各通道共用，reader 的提交不是线程安全的
+        self.commit_lock = Lock()
+
+    def make_lanes(self):
+        """每个通道是当前 consumer 的浅拷贝，共用 reader 与路由配置，writer 与缓冲队列独立"""
+        lanes = []
+        for i in range(self.lane_count):
+            lane = copy.copy(self)
+            lane.writer = self.writer if i == 0 else self.writer.clone()
+            lane.buffer = Buffer(self.buffer.maxsize)
+            lane.last = None
+            lane.tokens = {}
+            lane.writer_thread = Thread(target=lane.write, daemon=True)
+            lanes.append(lane)
+        return lanes
+
+    def broadcast(self, obj):
+        """控制节点不属于任何分区，放入每个通道"""
+        for lane in self.lanes:
+            lane.buffer.put(obj)
+
+    def get_lane(self, message):
+        """按消息所在的分区选择通道"""
+        partition = next(iter(self.reader.get_token(message)))
+        return self.lanes[zlib.crc32(partition.encode()) % len(self.lanes)]
+
+    def read(self):
+        """多通道时，消息按通道分组，分别路由到各通道的缓冲队列"""
+        if not self.lanes:
+            return super().read()
+
+        objs = self.reader.read_batches() if self.batch_mode else self.reader.read()
+        for obj in objs:
+            if isinstance(obj, (CommitPoint, BreakPoint)):
+                self.broadcast(obj)
+                if isinstance(obj, BreakPoint):
+                    break
+                continue
+
+            groups = {}
+            for message in obj if isinstance(obj, list) else [obj]:
+                lane = self.get_lane(message)
+                groups.setdefault(id(lane), (lane, []))[1].append(message)
+            for lane, messages in groups.values():
+                # 路由时 put 与 size 作用于当前通道的缓冲队列
+                self.buffer = lane.buffer
+                if isinstance(obj, list):
+                    self.route_batch(messages)
+                else:
+                    self.route(messages[0])
+
+    def run(self):
+        if self.lane_count <= 1:
+            return super().run()
+
+        self.lanes = self.make_lanes()
+        self.reader_thread.start()
+        for lane in self.lanes:
+            lane.writer_thread.start()
+
+        self.is_running = True
+        while any(lane.writer_thread.is_alive() for lane in self.lanes):
+            for lane in self.lanes:
+                lane.writer_thread.join(0.5)
+                if lane.error is not None:
+                    # 路由线程可能阻塞在失败通道已满的缓冲队列上，不再等待，由调用方 stop
+                    raise lane.error
+        self.reader_thread.join()
+
+    def stop(self):
+        if not self.lanes:
+            return super().stop()
+
+        if self.is_running:
+            self.reader.disconnect()
+            alive = [lane for lane in self.lanes if lane.error is None]
+            if len(alive) == len(self.lanes):
+                # 等待路由线程把已经读取的消息放入各通道之后再结束通道
+                self.reader_thread.join()
+            for lane in alive:
+                lane.buffer.put(BreakPoint())
+            for lane in alive:
+                lane.writer_thread.join()
+                lane.writer.stop()
+            self.reader.stop()
+            self.is_running = False
+
+    def track(self, obj):
+        """记录已经交给 writer 的消息，提交时一并提交所有分区的断点"""
+        self.last = obj
+        self.tokens.update(obj.token)
 
     def commit(self):
         logger.info('Start Committing')
         self.writer.commit()
         logger.info('Writer Committed')
-        if self.last:
-            self.reader.commit(self.last.token)
+        if self.tokens:
+            with self.commit_lock:
+                self.reader.commit(self.tokens)
+            self.tokens = {}
             logger.info('Reader Committed')
@@ -115,11 +115,11 @@ class MaxWellConsumer(BaseConsumer):
         :return: 是否需要熟悉缓存区域
         """
         if action_type == 'bootstrap-insert':
-            self.buffer.put(DateNode(value))
+            self.put(DateNode(value))
         # bootstrap 模式结束或者超过缓存最大限度 就应该加入刷新点
         if (action_type == 'bootstrap-complete'
-                or self.buffer.qsize() + 1 >= self.max_buf_size):
-            self.buffer.put(CommitPoint())
+                or self.size() + 1 >= self.max_buf_size):
+            self.put(CommitPoint())
 
     def _dml(self, action_type, value):
         """dml 模式处理
@@ -133,9 +133,9 @@ class MaxWellConsumer(BaseConsumer):
         # 当事务涉及多张表的写操作的时候，可能事务提交在其他的表中，但是新来的事务 xid 会变化
 
         commit = value.get('commit')
-        self.buffer.put(DateNode(value))
-        if commit or self.buffer.qsize() + 1 >= self.max_buf_size:
-            self.buffer.put(CommitPoint())
+        self.put(DateNode(value))
+        if commit or self.size() + 1 >= self.max_buf_size:
+            self.put(CommitPoint())
 
         # xid = value.get('xid')
         # # 新的数据已经是新的事务并且缓存超过指定大小，应该在这之前加入刷新点
@@ -10,7 +10,7 @@ import logging
 
 from .base_consumer import BaseConsumer
 from operators.common import CommitPoint, DateNode, BreakPoint
-from utils.common import bytes2obj
+from utils.codec import get_codec
 
 logger = logging.getLogger(__name__)
 
@@ -49,7 +49,7 @@ class MongoDBConsumer(BaseConsumer):
         elif obj.operationType == 'delete':
             self.writer.delete(obj.documentKey, db_name, coll_name)
 
-        self.last = obj
+        self.track(obj)
 
     def route(self, message):
         """对 message 进行路由处理"""
@@ -58,7 +58,8 @@ class MongoDBConsumer(BaseConsumer):
             return
 
         token = self.reader.get_token(message)
-        value = bytes2obj(self.reader.get_value(message))
+        # bson 编码的文档保持原始 BSON，直接交给 MongoWriter，不经过 Python 对象
+        value = get_codec(self.reader.get_codec(message)).decode(self.reader.get_value(message))
         value['token'] = token
 
         operation_type = value.get('operationType')
@@ -77,18 +78,18 @@ class MongoDBConsumer(BaseConsumer):
         :return: 是否需要熟悉缓存区域
         """
         if operation_type == 'bootstrap-insert':
-            self.buffer.put(DateNode(value))
+            self.put(DateNode(value))
 
         # bootstrap 模式结束或者超过缓存最大限度 就应该加入刷新点
         if (operation_type == 'bootstrap-complete'
-                or self.buffer.qsize() + 1 >= self.max_buf_size):
-            self.buffer.put(CommitPoint())
+                or self.size() + 1 >= self.max_buf_size):
+            self.put(CommitPoint())
 
     def _dml(self, value):
         """dml 模式处理"""
-        self.buffer.put(DateNode(value))
+        self.put(DateNode(value))
         # 暂时没有事务处理
-        self.buffer.put(CommitPoint())
+        self.put(CommitPoint())
 
     def _ddl(self, *args, **kwargs):
         """ddl 模式处理"""
@@ -11,7 +11,7 @@ import base64
 
 from .base_consumer import BaseConsumer
 from operators.common import CommitPoint, DateNode, BreakPoint
-from utils.common import bytes2obj
+from utils.codec import get_codec
 
 logger = logging.getLogger(__name__)
 
@@ -61,7 +61,7 @@ class MySQLConsumer(BaseConsumer):
         elif obj.type == 'delete':
             self.writer.delete(obj.data, self.keys, obj.database, obj.table)
 
-        self.last = obj
+        self.track(obj)
 
     def route(self, message):
         """对 message 进行路由处理"""
@@ -70,7 +70,7 @@ class MySQLConsumer(BaseConsumer):
             return
 
         token = self.reader.get_token(message)
-        value = bytes2obj(self.reader.get_value(message))
+        value = get_codec(self.reader.get_codec(message)).decode(self.reader.get_value(message))
         value['token'] = token
         # 对特殊类型字段值做处理
         value = self.map(value)
@@ -82,14 +82,16 @@ class MySQLConsumer(BaseConsumer):
             self._dml(action_type, value)
 
     def map(self, value):
-        data = value.get('data')
-        if not data:
-            return value
+        # update 的旧数据在 old 中，按 rows event 批量输出时，数据在 rows 与 olds 中
+        for data in ([value.get('data'), value.get('old')]
+                     + (value.get('rows') or []) + (value.get('olds') or [])):
+            if not data:
+                continue
 
-        # binary 类型字段要做 base64.decode
-        for col in self.binaries:
-            if data[col]:
-                data[col] = base64.b64decode(data[col])
+            # json 编码的 binary 类型字段要做 base64.decode，二进制编码时已经是 bytes
+            for col in self.binaries:
+                if isinstance(data.get(col), str):
+                    data[col] = base64.b64decode(data[col])
 
         # todo: 5.7+ json 类型数据转换
         return value
@@ -104,11 +106,11 @@ class MySQLConsumer(BaseConsumer):
         :return: 是否需要熟悉缓存区域
         """
         if action_type == 'bootstrap-insert':
-            self.buffer.put(DateNode(value))
+            self.put(DateNode(value))
         # bootstrap 模式结束或者超过缓存最大限度 就应该加入刷新点
         if (action_type == 'bootstrap-complete'
-                or self.buffer.qsize() + 1 >= self.max_buf_size):
-            self.buffer.put(CommitPoint())
+                or self.size() + 1 >= self.max_buf_size):
+            self.put(CommitPoint())
 
     def _dml(self, action_type, value):
         """dml 模式处理
@@ -121,9 +123,16 @@ class MySQLConsumer(BaseConsumer):
         # 否则有 `"offset":n`，n 表示当前事务的顺序，从 0 开始递增
         # 当事务涉及多张表的写操作的时候，可能事务提交在其他的表中，但是新来的事务 xid 会变化
         commit = value.get('commit')
-        self.buffer.put(DateNode(value))
-        if commit or self.buffer.qsize() + 1 >= self.max_buf_size:
-            self.buffer.put(CommitPoint())
+        rows = value.pop('rows', None)
+        if rows is None:
+            self.put(DateNode(value))
+        else:
+            # 一个 rows event 的批量数据，展开成多条
+            olds = value.pop('olds', None) or [None] * len(rows)
+            for row, old in zip(rows, olds):
+                self.put(DateNode(value, data=row, old=old))
+        if commit or self.size() + 1 >= self.max_buf_size:
+            self.put(CommitPoint())
 
     def _ddl(self, action_type, value):
         """ddl 模式处理
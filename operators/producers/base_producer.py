@@ -6,10 +6,21 @@
 @module: base_producer 
 @date: 2019-07-06 
 """
+import os
+import time
 import logging
+from threading import Thread, Event
 
 from operators.base import Base
-from operators.common import CommitPoint, BreakPoint
+from operators.common import CommitPoint, BreakPoint, SpoolBuffer
+from readers.base import RowBatch
+from config.sys_config import (
+    BATCH_MODE,
+    CHECKPOINT_INTERVAL,
+    CHECKPOINT_EVENTS,
+    SPOOL_PATH,
+    SPOOL_SEGMENT_SIZE
+)
 
 logger = logging.getLogger(__name__)
 
@@ -18,23 +29,114 @@ class BaseProducer(Base):
     """\
     每接受一条数据添加到缓存 buffer
     每次处理完一条都转给 writer，通常为消息队列
+    按时间或者条数定期在缓冲队列中插入断点，断点之前的数据写入完成后保存读取位置
+    开启 spool 时缓冲队列保存在本地文件中，读取不再等待 writer，
+    断点写入 spool 后即保存读取位置，writer 送达之后再从 spool 中删除
     """
+    def __init__(self, reader, writer, batch_mode=BATCH_MODE,
+                 checkpoint_interval=CHECKPOINT_INTERVAL,
+                 checkpoint_events=CHECKPOINT_EVENTS,
+                 spool_path=SPOOL_PATH, spool_segment_size=SPOOL_SEGMENT_SIZE):
+        """
+        :param checkpoint_interval: 保存断点的时间间隔（秒），0 表示不按时间保存
+        :param checkpoint_events: 每输出多少条数据保存一次断点，0 表示不按条数保存
+        :param spool_path: 本地 spool 目录，为空时使用内存缓冲队列
+        :param spool_segment_size: spool 每个 segment 文件的大小（字节）
+        """
+        super().__init__(reader, writer, batch_mode)
+        self.spooled = bool(spool_path)
+        if self.spooled:
+            name = getattr(reader, 'cache_key', '') or type(reader).__name__
+            self.buffer = SpoolBuffer(os.path.join(spool_path, name.replace(':', '-')),
+                                      spool_segment_size)
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_events = checkpoint_events
+        # 上次断点之后输出的数据条数
+        self.events = 0
+        # 需要插入断点，由读线程在数据的边界处理
+        self.checkpoint_due = Event()
+        # 初始化定时断点子线程
+        self.checkpoint_thread = Thread(target=self.tick, daemon=True)
+
+    def tick(self):
+        """子线程按时间间隔通知读线程插入断点"""
+        while True:
+            time.sleep(self.checkpoint_interval)
+            self.checkpoint_due.set()
+
     def route(self, obj):
         """用来区分是 bootstrap(全量), increment(增量), 包括: ddl, dml"""
         # logger.info(obj)
         self.buffer.put(obj)
+        if isinstance(obj, CommitPoint) and obj.position and self.spooled:
+            # reader 产生的位置断点，与定时断点一样在写入 spool 后保存
+            self.buffer.sync()
+            self.reader.commit(position=obj.position)
+        if isinstance(obj, (CommitPoint, BreakPoint)):
+            return
+
+        self.events += len(obj) if isinstance(obj, RowBatch) else 1
+        if self.checkpoint_events and self.events >= self.checkpoint_events:
+            self.checkpoint_due.set()
+        if self.checkpoint_due.is_set() and self.is_boundary(obj):
+            self.checkpoint()
+
+    @staticmethod
+    def is_boundary(obj):
+        """一个 binlog 事件拆分成多行时，只在最后一行之后插入断点"""
+        return not (isinstance(obj, dict) and 'offset' in obj and not obj.get('commit'))
+
+    def checkpoint(self):
+        """在读线程中记录当前读取位置，作为断点放入缓冲队列，全量读取期间不插入"""
+        position = self.reader.position()
+        if position is None:
+            return
+        self.buffer.put(CommitPoint(position=position))
+        if self.spooled:
+            # 之前的数据已经落盘，重启后由 spool 继续写出，读取位置可以直接保存
+            self.buffer.sync()
+            self.reader.commit(position=position)
+        self.checkpoint_due.clear()
+        self.events = 0
 
     def delegate(self, obj):
         """针对不同的操作类型执行不同的操作"""
-        if isinstance(obj, (CommitPoint, BreakPoint)):
+        if isinstance(obj, CommitPoint):
+            self.commit(obj.token, obj.position)
+            return
+        if isinstance(obj, BreakPoint):
             self.commit()
             return
-        self.writer.write(obj)
+        if isinstance(obj, RowBatch):
+            # 整批交给 writer，由 writer 决定如何展开
+            self.writer.write_batch(obj, self.reader.message_key)
+            return
+        # 按 reader 提供的 key 分区，同一行数据保持顺序
+        self.writer.write(obj, self.reader.message_key(obj))
 
-    def commit(self):
+    def commit(self, token=None, position=None):
+        """\
+        等待 writer 中的数据全部送达之后再保存断点，
+        有数据没有送达时 writer 抛出异常，不保存断点，spool 也不确认，重启后从上次确认的位置重新写出
+        """
         logger.info('Start Committing')
         self.writer.commit()
-        self.reader.commit()
+        if self.spooled:
+            self.buffer.ack()
+            if position:
+                # 读取位置在写入 spool 时已经保存
+                return
+        self.reader.commit(token, position)
+
+    def run(self):
+        if self.checkpoint_interval:
+            self.checkpoint_thread.start()
+        super().run()
+
+    def stop(self):
+        super().stop()
+        if self.spooled:
+            self.buffer.close()
 
 
 if __name__ == '__main__':
@@ -8,11 +8,67 @@
 """
 
 
+class RowBatch:
+    """\
+    一批共用信封（database, table, topic, ts, type 等）的数据，
+    只有在需要单条数据时才展开成字典，减少逐行构造字典与入队的开销
+    """
+    __slots__ = ('envelope', 'rows', 'field', 'columns', 'types')
+
+    def __init__(self, envelope, rows, field='data', columns=None, types=None):
+        """
+        :param envelope: dict, 这批数据共用的信封
+        :param rows: list, 数据，指定 columns 时每行是与 columns 顺序一致的元组
+        :param field: 展开时数据所在的字段
+        :param columns: list, 列名，None 表示每行已经是字典
+        :param types: list, 与 columns 对应的数据类型
+        """
+        self.envelope = envelope
+        self.rows = rows
+        self.field = field
+        self.columns = columns
+        self.types = types
+
+    def __len__(self):
+        return len(self.rows)
+
+    def event(self, row):
+        """把一行数据展开成与逐条读取时相同的字典"""
+        event = dict(self.envelope)
+        event[self.field] = dict(zip(self.columns, row)) if self.columns else row
+        return event
+
+    def to_events(self):
+        for row in self.rows:
+            yield self.event(row)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.envelope}, rows={len(self.rows)})'
+
+
 class BaseReader:
     """base reader"""
+    # 是否按批读取，由 read_batches 开启
+    batch_mode = False
+
     def read(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def read_batches(self, *args, **kwargs):
+        """按批读取数据，支持的 reader 产生 RowBatch 或者消息列表，其他数据仍按单条产生"""
+        self.batch_mode = True
+        yield from self.read(*args, **kwargs)
+
+    def message_key(self, obj):
+        """数据写入消息队列时的 key，同一个 key 的数据写入同一个分区，None 表示不指定
+        包含多行的批量数据返回与 rows 顺序一致的 key 列表，由 writer 按行的 key 拆分到各自的分区
+        """
+        return None
+
+    def position(self):
+        """当前读取位置的快照，用于异步断点，None 表示不支持"""
+        return None
+
     def commit(self, *args, **kwargs):
         raise NotImplementedError()
 
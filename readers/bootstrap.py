@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: bootstrap
+@date: 2019-09-02
+@note: 全量读取的分片、并行扫描与多表调度
+"""
+import time
+import logging
+from uuid import uuid4
+from collections import deque, OrderedDict
+from queue import Queue, Full
+from threading import Thread, Event
+
+from config.sys_config import (
+    MAX_BUF_SIZE,
+    BOOTSTRAP_BATCH_SIZE,
+    BOOTSTRAP_STOP_TIMEOUT,
+    BOOTSTRAP_TABLES
+)
+
+logger = logging.getLogger(__name__)
+
+
+def split_range(min_value, max_value, chunk_size):
+    """把 [min_value, max_value] 按 chunk_size 切分成首尾相接的闭区间
+    :param min_value: int, 最小值
+    :param max_value: int, 最大值
+    :param chunk_size: int, 每个分片的跨度
+    :return: [(lower, upper), ...]
+    """
+    chunks = []
+    lower = min_value
+    while lower <= max_value:
+        upper = min(lower + chunk_size - 1, max_value)
+        chunks.append((lower, upper))
+        lower = upper + 1
+    return chunks
+
+
+def pk_value(pk, row):
+    """一行数据的主键值，联合主键返回元组，可以直接比较大小
+    :param pk: 主键列，str 或者 tuple
+    :param row: dict, 一行数据
+    """
+    if isinstance(pk, tuple):
+        return tuple(row.get(col) for col in pk)
+    return row.get(pk)
+
+
+class ScanTask:
+    """扫描任务，由扫描线程调用 fn(context, *args) 获取数据"""
+    def __init__(self, key, fn, *args, position=None):
+        """
+        :param key: str, 任务所属的库表, 格式 schema.table
+        :param fn: 读取函数, 第一个参数是扫描线程绑定的 context
+        :param args: 读取函数的其他参数，例如分片的上下界
+        :param position: 任务完成后可以记录的断点，通常是分片的上界
+        """
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.position = position
+
+    def __call__(self, context):
+        return self.fn(context, *self.args)
+
+    def __repr__(self):
+        return f'ScanTask({self.key}, {self.args})'
+
+
+class ChunkProgress:
+    """\
+    记录一张表的分片完成情况
+    分片可能乱序完成，只有之前的分片都完成了，断点才能推进到当前分片的上界
+    """
+    def __init__(self, positions):
+        """
+        :param positions: list, 按顺序排列的分片上界
+        """
+        self.positions = [p for p in positions if p is not None]
+        self.finished = set()
+        self.index = 0
+
+    def finish(self, position):
+        """标记分片完成
+        :return: 新的断点，断点没有推进时返回 None
+        """
+        if position is None:
+            return None
+
+        self.finished.add(position)
+        checkpoint = None
+        while (self.index < len(self.positions)
+               and self.positions[self.index] in self.finished):
+            checkpoint = self.positions[self.index]
+            self.index += 1
+        return checkpoint
+
+
+class WatermarkChunk:
+    """\
+    基于水位线的无锁快照分片，参考 DBLog
+    读取分片前后分别写入低水位线和高水位线，两条水位线之间增量日志中出现的主键，
+    分片中读到的数据可能已经过期，以增量日志为准从分片中剔除；
+    读到高水位线后，再输出分片中剩余的数据
+    """
+    def __init__(self, key, pk=None, lower=None):
+        """
+        :param key: str, 分片所属的库表, 格式 schema.table
+        :param pk: 主键列，联合主键为 tuple，None 表示没有主键，无法剔除
+        :param lower: 分片的下界（不包含），None 表示从头开始
+        """
+        self.key = key
+        self.pk = pk
+        self.lower = lower
+        # 分片的上界（包含），None 表示没有上界
+        self.upper = None
+        # 是否是该表的最后一个分片
+        self.last = True
+        self.rows = OrderedDict()
+        self.low = uuid4().hex
+        self.high = uuid4().hex
+        # 是否已经读到低水位线
+        self.opened = False
+
+    def fill(self, rows, limit=None):
+        """填充分片数据
+        :param rows: list, 按主键排序的数据
+        :param limit: 分片的最大行数，None 表示整表读取
+        """
+        if self.pk is None:
+            self.rows = OrderedDict(enumerate(rows))
+        else:
+            self.rows = OrderedDict((pk_value(self.pk, row), row) for row in rows)
+        self.last = limit is None or len(rows) < limit
+        self.upper = None if self.last else pk_value(self.pk, rows[-1])
+
+    def covers(self, value):
+        """主键是否在分片范围内"""
+        return ((self.lower is None or value > self.lower)
+                and (self.upper is None or value <= self.upper))
+
+    def discard(self, value):
+        """增量日志中出现的主键，从分片中剔除"""
+        self.rows.pop(value, None)
+
+    def __repr__(self):
+        return f'WatermarkChunk({self.key}, ({self.lower}, {self.upper}])'
+
+
+class ParallelScanner:
+    """\
+    多线程并行扫描
+    每个线程绑定一个 context（例如一条快照连接），从任务队列中领取任务，
+    读取的数据按批放入结果队列，由调用方所在的线程统一获取
+    """
+    def __init__(self, contexts, max_size=MAX_BUF_SIZE,
+                 batch_size=BOOTSTRAP_BATCH_SIZE, throttle=None):
+        """
+        :param contexts: list, 每个扫描线程独占一个 context
+        :param max_size: 结果队列的最大长度
+        :param batch_size: 每批数据的最大行数
+        :param throttle: AdaptiveThrottle 实例，每读取一批数据后限速，None 表示不限速
+        """
+        self.contexts = contexts
+        self.batch_size = batch_size
+        self.throttle = throttle
+        self.tasks = Queue()
+        self.results = Queue(max(max_size // batch_size, 1))
+        self.stopped = Event()
+        self.threads = []
+
+    def _put(self, item):
+        """结果队列满时等待，但是扫描被终止时放弃"""
+        while not self.stopped.is_set():
+            try:
+                self.results.put(item, timeout=0.5)
+            except Full:
+                continue
+            else:
+                return True
+        return False
+
+    def _work(self, context):
+        """子线程负责领取任务并读取数据"""
+        while not self.stopped.is_set():
+            task = self.tasks.get()
+            if task is None:
+                break
+
+            try:
+                rows = []
+                start = time.time()
+                for row in task(context):
+                    rows.append(row)
+                    if len(rows) >= self.batch_size:
+                        # 只统计查询的耗时，结果队列满时的等待是下游的背压，不计入
+                        latency = time.time() - start
+                        if not self._put((task, rows)):
+                            return
+                        self._throttle(len(rows), latency)
+                        rows = []
+                        start = time.time()
+                if rows:
+                    latency = time.time() - start
+                    if not self._put((task, rows)):
+                        return
+                    self._throttle(len(rows), latency)
+                # 任务完成
+                self._put((task, None))
+            except Exception as e:
+                logger.error(f'Scan error in {task}: {e}')
+                self._put((task, e))
+
+    def _throttle(self, rows, latency):
+        """按读取这批数据的查询耗时限速"""
+        if self.throttle is not None:
+            self.throttle.acquire(rows, latency)
+
+    def start(self):
+        self.threads = [Thread(target=self._work, args=(context, ), daemon=True)
+                        for context in self.contexts]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, task):
+        self.tasks.put(task)
+
+    def get(self):
+        """获取一批数据
+        :return: (task, rows), rows 为 None 时表示该任务已完成
+        """
+        task, rows = self.results.get()
+        if isinstance(rows, Exception):
+            raise rows
+        return task, rows
+
+    def stop(self, timeout=BOOTSTRAP_STOP_TIMEOUT):
+        """通知扫描线程停止，并等待线程退出，之后才能提交或者关闭线程使用的连接
+        扫描线程最多再读取一批数据就会退出，可以重复调用
+        :param timeout: 等待每个线程退出的最长时间（秒）
+        :return: bool, 是否所有扫描线程都已退出
+        """
+        if not self.stopped.is_set():
+            self.stopped.set()
+            for _ in self.threads:
+                self.tasks.put(None)
+
+        for thread in self.threads:
+            thread.join(timeout)
+        alive = [thread.name for thread in self.threads if thread.is_alive()]
+        if alive:
+            logger.warning(f'Scan threads {alive} still running after {timeout}s')
+        return not alive
+
+
+class BootstrapScheduler:
+    """\
+    多表并发全量读取调度器
+    表按传入的顺序（通常是从小到大）依次开始，最多 max_tables 张表同时读取，
+    一张表的任务全部完成后，才会把下一张表的任务提交给扫描线程
+    """
+    START = 'start'
+    ROWS = 'rows'
+    DONE = 'done'
+    COMPLETE = 'complete'
+
+    def __init__(self, scanner, max_tables=BOOTSTRAP_TABLES):
+        """
+        :param scanner: ParallelScanner 实例
+        :param max_tables: 同时读取的最大表数
+        """
+        self.scanner = scanner
+        self.max_tables = max(max_tables, 1)
+
+    def run(self, plans):
+        """执行读取计划
+        :param plans: [(key, [ScanTask, ...]), ...], 按开始的先后排序
+        :return: 生成器, (status, key, value)
+            status 为 ROWS 时 value 为一批数据,
+            status 为 DONE 时 value 为完成的 ScanTask,
+            status 为 START 或 COMPLETE 时 value 为 None
+        """
+        pending = deque(plans)
+        # 正在读取的表以及尚未完成的任务数
+        remaining = {}
+
+        self.scanner.start()
+        try:
+            while pending or remaining:
+                while pending and len(remaining) < self.max_tables:
+                    key, tasks = pending.popleft()
+                    yield self.START, key, None
+                    if not tasks:
+                        yield self.COMPLETE, key, None
+                        continue
+                    remaining[key] = len(tasks)
+                    for task in tasks:
+                        self.scanner.submit(task)
+
+                if not remaining:
+                    continue
+
+                task, rows = self.scanner.get()
+                if rows is not None:
+                    yield self.ROWS, task.key, rows
+                    continue
+
+                yield self.DONE, task.key, task
+                remaining[task.key] -= 1
+                if not remaining[task.key]:
+                    del remaining[task.key]
+                    yield self.COMPLETE, task.key, None
+        finally:
+            self.scanner.stop()
+
+
+if __name__ == '__main__':
+    print(split_range(1, 10, 3))
+    print(split_range(1, 1, 3))
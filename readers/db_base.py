@@ -10,6 +10,7 @@ import logging
 from bson import json_util
 
 from readers.base import BaseReader
+from operators.common import CommitPoint
 from utils.cache import Cache
 from utils.str_utils import b2s
 from config.sys_config import REDIS_CONFIG
@@ -21,6 +22,7 @@ logger = logging.getLogger(__name__)
 class DBReader(BaseReader):
     suffix_rt = 'rt'
     suffix_ts = 'ts'
+    suffix_bp = 'bp'
 
     @staticmethod
     def decode(args):
@@ -32,10 +34,10 @@ class DBReader(BaseReader):
         return b2s(k), json_util.loads(v)
 
     @staticmethod
-    def save(cache, value):
+    def save(cache, value, pipe=None):
         if cache and value:
             logger.info(f'Save {cache.__repr__()}')
-            cache.setm(value)
+            cache.setm(value, pipe)
 
     def __init__(self, tables, cache_key='', is_bootstrap=True, is_resume=True):
         """从 DB 读取数据
@@ -59,16 +61,31 @@ class DBReader(BaseReader):
         self.timestamps = {}
         self._ts = {}
 
+        # 用于记录每张表全量读取的进度，中断后从最近一个已提交的分片继续
+        self._cache_progress = None
+        self.progress = {}
+
+        # 是否已经进入增量读取，全量读取期间不保存异步断点
+        self.watching = False
+
         if self.is_resume:
             key_rt = f'{cache_key}:{self.suffix_rt}'
             # 从外部缓存读取
             self._cache_resume_token = Cache(key_rt, **REDIS_CONFIG)
-            self.resume_token = self._rt = self.get_resume_token()
+            self.resume_token = self.get_resume_token()
+            # 读取线程推进的位置与已提交的断点分开保存，提交时才复制到 resume_token
+            self._rt = dict(self.resume_token)
 
             key_ts = f'{cache_key}:{self.suffix_ts}'
             # 从外部缓存读取
             self._cache_timestamps = Cache(key_ts, **REDIS_CONFIG)
-            self.timestamps = self._ts = self.get_timestamps()
+            self.timestamps = self.get_timestamps()
+            self._ts = dict(self.timestamps)
+
+            key_bp = f'{cache_key}:{self.suffix_bp}'
+            # 从外部缓存读取
+            self._cache_progress = Cache(key_bp, **REDIS_CONFIG)
+            self.progress = self.get_progress()
 
         # 新增表
         self.new_tables = set(self.tables) - set(self.timestamps.keys())
@@ -77,29 +94,56 @@ class DBReader(BaseReader):
         # 需要跟踪增量表
         self.inc_tables = self.new_tables | self.old_tables
 
+    @property
+    def cache_key(self):
+        return self._cache_key
+
     def get_resume_token(self):
         resume_token = self._cache_resume_token.get_all() if self._cache_resume_token else {}
         return dict(map(self.decode, resume_token.items()))
 
-    def save_resume_token(self):
-        self.save(self._cache_resume_token, self.resume_token)
+    def save_resume_token(self, pipe=None):
+        self.save(self._cache_resume_token, self.resume_token, pipe)
 
     def get_timestamps(self):
         timestamps = self._cache_timestamps.get_all() if self._cache_timestamps else {}
         return dict(map(self.decode_ts, timestamps.items()))
 
-    def save_timestamps(self):
+    def save_timestamps(self, pipe=None):
         timestamps = {k: json_util.dumps(v) for k, v in self.timestamps.items()}
-        self.save(self._cache_timestamps, timestamps)
+        self.save(self._cache_timestamps, timestamps, pipe)
+
+    def get_progress(self):
+        progress = self._cache_progress.get_all() if self._cache_progress else {}
+        return dict(map(self.decode_ts, progress.items()))
+
+    def save_progress(self):
+        progress = {k: json_util.dumps(v) for k, v in self.progress.items()}
+        self.save(self._cache_progress, progress)
+
+    def clear_progress(self, pipe=None):
+        """时间已经保存的表，不再需要全量读取的进度"""
+        keys = [k for k in self.progress if k in self.timestamps]
+        if self._cache_progress and keys:
+            logger.info(f'Clear {self._cache_progress.__repr__()} {keys}')
+            self._cache_progress.delm(keys, pipe)
+        for k in keys:
+            self.progress.pop(k)
 
     def read(self):
+        """先全量读取新增的表，再读取所有表的增量数据
+        全量读取是一个整体，所有新增表都读取完成之后才开始增量读取，
+        先完成的小表也要等待大表，需要逐表进入增量的 reader 在 bootstrap 中自行穿插增量读取
+        """
         # 如果 self.keys 有新增数据库，也就是与 self.timestamps 中有不同
         # 则启动全量拉取
         if self.new_tables and self.is_bootstrap:
             yield from self.bootstrap()
             if self.is_resume:
-                self.push()
+                # 全量读取的数据写入之后，由写线程保存增量的起始位置与每张表的时间，并清除全量读取的进度
+                yield CommitPoint(position={'rt': dict(self._rt), 'ts': dict(self._ts)})
 
+        self.watching = True
         yield from self.watch()
 
     def bootstrap(self, *args, **kwargs):
@@ -110,13 +154,38 @@ class DBReader(BaseReader):
         """读取增量数据"""
         raise NotImplementedError()
 
-    def commit(self, *args, **kwargs):
+    def position(self):
+        """当前读取位置的快照，由读取线程调用，全量读取期间返回 None"""
+        if not self.watching or not self.is_resume:
+            return None
+        return {'rt': dict(self._rt), 'ts': dict(self._ts)}
+
+    def commit(self, token=None, position=None):
+        """提交断点
+        :param token: 全量读取的进度, {schema.table: progress}
+        :param position: position() 返回的位置，数据写入之后保存，
+            只更新已提交的断点，不修改读取线程正在推进的 _rt 与 _ts
+        """
+        if position:
+            self.resume_token.update(position['rt'])
+            self.timestamps.update(position['ts'])
+            self.push()
+            return
+
         self.resume_token.update(self._rt)
         self.timestamps.update(self._ts)
+        if token and self.is_resume:
+            self.progress.update(token)
+            self.save_progress()
 
     def push(self):
-        self.save_resume_token()
-        self.save_timestamps()
+        """使用一个 pipeline 保存所有断点"""
+        pipe = self._cache_resume_token.pipeline() if self._cache_resume_token else None
+        self.save_resume_token(pipe)
+        self.save_timestamps(pipe)
+        self.clear_progress(pipe)
+        if pipe is not None:
+            pipe.execute()
 
     def disconnect(self, *args, **kwargs):
         raise NotImplementedError()
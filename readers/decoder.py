@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: decoder
+@date: 2019-09-12
+@note: 在子进程中读取并解析 binlog，解析结果按顺序交给父进程，使增量读取不再受限于单核
+"""
+import signal
+import logging
+import multiprocessing
+from queue import Empty
+
+from config.sys_config import BINLOG_PIPELINE_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class BinlogDecoder:
+    """\
+    binlog 流水线解析
+    子进程使用 spawn 启动，不继承父进程的连接，reader 序列化时去掉连接，只带上解析所需的状态，
+    子进程负责接收、解析以及过滤 binlog，建立自己的连接，
+    每个 binlog event 解析出的数据作为一批，附带输出每条数据后的断点 (item, rt, ts)，
+    以及这个 event 中 DDL 失效的表，经过有界队列交给父进程，
+    父进程先使自己的表结构缓存失效，再按顺序输出并更新断点，保证顺序与断点语义不变
+    """
+    def __init__(self, reader, stream_config, queue_size=BINLOG_PIPELINE_QUEUE_SIZE):
+        """
+        :param reader: MySQLReader 实例，子进程使用它的 open_stream 与 parse_binlog 解析
+        :param stream_config: binlog stream 的参数
+        :param queue_size: 队列中最多缓存的批数
+        """
+        self.reader = reader
+        # fork 会继承父进程的 MySQL 与 Redis 连接，子进程释放它们时会关闭父进程的连接
+        ctx = multiprocessing.get_context('spawn')
+        self.queue = ctx.Queue(queue_size)
+        self.stopped = ctx.Event()
+        self.process = ctx.Process(target=self._run,
+                                   args=(reader, stream_config, self.queue, self.stopped),
+                                   daemon=True)
+
+    @classmethod
+    def _run(cls, reader, stream_config, queue, stopped):
+        """子进程负责读取与解析 binlog"""
+        # 信号由父进程处理
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        # 记录子进程中失效的表，随解析结果交给父进程
+        reader.registry.journal = []
+        # 子进程中的 reader 是父进程的副本，DDL 处理需要访问子进程的 stream
+        stream = reader.stream = reader.open_stream(stream_config)
+        try:
+            for binlog_event in stream:
+                if stopped.is_set():
+                    break
+                items = cls._decode(reader, binlog_event)
+                invalidated, reader.registry.journal = reader.registry.journal, []
+                if items or invalidated:
+                    queue.put((invalidated, items))
+        except Exception as e:
+            logger.error(f'Binlog decoder error: {e}')
+            queue.put(e)
+        finally:
+            stream.close()
+            reader.registry.close()
+            queue.put(None)
+
+    @staticmethod
+    def _decode(reader, binlog_event):
+        """解析一个 binlog event，每条数据附带输出这条数据之后的断点"""
+        items = []
+
+        def mark():
+            item = items[-1][0]
+            key = f"{item.get('database')}.{item.get('table')}"
+            ts = reader._ts.get(key)
+            items[-1].extend([dict(reader._rt), {key: ts} if ts is not None else {}])
+
+        # 断点在数据输出之后才更新，需要取到下一条数据时再记录上一条的断点
+        for item in reader.parse_binlog(binlog_event):
+            if items:
+                mark()
+            items.append([item])
+        if items:
+            mark()
+        return items
+
+    def start(self):
+        self.process.start()
+        logger.info(f'Binlog decoder started, pid={self.process.pid}')
+
+    def __iter__(self):
+        """按顺序获取子进程解析的数据，DDL 失效的表先同步到父进程的表结构缓存
+        :return: 生成器, [[item, rt, ts], ...]
+        """
+        while True:
+            try:
+                items = self.queue.get(timeout=1)
+            except Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('Binlog decoder exited unexpectedly')
+                continue
+
+            if items is None:
+                break
+            if isinstance(items, Exception):
+                raise items
+
+            invalidated, items = items
+            for schema, table in invalidated:
+                self.reader.registry.invalidate(schema, table)
+            if items:
+                yield items
+
+    def stop(self):
+        self.stopped.set()
+        if self.process.is_alive():
+            # 子进程可能阻塞在读取 binlog 或者写入队列
+            self.process.terminate()
+        self.process.join(5)
+        logger.info('Binlog decoder stopped')
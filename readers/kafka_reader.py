@@ -10,14 +10,19 @@ https://docs.confluent.io/current/clients/confluent-kafka-python/#confluent-kafk
 https://github.com/edenhill/librdkafka/blob/master/CONFIGURATION.md
 """
 import logging
-from confluent_kafka import Consumer, OFFSET_INVALID
+from threading import Lock
+
+from confluent_kafka import Consumer, TopicPartition, OFFSET_INVALID
 
 from readers.mq_base import MQReader
 from utils.str_utils import b2s
 from config.sys_config import (
     BOOTSTRAP_SERVERS,
     BROKER_VERSION,
-    COMPRESSION_TYPE
+    COMPRESSION_TYPE,
+    CONSUME_BATCH_SIZE,
+    CONSUME_TIMEOUT,
+    MANUAL_COMMIT
 )
 
 logger = logging.getLogger(__name__)
@@ -37,22 +42,41 @@ class KafkaReader(MQReader):
     def get_token(msg):
         return {f'{msg.topic()}.{msg.partition()}': msg.offset() + 1}
 
+    @staticmethod
+    def get_codec(msg):
+        """消息的编码方式，由 writer 写在 codec header 中，没有时为 json"""
+        headers = dict(msg.headers() or ())
+        return b2s(headers.get('codec') or b'json')
+
     def __init__(self, topics, group_id='group-1', client_id='default',
                  bootstrap_servers=BOOTSTRAP_SERVERS,
-                 is_bootstrap=True, is_resume=True):
+                 is_bootstrap=True, is_resume=True,
+                 consume_size=CONSUME_BATCH_SIZE, consume_timeout=CONSUME_TIMEOUT,
+                 manual_commit=MANUAL_COMMIT):
         """从 Kafka 读取数据
         :param topics: list, kafka topics
         :param group_id: str, kafka topics group_id
         :param client_id: str, kafka topics client_id
         :param bootstrap_servers: kafka host
         :param is_bootstrap: 是否全量读取
-        :param is_resume: 是否断点续传
+        :param is_resume: 是否断点续传，同时在 redis 中保存 offset
+        :param consume_size: 每次 consume 最多返回的消息数
+        :param consume_timeout: 每次 consume 最长等待的时间（秒）
+        :param manual_commit: 是否手动提交 offset，只有 writer 写入之后才异步提交到 Kafka，
+            此时 Kafka 中的 offset 已经可以断点续传，redis 是可选的
         """
         if not isinstance(topics, (list, tuple)):
             topics = [topics]
         self.topics = topics
         self.group_id = group_id
         self.client_id = client_id
+        self.consume_size = consume_size
+        self.consume_timeout = consume_timeout
+        self.manual_commit = manual_commit
+        # 当前分配给这个 consumer 的分区 {topic.partition}，被收回的分区不再提交 offset
+        self.assigned = set()
+        # 再均衡回调与 writer 线程的提交互斥
+        self.lock = Lock()
 
         super().__init__(f'kafka:{self.client_id}:{self.group_id}',
                          is_bootstrap=is_bootstrap, is_resume=is_resume)
@@ -63,7 +87,7 @@ class KafkaReader(MQReader):
             'bootstrap.servers': bootstrap_servers,
             'broker.version.fallback': BROKER_VERSION,
             'compression.type': COMPRESSION_TYPE,
-            'enable.auto.commit': True,
+            'enable.auto.commit': not manual_commit,
             'auto.offset.reset': 'earliest' if is_bootstrap else 'latest',
             'on_commit': self.on_commit,
         }
@@ -87,29 +111,65 @@ class KafkaReader(MQReader):
                 if part.offset != OFFSET_INVALID:
                     self.resume_token[key] = part.offset
 
+    def commit(self, token):
+        """writer 写入之后提交 offset
+        :param token: 每个分区下一条要读取的 offset, {topic.partition: offset}
+        """
+        if not self.manual_commit:
+            super().commit(token)
+            return
+
+        with self.lock:
+            # 再均衡之后被收回的分区由新的 consumer 提交，这里不能覆盖
+            revoked = [key for key in token if key not in self.assigned]
+            if revoked:
+                logger.info(f'Kafka reader discard offsets of revoked partitions {revoked}')
+            token = {key: offset for key, offset in token.items() if key in self.assigned}
+            super().commit(token)
+            if not token:
+                return
+
+            offsets = []
+            for key, offset in token.items():
+                # topic 中可能有 '.'，分区号在最后
+                topic, partition = key.rsplit('.', 1)
+                offsets.append(TopicPartition(topic, int(partition), offset))
+            self.consumer.commit(offsets=offsets, asynchronous=True)
+
     def read(self):
         """从 kafka 读取数据
         https://github.com/confluentinc/confluent-kafka-python/issues/201
         :return:
         """
-        # 重置 offset
         def on_assign(consumer, partitions):
+            with self.lock:
+                self.assigned.update(f'{part.topic}.{part.partition}' for part in partitions)
+
+            # 手动提交时 Kafka 中的 offset 就是断点，不需要从 redis 重置
+            if not self.is_resume or self.manual_commit:
+                return
+
+            # 重置 offset
             consumer.assign(partitions)
             for part in partitions:
                 key = f'{part.topic}.{part.partition}'
                 part.offset = self.resume_token.get(key) or 0
             consumer.commit(offsets=partitions, asynchronous=False)
 
-        # 取消订阅
-        if self.is_resume:
-            self.consumer.subscribe(self.topics, on_assign=on_assign)
-        else:
-            self.consumer.subscribe(self.topics)
+        def on_revoke(consumer, partitions):
+            # 分区交给其他 consumer 之前停止提交，尚未写入的消息由新的 consumer 重新读取
+            keys = {f'{part.topic}.{part.partition}' for part in partitions}
+            with self.lock:
+                self.assigned -= keys
+            logger.info(f'Kafka reader partitions revoked {sorted(keys)}')
+
+        self.consumer.subscribe(self.topics, on_assign=on_assign, on_revoke=on_revoke)
         logger.info(f'Kafka consumer subscribe {self.topics}')
 
         while True:
             try:
-                msg = self.consumer.poll(1)
+                # 一次调用返回多条消息，减少每条消息调用 librdkafka 的开销
+                msgs = self.consumer.consume(self.consume_size, self.consume_timeout)
             except RuntimeError as e:
                 logger.error(f'RuntimeError:{e}')
                 break
@@ -117,14 +177,21 @@ class KafkaReader(MQReader):
                 logger.error('KeyboardInterrupt')
                 break
 
-            if msg is None:
-                continue
-            if msg.error():
-                logger.error(msg.error())
-                continue
+            batch = []
+            for msg in msgs:
+                if msg.error():
+                    logger.error(msg.error())
+                    continue
+                batch.append(msg)
 
-            # logger.info(f'{msg.topic()} {msg.partition()} {msg.offset()}')
-            yield msg
+            if not batch:
+                continue
+            if self.batch_mode:
+                # 按批读取，整批交给 operator
+                yield batch
+            else:
+                # logger.info(f'{msg.topic()} {msg.partition()} {msg.offset()}')
+                yield from batch
 
         # 取消订阅
         try:
@@ -9,26 +9,73 @@
 """
 import logging
 from datetime import datetime
+from collections.abc import Mapping
 
 from bson import Timestamp
-from pymongo import DESCENDING
+from bson.raw_bson import RawBSONDocument
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
 from pymongo.read_concern import ReadConcern
 
 from connectors.mongo_connector import MongoDBConnector
 from readers.db_base import DBReader
+from readers.base import RowBatch
+from readers.throttle import AdaptiveThrottle
+from readers.bootstrap import BootstrapScheduler, ChunkProgress, ParallelScanner, ScanTask
+from operators.common import CommitPoint
 from utils.str_utils import b2s
+from config.sys_config import (
+    BOOTSTRAP_WORKERS,
+    BOOTSTRAP_TABLES,
+    BOOTSTRAP_CHUNK_SIZE,
+    BOOTSTRAP_BATCH_SIZE,
+    BOOTSTRAP_TARGET_LAG,
+    CHANGE_STREAM_BATCH_SIZE,
+    CHANGE_STREAM_MAX_AWAIT_MS,
+    MONGO_RAW
+)
 
 logger = logging.getLogger(__name__)
 
 
+class DocumentBatch(RowBatch):
+    """一批共用信封的文档，展开时补充 documentKey"""
+    __slots__ = ()
+
+    def __init__(self, envelope, rows):
+        super().__init__(envelope, rows, 'fullDocument')
+
+    def event(self, row):
+        event = super().event(row)
+        event['documentKey'] = row['_id']
+        return event
+
+
 class MongoDBReader(DBReader):
+    # 需要同步的 change event 类型，其他事件在服务端过滤
+    operation_types = (
+        'insert',
+        'update',
+        'replace',
+        'delete',
+    )
+
     @staticmethod
     def decode(args):
         k, v = args
         return b2s(k), b2s(v)
 
     def __init__(self, tables, client_id='default', *, user, password, host, port,
-                 database=None, is_bootstrap=True, is_resume=True):
+                 database=None, is_bootstrap=True, is_resume=True,
+                 bootstrap_workers=BOOTSTRAP_WORKERS,
+                 bootstrap_tables=BOOTSTRAP_TABLES,
+                 batch_size=BOOTSTRAP_BATCH_SIZE,
+                 chunk_size=BOOTSTRAP_CHUNK_SIZE,
+                 target_lag=BOOTSTRAP_TARGET_LAG,
+                 columns=None, filters=None,
+                 stream_batch_size=CHANGE_STREAM_BATCH_SIZE,
+                 max_await_time_ms=CHANGE_STREAM_MAX_AWAIT_MS,
+                 raw=MONGO_RAW):
         """从 MongoDB 读取数据
         :param tables: list, 要读取的库表
         :param client_id: str, 用于区分不同的客户端
@@ -39,11 +86,36 @@ class MongoDBReader(DBReader):
         :param database: 要连接 MongoDB 的数据库
         :param is_bootstrap: 是否全量查询
         :param is_resume: 是与否启用断点续传
+        :param bootstrap_workers: 全量读取时并行的游标数，大于 1 时按 _id 分片读取
+        :param bootstrap_tables: 全量读取时同时读取的最大集合数
+        :param batch_size: 全量读取时游标每批返回的文档数
+        :param chunk_size: 全量读取时每个 _id 分片的文档数，不分片时每读取多少条记录一次进度
+        :param target_lag: 全量读取时允许的最大复制延迟（秒），0 表示不限速
+        :param columns: dict, 每个集合需要读取的字段 {db.coll: [field, ...]}，
+            _id 总会被读取，未配置的集合读取所有字段
+        :param filters: dict, 每个集合全量读取的查询条件 {db.coll: {...}}，
+            只作用于全量读取
+        :param stream_batch_size: change stream 每批返回的最大事件数
+        :param max_await_time_ms: change stream 没有新事件时服务端最长等待的时间（毫秒）
+        :param raw: 是否按原始 BSON 读取，文档保持为 RawBSONDocument，只在访问字段时解码
         """
         super().__init__(tables, f'mongo:{client_id}', is_bootstrap, is_resume)
+        self.raw = raw
         self.conn = MongoDBConnector(user=user, password=password,
-                                     host=host, port=port, database=database)
+                                     host=host, port=port, database=database,
+                                     document_class=RawBSONDocument if raw else dict)
         self.client_id = client_id
+        self.bootstrap_workers = bootstrap_workers
+        self.bootstrap_tables = bootstrap_tables
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.target_lag = target_lag
+        self.filters = filters or {}
+        self.stream_batch_size = stream_batch_size
+        self.max_await_time_ms = max_await_time_ms
+        # 每个集合的投影，_id 默认返回
+        self.projections = {key: {field: 1 for field in fields}
+                            for key, fields in (columns or {}).items() if fields}
         self.db_names = set()
         self.coll_names = set()
         if isinstance(tables, (list, tuple, set)):
@@ -56,59 +128,172 @@ class MongoDBReader(DBReader):
 
     def bootstrap(self):
         """读取历史数据"""
-        for key in self.new_tables:
-            schema, table = key.split('.')
-            yield from self._bootstrap(schema, table)
-        self.commit()
+        # 上次中断的全量读取
+        progress = {k: v for k, v in self.progress.items() if k in self.new_tables}
+        if progress:
+            logger.info(f'MongoDB resume bootstrap progress={progress}')
 
-    def _bootstrap(self, db_name, coll_name):
-        """读取历史数据"""
-        # 传递开始标志位
-        yield {
-            'operationType': 'bootstrap-start',
-            'ns': {'db': db_name, 'coll': coll_name},
-            'topic': f'{db_name}-{coll_name}',
-        }
+        # 小表优先，尽快进入增量同步
+        keys = self.order_tables(self.new_tables)
+        yield from self._bootstrap(keys, progress)
 
-        db = self.conn.client[db_name]
-        coll = db[coll_name]
+    def order_tables(self, keys):
+        """按 collStats 估算的大小从小到大排序"""
+        sizes = {}
+        for key in keys:
+            db_name, coll_name = key.split('.')
+            try:
+                sizes[key] = self.conn.get_collection_size(db_name, coll_name)
+            except OperationFailure as e:
+                logger.error(f'MongoDB collStats error in {key}: {e}')
+                sizes[key] = 0
+        return sorted(keys, key=lambda k: sizes[k])
 
-        # 开启 session, 获得当前时间下最大的 _id, start_operation_time
+    def get_max_id(self, db_name, coll_name):
+        """开启 session, 获得当前时间下最大的 _id"""
+        coll = self.conn.client[db_name][coll_name]
         with self.conn.client.start_session() as session:
             with session.start_transaction(read_concern=ReadConcern('snapshot')):
-                ts = Timestamp(datetime.utcnow(), 0)
                 max_obj = coll.find_one(sort=[('_id', DESCENDING)])
+        return max_obj.get('_id') if max_obj else None
+
+    def read_collection(self, client, db_name, coll_name, max_id, min_id=None):
+        """读取集合中 (min_id, max_id] 的数据"""
+        key = f'{db_name}.{coll_name}'
+        coll = client[db_name][coll_name]
+        domain = {'_id': {'$lte': max_id}}
+        if min_id is not None:
+            domain['_id']['$gt'] = min_id
+        if self.filters.get(key):
+            domain = {'$and': [domain, self.filters[key]]}
+
+        values = coll.find(domain, self.projections.get(key)).batch_size(self.batch_size)
+        if self.is_resume:
+            # 按 _id 顺序读取，中断后才能从最近的 _id 继续
+            values = values.sort('_id', ASCENDING)
+        yield from values
+
+    def _bootstrap(self, keys, progress):
+        """读取历史数据，多个集合共用同一个开始时间，并发读取
+        :param keys: 要读取的集合，按开始读取的先后排序
+        :param progress: 上次中断时每个集合的读取进度
+        """
+        # 采样计数器
+        index = 1
+        # 记录开始时间, 之后的数据由 change stream 同步
+        ts = Timestamp(datetime.utcnow(), 0)
+        # 每个集合的开始时间、最大 _id 以及距离上次记录进度读取的条数
+        timestamps = {}
+        max_ids = {}
+        counters = {}
+        # 每个集合的分片完成情况
+        chunks = {}
+
+        plans = []
+        for key in keys:
+            bp = progress.get(key) or {}
+            if bp.get('complete'):
+                # 上次已经读取完成，只是没来得及记录时间
+                self._ts[key] = bp['ts']
+                continue
+
+            db_name, coll_name = key.split('.')
+            timestamps[key] = bp.get('ts') or ts
+            max_id = max_ids[key] = bp.get('max_id') or self.get_max_id(db_name, coll_name)
+            tasks = self.plan_tasks(key, max_id, bp.get('_id')) if max_id else []
+            chunks[key] = ChunkProgress([task.position for task in tasks])
+            plans.append((key, tasks))
+
+        # MongoClient 是线程安全的，每个扫描线程共用同一个 client
+        contexts = [self.conn.client] * max(self.bootstrap_workers, self.bootstrap_tables)
+        # 根据副本集的复制延迟限速
+        throttle = (AdaptiveThrottle(self.conn.get_replication_lag, self.target_lag)
+                    if self.target_lag else None)
+        scanner = ParallelScanner(contexts, batch_size=self.batch_size, throttle=throttle)
+        scheduler = BootstrapScheduler(scanner, self.bootstrap_tables)
 
-        max_id = max_obj.get('_id')
-        if max_id:
-            domain = {'_id': {'$lte': max_id}}
-            values = coll.find(domain)
-            index = 1
-
-            for val in values:
-                data = {
-                    'operationType': 'bootstrap-insert',
-                    'fullDocument': val,
-                    'documentKey': val['_id'],
-                    'ns': {'db': db_name, 'coll': coll_name},
-                    'topic': f'{db_name}-{coll_name}',
-                }
-                yield data
-                # 添加采样数据到日志
-                index += 1
-                if index % 50_000 == 0:
-                    logger.info(f"MongoDB index = {index}, data={data}")
-
-        # 传递结束标志位
-        yield {
-            'operationType': 'bootstrap-complete',
-            'ns': {'db': db_name, 'coll': coll_name},
-            'topic': f'{db_name}-{coll_name}',
-        }
-
-        self._ts.update({
-            f'{db_name}.{coll_name}': ts
-        })
+        for status, key, value in scheduler.run(plans):
+            db_name, coll_name = key.split('.')
+            ns = {'db': db_name, 'coll': coll_name}
+            topic = f'{db_name}-{coll_name}'
+            if status == scheduler.START:
+                counters[key] = 0
+                # 传递开始标志位
+                yield {'operationType': 'bootstrap-start', 'ns': ns, 'topic': topic}
+            elif status == scheduler.ROWS:
+                if self.batch_mode:
+                    # 整批共用一个信封
+                    yield DocumentBatch({'operationType': 'bootstrap-insert',
+                                         'ns': ns, 'topic': topic}, value)
+                    index += len(value)
+                else:
+                    for val in value:
+                        data = {
+                            'operationType': 'bootstrap-insert',
+                            'fullDocument': val,
+                            'documentKey': val['_id'],
+                            'ns': ns,
+                            'topic': topic,
+                        }
+                        yield data
+                        # 添加采样数据到日志
+                        index += 1
+                        if index % 50_000 == 0:
+                            logger.info(f"MongoDB index = {index}, data={data}")
+
+                counters[key] += len(value)
+                if (self.is_resume and self.bootstrap_workers <= 1
+                        and counters[key] >= self.chunk_size):
+                    counters[key] = 0
+                    # 提交后记录已经读取的最大 _id
+                    yield self.checkpoint(key, timestamps[key],
+                                          _id=value[-1]['_id'], max_id=max_ids[key])
+            elif status == scheduler.DONE:
+                _id = chunks[key].finish(value.position)
+                if _id is not None and self.is_resume:
+                    # 之前的分片都已读取，提交后记录进度
+                    yield self.checkpoint(key, timestamps[key], _id=_id, max_id=max_ids[key])
+            elif status == scheduler.COMPLETE:
+                # 传递结束标志位
+                yield {'operationType': 'bootstrap-complete', 'ns': ns, 'topic': topic}
+                self._ts.update({
+                    key: timestamps[key]
+                })
+                if self.is_resume:
+                    yield self.checkpoint(key, timestamps[key], complete=True)
+
+    def plan_tasks(self, key, max_id, start=None):
+        """按 _id 把集合切分为多个范围 (lower, upper]，不能切分时整个集合读取
+        :param key: 要读取的集合
+        :param max_id: 开始读取时最大的 _id
+        :param start: 上次中断时已经读取完成的 _id
+        :return: [ScanTask, ...]
+        """
+        db_name, coll_name = key.split('.')
+        full_scan = [ScanTask(key, self.read_collection, db_name, coll_name, max_id, start)]
+        if self.bootstrap_workers <= 1:
+            return full_scan
+
+        try:
+            points = self.conn.get_split_points(db_name, coll_name, self.chunk_size)
+        except OperationFailure as e:
+            logger.error(f'MongoDB split error in {key}: {e}')
+            return full_scan
+
+        # 只保留 (start, max_id) 之间的分界点，类型不同的 _id 无法比较，也不作为分界点
+        points = [p for p in points if type(p) is type(max_id) and p < max_id
+                  and (start is None or p > start)]
+        bounds = [start] + points + [max_id]
+        logger.info(f'MongoDB {key} split into {len(bounds) - 1} chunks')
+        return [ScanTask(key, self.read_collection, db_name, coll_name, upper, lower,
+                         position=upper)
+                for lower, upper in zip(bounds, bounds[1:])]
+
+    @staticmethod
+    def checkpoint(key, ts, **kwargs):
+        """生成全量读取的断点，随 CommitPoint 在数据写入之后保存"""
+        bp = dict(ts=ts, **kwargs)
+        return CommitPoint({key: bp})
 
     def watch(self):
         """监控数据
@@ -133,14 +318,38 @@ class MongoDBReader(DBReader):
             start_at_operation_time = None
         else:
             resume_after = None
-            start_at_operation_time = min(list(self.timestamps.values()))
+            # 全量读取的时间在数据写入之后才提交，这里使用读取线程记录的时间
+            start_at_operation_time = min(list(self._ts.values()))
+
+        # 只有一个库时打开库级别的 stream，其他库的变化不会进入
+        database = next(iter(self.db_names)) if len(self.db_names) == 1 else None
 
         return dict(
+            pipeline=self.build_pipeline(),
+            database=database,
             full_document='updateLookup',
             start_at_operation_time=start_at_operation_time,
-            resume_after=resume_after
+            resume_after=resume_after,
+            batch_size=self.stream_batch_size,
+            max_await_time_ms=self.max_await_time_ms,
         )
 
+    def build_pipeline(self):
+        """在服务端按集合与事件类型过滤，不需要的事件不会传输与解码"""
+        colls = {}
+        for key in self.inc_tables:
+            db_name, coll_name = key.split('.')
+            colls.setdefault(db_name, []).append(coll_name)
+        namespaces = [{'ns.db': db_name, 'ns.coll': {'$in': sorted(names)}}
+                      for db_name, names in sorted(colls.items())]
+
+        match = {'operationType': {'$in': list(self.operation_types)}}
+        if len(namespaces) == 1:
+            match.update(namespaces[0])
+        elif namespaces:
+            match['$or'] = namespaces
+        return [{'$match': match}]
+
     def parse_change_stream(self, change_stream):
         """解析 msg"""
         # 过滤掉不需要的表
@@ -164,7 +373,36 @@ class MongoDBReader(DBReader):
 
         self._rt = self.stream._resume_token
         self._ts[key] = ts
-        yield dict(**change_stream, topic=topic)
+        yield dict(**self.project(key, change_stream), topic=topic)
+
+    def message_key(self, event):
+        """按 _id 生成消息的 key，同一个文档的变化写入同一个分区"""
+        document_key = event.get('documentKey')
+        if isinstance(document_key, Mapping):
+            # change event 中是 {'_id': ...}，全量数据中直接是 _id
+            document_key = document_key.get('_id')
+        return None if document_key is None else str(document_key).encode()
+
+    def project(self, key, change_stream):
+        """增量数据按相同的字段裁剪，裁剪后的文档会被解码"""
+        projection = self.projections.get(key)
+        if not projection:
+            return change_stream
+
+        def _project(doc):
+            if not doc:
+                return doc
+            return {k: v for k, v in doc.items()
+                    if k == '_id' or k.split('.')[0] in projection}
+
+        # 原始 BSON 文档不能修改，复制第一层
+        change_stream = dict(change_stream)
+        change_stream['fullDocument'] = _project(change_stream.get('fullDocument'))
+        description = change_stream.get('updateDescription')
+        if description:
+            change_stream['updateDescription'] = dict(
+                description, updatedFields=_project(description.get('updatedFields')))
+        return change_stream
 
     def disconnect(self, *args, **kwargs):
         if self.stream:
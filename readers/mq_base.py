@@ -31,6 +31,10 @@ class MQReader(BaseReader):
     def get_token(msg):
         raise NotImplementedError()
 
+    @staticmethod
+    def get_codec(msg):
+        raise NotImplementedError()
+
     def __init__(self, cache_key='', is_bootstrap=True, is_resume=True):
         """从 MQ 读取数据
         :param cache_key: 缓存key
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: multiplexer
+@date: 2019-09-19
+@note: 同一个 MySQL 实例只建立一个 binlog 复制连接，解析一次后分发给进程内的多个 reader
+"""
+import time
+import logging
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, Event
+
+from pymysqlreplication.gtid import Gtid, GtidSet
+from pymysqlreplication.row_event import RowsEvent
+from pymysqlreplication.event import RotateEvent, GtidEvent, QueryEvent
+
+from connectors.mysql_connector import MySQLConnector
+from readers.mysql_schema import (
+    DDL_PATTERN,
+    RegistryBinLogStreamReader,
+    SchemaRegistry,
+    parse_ddl_tables
+)
+from utils.str_utils import b2s
+from config.sys_config import BINLOG_PIPELINE_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+def intersect_gtid_sets(gtid_sets):
+    """多个 GTID 集合的交集，即所有订阅者都已经处理过的事务
+    :param gtid_sets: list, [GtidSet, ...]
+    :return: GtidSet
+    """
+    result = None
+    for gtid_set in gtid_sets:
+        current = {gtid.sid: gtid.intervals for gtid in gtid_set.gtids}
+        if result is None:
+            result = current
+            continue
+        result = {
+            sid: [(max(a0, b0), min(a1, b1))
+                  for a0, a1 in intervals for b0, b1 in current[sid]
+                  if max(a0, b0) < min(a1, b1)]
+            for sid, intervals in result.items() if sid in current
+        }
+
+    # 内部的区间是左闭右开的
+    return GtidSet(','.join(
+        sid + ''.join(f':{a}-{b - 1}' for a, b in intervals)
+        for sid, intervals in (result or {}).items() if intervals
+    ))
+
+
+class Subscription:
+    """\
+    一个 reader 对共享 binlog 的订阅
+    记录已经收到的位置，共享 stream 从更早的位置重启时，跳过已经收到的 event
+    """
+    def __init__(self, name, tables, position, queue_size=BINLOG_PIPELINE_QUEUE_SIZE):
+        """
+        :param name: str, 订阅者的名称，用于日志
+        :param tables: set, 需要的表 {(schema, table), ...}
+        :param position: dict, 开始的位置, 包含 log_file, log_pos 或者 auto_position
+        :param queue_size: 队列中最多缓存的 event 数
+        """
+        self.name = name
+        self.tables = tables
+        self.log_file = position.get('log_file')
+        self.log_pos = position.get('log_pos')
+        # 已经处理过的事务
+        self.gtid_set = GtidSet(position.get('auto_position') or '')
+        # 当前事务是否已经处理过
+        self.skipping = False
+        self.queue = Queue(queue_size)
+        self.closed = Event()
+
+    def has_position(self):
+        return bool(self.log_file and self.log_pos)
+
+    def accept(self, binlog_event, log_file):
+        """判断是否需要这个 event，并推进已经收到的位置
+        :param binlog_event: 解析后的 event
+        :param log_file: event 所在的 binlog 文件
+        """
+        if isinstance(binlog_event, RotateEvent):
+            return True
+
+        log_pos = binlog_event.packet.log_pos
+        if (self.has_position() and log_file
+                and (log_file, log_pos) <= (self.log_file, self.log_pos)):
+            return False
+
+        if isinstance(binlog_event, GtidEvent):
+            gtid = Gtid(binlog_event.gtid)
+            self.skipping = gtid in self.gtid_set
+            if not self.skipping:
+                self.gtid_set.merge_gtid(gtid)
+        if self.skipping:
+            return False
+
+        if log_file:
+            self.log_file, self.log_pos = log_file, log_pos
+        if isinstance(binlog_event, RowsEvent):
+            return (binlog_event.schema, binlog_event.table) in self.tables
+        return True
+
+    def put(self, item):
+        """队列满时等待，但是订阅被取消时放弃"""
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+            except Full:
+                continue
+            else:
+                return
+
+    def __iter__(self):
+        """按顺序获取 event"""
+        while not self.closed.is_set():
+            try:
+                item = self.queue.get(timeout=1)
+            except Empty:
+                continue
+
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self.closed.set()
+
+    def __repr__(self):
+        return f'Subscription({self.name}, {self.log_file}:{self.log_pos})'
+
+
+class BinlogMultiplexer:
+    """\
+    binlog 多路分发
+    每个 MySQL 实例 (host, port) 只有一个实例，由子线程读取 binlog，
+    每个 event 只解析一次，按订阅者的表分发到各自的队列；
+    解析的表是所有订阅者的表的并集，新的订阅者加入时，共享 stream 从所有订阅者中最早的位置重启，
+    已经收到过的 event 按位置或者 GTID 跳过，所有订阅者都共享同一个速度
+    """
+    _instances = {}
+    _lock = Lock()
+
+    @classmethod
+    def get(cls, mysql_settings, conn_settings, only_events):
+        """获取 MySQL 实例对应的 multiplexer
+        :param mysql_settings: dict, 复制连接的参数
+        :param conn_settings: dict, 查询表结构的连接参数
+        :param only_events: 需要的 event 类型，共享 stream 读取所有订阅者需要的 event
+        """
+        key = (mysql_settings['host'], mysql_settings['port'])
+        with cls._lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(mysql_settings, conn_settings, only_events)
+            instance = cls._instances[key]
+            # 订阅时 stream 会重启，新增的 event 类型在重启后生效
+            instance.only_events = tuple(dict.fromkeys(tuple(instance.only_events)
+                                                       + tuple(only_events)))
+            return instance
+
+    def __init__(self, mysql_settings, conn_settings, only_events):
+        self.mysql_settings = mysql_settings
+        self.conn_settings = conn_settings
+        self.only_events = only_events
+        self.registry = SchemaRegistry(conn_settings)
+        self.server_id = int(time.time())
+        self.subscriptions = []
+        self.lock = Lock()
+        # 订阅者变化后需要重启 stream
+        self.restart = Event()
+        self.stream = None
+        self.log_file = None
+        self.thread = None
+
+    def subscribe(self, name, tables, position):
+        """订阅 binlog
+        :param name: str, 订阅者的名称
+        :param tables: set, 需要的表 {(schema, table), ...}
+        :param position: dict, 开始的位置，为空时从当前位置开始
+        :return: Subscription
+        """
+        if not (position.get('log_file') and position.get('log_pos')
+                or position.get('auto_position')):
+            conn = MySQLConnector(**self.conn_settings)
+            try:
+                position = conn.get_binlog_file_position()
+            finally:
+                conn.close()
+
+        subscription = Subscription(name, set(tables), position)
+        with self.lock:
+            self.subscriptions.append(subscription)
+            self.registry.preload({schema for schema, _ in tables})
+            self.restart.set()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+            elif self.stream is not None:
+                # 没有新的 event 时子线程阻塞在读取上，关闭连接使其立即重启
+                self.stream.close()
+        logger.info(f'Binlog subscribed by {subscription}')
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """取消订阅，stream 在下一个 event 之后按剩余的订阅者重启"""
+        subscription.close()
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+            self.restart.set()
+        logger.info(f'Binlog unsubscribed by {subscription}')
+
+    def build_stream_config(self, subscriptions):
+        """从所有订阅者中最早的位置开始读取"""
+        stream_config = dict(
+            connection_settings=self.mysql_settings,
+            server_id=self.server_id,
+            only_events=self.only_events,
+            blocking=True,
+            only_schemas={schema for s in subscriptions for schema, _ in s.tables},
+            only_tables={table for s in subscriptions for _, table in s.tables},
+            freeze_schema=True,
+        )
+        if all(s.has_position() for s in subscriptions):
+            log_file, log_pos = min((s.log_file, s.log_pos) for s in subscriptions)
+            stream_config.update(log_file=log_file, log_pos=log_pos, resume_stream=True)
+        else:
+            gtid_set = intersect_gtid_sets([s.gtid_set for s in subscriptions])
+            stream_config.update(auto_position=str(gtid_set), resume_stream=True)
+        return stream_config
+
+    def _run(self):
+        """子线程负责读取 binlog 并分发"""
+        while True:
+            with self.lock:
+                subscriptions = list(self.subscriptions)
+                self.restart.clear()
+                if not subscriptions:
+                    # 在锁内退出，之后的订阅会启动新的子线程
+                    self.thread = None
+                    break
+
+            stream_config = self.build_stream_config(subscriptions)
+            logger.info(f'Binlog multiplexer start from {stream_config}')
+            tables = set().union(*(s.tables for s in subscriptions))
+            self.stream = RegistryBinLogStreamReader(registry=self.registry, tables=tables,
+                                                     **stream_config)
+            self.log_file = stream_config.get('log_file')
+            try:
+                for binlog_event in self.stream:
+                    self.dispatch(binlog_event, subscriptions)
+                    if self.restart.is_set():
+                        break
+            except Exception as e:
+                if self.restart.is_set():
+                    continue
+                logger.error(f'Binlog multiplexer error: {e}')
+                with self.lock:
+                    failed, self.subscriptions = self.subscriptions, []
+                    self.thread = None
+                for subscription in failed:
+                    subscription.put(e)
+                break
+            finally:
+                self.stream.close()
+
+        logger.info('Binlog multiplexer stopped')
+
+    def dispatch(self, binlog_event, subscriptions):
+        """\
+        分发 event，DDL 只在共享的表结构缓存上处理一次
+        同一个 event 对象分发给所有订阅者，订阅者只能读取，不能修改
+        """
+        if isinstance(binlog_event, RotateEvent):
+            self.log_file = binlog_event.next_binlog
+        elif isinstance(binlog_event, QueryEvent):
+            self.parse_ddl(binlog_event)
+        elif isinstance(binlog_event, RowsEvent):
+            # rows 是延迟解析的，在分发前解析一次，避免多个订阅者的线程同时解析同一个 packet
+            binlog_event.rows
+
+        for subscription in subscriptions:
+            if subscription.accept(binlog_event, self.log_file):
+                subscription.put(binlog_event)
+
+    def parse_ddl(self, binlog_event):
+        """表结构变化时，使表结构缓存与 table_map 中的表失效"""
+        query = binlog_event.query
+        if not DDL_PATTERN.match(query):
+            return
+
+        schema = b2s(binlog_event.schema)
+        tables = parse_ddl_tables(query, schema)
+        for db_name, table_name in tables or [(schema, None)]:
+            self.registry.invalidate(db_name, table_name)
+            self.stream.forget_tables(db_name, table_name)
+
+
+if __name__ == '__main__':
+    print(intersect_gtid_sets([
+        GtidSet('3e11fa47-71ca-11e1-9e33-c80aa9429562:1-10:20-30'),
+        GtidSet('3e11fa47-71ca-11e1-9e33-c80aa9429562:5-25'),
+    ]))
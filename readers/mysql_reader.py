@@ -11,6 +11,7 @@ import time
 import logging
 import json
 from datetime import datetime
+from collections import deque
 
 from bson import Timestamp
 from werkzeug.utils import cached_property
@@ -24,13 +25,48 @@ from pymysqlreplication.row_event import (
 )
 from pymysqlreplication.event import (
     RotateEvent,
-    GtidEvent
+    GtidEvent,
+    QueryEvent,
+    XidEvent
 )
 
 from connectors.mysql_connector import MySQLConnector
 from readers.db_base import DBReader
-from utils.common import DateEncoder
+from readers.base import RowBatch
+from readers.throttle import AdaptiveThrottle
+from readers.decoder import BinlogDecoder
+from readers.multiplexer import BinlogMultiplexer
+from readers.mysql_schema import (
+    DDL_PATTERN,
+    RegistryBinLogStreamReader,
+    SchemaRegistry,
+    parse_ddl_tables
+)
+from operators.common import CommitPoint
+from readers.bootstrap import (
+    BootstrapScheduler,
+    ChunkProgress,
+    ParallelScanner,
+    ScanTask,
+    WatermarkChunk,
+    pk_value,
+    split_range
+)
+from utils.common import DateEncoder, obj2bytes
 from utils.str_utils import b2s
+from config.sys_config import (
+    BOOTSTRAP_WORKERS,
+    BOOTSTRAP_TABLES,
+    BOOTSTRAP_CHUNK_SIZE,
+    BOOTSTRAP_TARGET_LAG,
+    BINLOG_BATCH,
+    BINLOG_PIPELINE,
+    BINLOG_SHARED,
+    BINLOG_TRANSACTION,
+    MAX_LEN,
+    SNAPSHOT_MODE,
+    WATERMARK_TABLE
+)
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +78,35 @@ class MySQLReader(DBReader):
         UpdateRowsEvent,
         RotateEvent,
         GtidEvent,
+        QueryEvent,
+    )
+    # 事务模式下还需要事务结束的 event
+    transaction_events = (
+        XidEvent,
+    )
+    # 可以按范围切分的主键类型
+    chunk_types = (
+        'tinyint',
+        'smallint',
+        'mediumint',
+        'int',
+        'bigint',
+    )
+    # 快照方式
+    LOCK = 'lock'
+    WATERMARK = 'watermark'
+    # 持有连接的属性，传给解析 binlog 的子进程时不序列化
+    connections = (
+        'conn',
+        'stream',
+        'decoder',
+        'monitor',
+        'throttle',
+        'multiplexer',
+        'subscription',
+        '_cache_resume_token',
+        '_cache_timestamps',
+        '_cache_progress',
     )
 
     @staticmethod
@@ -52,7 +117,17 @@ class MySQLReader(DBReader):
 
     def __init__(self, tables, client_id='default', *, host, port, user, password,
                  charset, database=None, autocommit=True, db=None,
-                 cursorclass=SSDictCursor, is_bootstrap=True, is_resume=True):
+                 cursorclass=SSDictCursor, is_bootstrap=True, is_resume=True,
+                 bootstrap_workers=BOOTSTRAP_WORKERS,
+                 bootstrap_tables=BOOTSTRAP_TABLES,
+                 chunk_size=BOOTSTRAP_CHUNK_SIZE,
+                 target_lag=BOOTSTRAP_TARGET_LAG,
+                 snapshot_mode=SNAPSHOT_MODE,
+                 watermark_table=WATERMARK_TABLE,
+                 columns=None, filters=None, binlog_batch=BINLOG_BATCH,
+                 binlog_pipeline=BINLOG_PIPELINE,
+                 binlog_transaction=BINLOG_TRANSACTION,
+                 binlog_shared=BINLOG_SHARED, message_keys=None):
         """从 MySQL 读取数据
         :param tables: list, 要读取的库表
         :param client_id: str, 用于区分不同的客户端
@@ -67,13 +142,32 @@ class MySQLReader(DBReader):
         :param cursorclass: 连接数据库用的 cursor 类型
         :param is_bootstrap: 是否全量查询
         :param is_resume: 是否断点续传
+        :param bootstrap_workers: 全量读取时并行的快照连接数，大于 1 时按主键分片读取
+        :param bootstrap_tables: 全量读取时同时读取的最大表数
+        :param chunk_size: 全量读取时每个主键分片的行数，lock 方式按估算的行数换算成主键跨度
+        :param target_lag: 全量读取时允许的最大复制延迟（秒），0 表示不限速
+        :param snapshot_mode: 快照方式, lock 使用全局读锁, watermark 使用水位线无锁读取
+        :param watermark_table: watermark 方式下写入水位线的表, 格式 schema.table
+        :param columns: dict, 每张表需要读取的列 {schema.table: [column, ...]}，
+            主键总会被读取，未配置的表读取所有列
+        :param filters: dict, 每张表全量读取的过滤条件 {schema.table: 'SQL 条件'}，
+            只作用于全量读取
+        :param binlog_batch: 是否把 binlog 中一个 rows event 作为一条批量数据输出
+        :param binlog_pipeline: 是否在子进程中读取并解析 binlog
+        :param binlog_transaction: 是否按事务输出 binlog，一个事务内每个 topic 只有一个提交标记
+        :param binlog_shared: 是否与同一进程中读取同一个实例的其他 reader 共用一个 binlog 连接
+        :param message_keys: dict, 每张表作为消息 key 的列 {schema.table: [column, ...]}，
+            未配置的表使用主键
         """
         cache_key = f'mysql:{client_id}'
         super().__init__(tables, cache_key, is_bootstrap, is_resume)
-        self.conn = MySQLConnector(host=host, port=port, user=user,
-                                   password=password, charset=charset,
-                                   database=database, autocommit=autocommit,
-                                   db=db, cursorclass=cursorclass)
+        self.conn_settings = dict(host=host, port=port, user=user,
+                                  password=password, charset=charset,
+                                  database=database, autocommit=autocommit,
+                                  db=db, cursorclass=cursorclass)
+        self.conn = MySQLConnector(**self.conn_settings)
+        # 表结构缓存，binlog 解析与全量读取共用
+        self.registry = SchemaRegistry(self.conn_settings)
         self.mysql_settings = {
             'host': host,
             'port': port,
@@ -81,6 +175,44 @@ class MySQLReader(DBReader):
             'password': password,
         }
         self.client_id = client_id
+        self.bootstrap_workers = bootstrap_workers
+        self.bootstrap_tables = bootstrap_tables
+        self.chunk_size = chunk_size
+        self.target_lag = target_lag
+        # 全量读取的限速器，以及采样复制延迟的连接
+        self.throttle = None
+        self.monitor = None
+        self.snapshot_mode = snapshot_mode
+        self.watermark_table = watermark_table
+        self.filters = filters or {}
+        self.message_keys = message_keys or {}
+        self.binlog_batch = binlog_batch
+        self.binlog_pipeline = binlog_pipeline
+        # 流水线模式下解析 binlog 的子进程
+        self.decoder = None
+        self.binlog_transaction = binlog_transaction
+        if binlog_transaction:
+            self.only_events = self.only_events + self.transaction_events
+        self.binlog_shared = binlog_shared
+        # 共用 binlog 连接时的订阅
+        self.multiplexer = None
+        self.subscription = None
+        # 事务模式下当前事务的数据、GTID 以及事务结束后才更新的时间戳
+        self.txn = None
+        self.txn_gtid = None
+        self.txn_ts = {}
+        # 事务模式下已经输出的数据条数，过大的事务分多次输出时 offset 连续
+        self.txn_offset = 0
+        # 每张表需要读取的列，包含主键
+        self.projections = {key: self.get_projection(key, cols)
+                            for key, cols in (columns or {}).items()}
+        # 并行模式下用于读取的快照连接
+        self.snapshots = []
+        # watermark 方式下尚未读取完成的表，及每张表的读取状态
+        self.watermark_tables = deque()
+        self.snapshotting = {}
+        # watermark 方式下正在读取的分片
+        self.chunk = None
         self.db_names = set()
         self.table_names = set()
         if isinstance(tables, (list, tuple, set)):
@@ -88,6 +220,13 @@ class MySQLReader(DBReader):
                 db_name, table_name = key.split('.')
                 self.db_names.add(db_name)
                 self.table_names.add(table_name)
+        if self.snapshot_mode == self.WATERMARK:
+            # 水位线写在 binlog 中，需要一起读取
+            db_name, table_name = watermark_table.split('.')
+            self.db_names.add(db_name)
+            self.table_names.add(table_name)
+        # 一次查询预加载所有库的表结构
+        self.registry.preload(self.db_names)
 
         self.stream = None
         self.server_id = int(time.time())
@@ -100,12 +239,27 @@ class MySQLReader(DBReader):
             self.server_id = self.resume_token.get('server_id') or self.server_id
             self.set_auto_position(self.resume_token.get('auto_position') or self.auto_position)
 
+    def __getstate__(self):
+        """子进程只使用解析 binlog 所需的状态，连接在子进程中重新建立"""
+        state = dict(self.__dict__)
+        state.update(dict.fromkeys(self.connections), snapshots=[])
+        return state
+
     def set_auto_position(self, auto_position):
         self.auto_position = auto_position
         self.gtid_set = GtidSet(auto_position)
 
     def bootstrap(self):
-        """读取历史数据"""
+        """读取历史数据
+        lock 方式下多张表在同一个快照上并发读取，小表优先完成，但是增量同步要等所有表读取完成后才开始；
+        watermark 方式下分片穿插在增量同步中读取，最多 bootstrap_tables 张表轮流读取分片，
+        每张表读取完成后即进入增量同步，需要小表尽快进入增量同步时使用 watermark 方式
+        """
+        if self.snapshot_mode == self.WATERMARK:
+            # 无锁快照，这里只记录位置，分片在增量同步时穿插读取
+            self.prepare_watermark()
+            return
+
         tx_isolation = self.conn.get_tx_isolation()
         try:
             # 打开全局读锁
@@ -114,17 +268,34 @@ class MySQLReader(DBReader):
             self.conn.set_tx_isolation('REPEATABLE-READ')
             # 开启事务的一致性快照, 仅支持 innodb
             self.conn.start_transaction(with_snapshot=True)
+            # 并行模式下，其他快照连接也要在全局读锁内开启，保证读取的是同一个快照
+            if self.bootstrap_workers > 1 or self.bootstrap_tables > 1:
+                workers = max(self.bootstrap_workers, self.bootstrap_tables)
+                self.snapshots = [self.open_snapshot() for _ in range(workers)]
             # 记录全局事务 ID
             auto_position = self.conn.get_global_gtid_executed()
         finally:
             self.conn.unlock_tables()
 
+        # 上次中断的全量读取，增量同步要从中断前的快照位置开始
+        progress = {k: v for k, v in self.progress.items() if k in self.new_tables}
+        if progress:
+            logger.info(f'MySQL resume bootstrap progress={progress}')
+            auto_position = next(iter(progress.values())).get('position') or auto_position
+
         logger.info(auto_position)
         self.set_auto_position(auto_position)
 
-        for key in self.new_tables:
-            schema, table = key.split('.')
-            yield from self._bootstrap(schema, table)
+        # 小表优先，尽快进入增量同步
+        keys = self.order_tables(self.new_tables)
+        try:
+            yield from self._bootstrap(keys, progress)
+        except Exception:
+            # 全量读取失败时不进入增量同步，重启后从已提交的分片继续
+            self.close_snapshots()
+            self.conn.rollback()
+            self.conn.set_tx_isolation(tx_isolation)
+            raise
 
         # 判断是否对齐：第一次属于对齐，其他都是非对齐
         self.has_aligned = not bool(self._rt)
@@ -138,46 +309,412 @@ class MySQLReader(DBReader):
 
         # 关闭事务
         self.conn.commit()
+        self.close_snapshots()
         # 还原事务隔离级别
         self.conn.set_tx_isolation(tx_isolation)
-        self.commit()
 
-    def _bootstrap(self, db_name, table_name):
-        """读取历史数据"""
+    def prepare_watermark(self):
+        """watermark 方式：不加锁记录当前位置，并为每张表初始化读取状态"""
+        auto_position = self.conn.get_global_gtid_executed()
+
+        # 上次中断的全量读取，增量同步要从中断前的位置开始
+        progress = {k: v for k, v in self.progress.items() if k in self.new_tables}
+        if progress:
+            logger.info(f'MySQL resume watermark progress={progress}')
+            auto_position = next(iter(progress.values())).get('position') or auto_position
+
+        logger.info(auto_position)
+        self.set_auto_position(auto_position)
+
+        # 小表优先
+        for key in self.order_tables(self.new_tables):
+            bp = progress.get(key) or {}
+            if bp.get('complete'):
+                self._ts[key] = bp['ts']
+                continue
+
+            db_name, table_name = key.split('.')
+            pks = self.conn.get_primary_keys(db_name, table_name)
+            pk = (pks[0] if len(pks) == 1 else tuple(pks)) if pks else None
+            high = bp.get('pk')
+            if pk is None:
+                logger.warning(f'MySQL {key} has no primary key, read as one chunk, '
+                               f'rows changed during the snapshot may be duplicated')
+            elif isinstance(pk, tuple) and high is not None:
+                # 联合主键的进度保存后是列表
+                high = tuple(high)
+            self.snapshotting[key] = {
+                # 有主键时按主键 keyset 分页读取，没有主键时整表作为一个分片
+                'pk': pk,
+                # 已经输出的分片上界
+                'high': high,
+                'ts': bp.get('ts') or Timestamp(datetime.utcnow(), 0),
+                'started': False,
+            }
+            self.watermark_tables.append(key)
+
+        if self.watermark_tables:
+            self.throttle = self.open_throttle()
+        # 新表的增量数据由分片范围过滤，不再需要对齐
+        self.has_aligned = True
+        self._rt = self._rt or {
+            'server_id': self.server_id,
+            'resume_stream': int(False),
+            'auto_position': self.auto_position,
+        }
+        logger.info(f'MySQL resume_token={self._rt}')
+
+    def next_chunk(self):
+        """watermark 方式：写入低水位线，读取下一个分片，再写入高水位线"""
+        if not self.watermark_tables:
+            return
+
+        key = self.watermark_tables[0]
+        state = self.snapshotting[key]
+        db_name, table_name = key.split('.')
+        if not state['started']:
+            state['started'] = True
+            yield dict(type='bootstrap-start', database=db_name,
+                       table=table_name, topic=f'{db_name}-{table_name}',
+                       ts=state['ts'].time, data={})
+
+        pk = state['pk']
+        chunk = WatermarkChunk(key, pk, state['high'])
+        self.conn.write_watermark(self.watermark_table, self.server_id, chunk.low)
+
+        start = time.time()
+        if pk is not None:
+            # keyset 分页，任何可比较的主键都只读取一个分片的数据
+            cols = pk if isinstance(pk, tuple) else (pk, )
+            fields = ', '.join(f'`{col}`' for col in cols)
+            args = [self.chunk_size]
+            if chunk.lower is not None:
+                marks = ', '.join(['%s'] * len(cols))
+                sql = self.build_select(key, f'({fields}) > ({marks})')
+                args[:0] = chunk.lower if isinstance(pk, tuple) else [chunk.lower]
+            else:
+                sql = self.build_select(key)
+            sql += f' order by {fields} limit %s'
+            chunk.fill(list(self.conn.read(sql, args)), self.chunk_size)
+        else:
+            chunk.fill(list(self.conn.read(self.build_select(key))))
+        latency = time.time() - start
+
+        self.conn.write_watermark(self.watermark_table, self.server_id, chunk.high)
+        self.chunk = chunk
+        if self.throttle is not None:
+            self.throttle.acquire(len(chunk.rows), latency)
+        logger.info(f'MySQL {chunk} read {len(chunk.rows)} rows')
+
+    def parse_watermark(self, binlog_event):
+        """watermark 方式：处理水位线事件"""
+        chunk = self.chunk
+        if chunk is None:
+            return
+
+        for row in binlog_event.rows:
+            values = row.get('after_values') or row.get('values') or {}
+            if values.get('id') != self.server_id:
+                continue
+            value = b2s(values.get('value'))
+            if value == chunk.low:
+                chunk.opened = True
+            elif value == chunk.high:
+                yield from self.finish_chunk()
+                return
+
+    def finish_chunk(self):
+        """watermark 方式：读到高水位线，输出分片中剩余的数据，开始下一个分片"""
+        chunk, self.chunk = self.chunk, None
+        key = chunk.key
+        state = self.snapshotting[key]
+        db_name, table_name = key.split('.')
+        ts = state['ts']
+
+        envelope = dict(type='bootstrap-insert', database=db_name,
+                        table=table_name, topic=f'{db_name}-{table_name}',
+                        ts=ts.time)
+        if self.batch_mode:
+            if chunk.rows:
+                yield RowBatch(envelope, list(chunk.rows.values()))
+        else:
+            for msg in chunk.rows.values():
+                yield dict(envelope, data=msg)
+
+        if chunk.last:
+            del self.snapshotting[key]
+            self.watermark_tables.popleft()
+            yield from self._bootstrap_complete(key, ts)
+            if not self.watermark_tables:
+                self.close_monitor()
+        else:
+            state['high'] = chunk.upper
+            # 前 bootstrap_tables 张表轮流读取分片，大表不会挡住之后的小表
+            self.watermark_tables.popleft()
+            active = min(self.bootstrap_tables, len(self.watermark_tables) + 1)
+            self.watermark_tables.insert(active - 1, key)
+            if self.is_resume:
+                yield self.checkpoint(key, ts, pk=chunk.upper)
+
+        yield from self.next_chunk()
+
+    def accept_row(self, key, values):
+        """watermark 方式：表尚未读取完成时，判断增量数据是否需要输出
+        已经输出的分片范围内的数据直接输出；
+        当前分片两条水位线之间的数据输出，并从分片中剔除；
+        尚未读取的范围不输出，之后由分片读取最新的数据
+        """
+        state = self.snapshotting[key]
+        chunk = self.chunk if self.chunk and self.chunk.key == key else None
+        if state['pk'] is None:
+            return bool(chunk and chunk.opened)
+
+        # 字符串主键在 Python 中按二进制比较，非二进制排序规则的主键范围可能与 MySQL 不一致
+        value = pk_value(state['pk'], values)
+        if state['high'] is not None and value <= state['high']:
+            return True
+        if chunk and chunk.opened and chunk.covers(value):
+            chunk.discard(value)
+            return True
+        return False
+
+    def open_throttle(self):
+        """开启限速时，使用单独的连接采样复制延迟"""
+        if not self.target_lag:
+            return None
+        self.monitor = MySQLConnector(**self.conn_settings)
+        return AdaptiveThrottle(self.monitor.get_replica_lag, self.target_lag)
+
+    def close_monitor(self):
+        """关闭采样复制延迟的连接"""
+        if self.monitor:
+            self.monitor.close()
+        self.monitor = None
+        self.throttle = None
+
+    def open_snapshot(self):
+        """开启一条一致性快照连接，需要在全局读锁内调用"""
+        conn = MySQLConnector(**self.conn_settings)
+        conn.set_tx_isolation('REPEATABLE-READ')
+        conn.start_transaction(with_snapshot=True)
+        return conn
+
+    def close_snapshots(self):
+        """关闭并行模式下的快照连接"""
+        for conn in self.snapshots:
+            try:
+                conn.commit()
+            except Exception as e:
+                logger.error(f'MySQL snapshot commit error: {e}')
+            conn.close()
+        self.snapshots = []
+
+    def order_tables(self, keys):
+        """按 information_schema 估算的大小从小到大排序"""
+        sizes = self.conn.get_tables_size(keys)
+        return sorted(keys, key=lambda k: sizes.get(k, 0))
+
+    def _bootstrap(self, keys, progress):
+        """读取历史数据，多张表、多个主键分片在快照连接上并行读取
+        :param keys: 要读取的表，按开始读取的先后排序
+        :param progress: 上次中断时每张表的读取进度
+        """
         # 采样计数器
         counter = 1
-        # 记录时间
-        ts = Timestamp(datetime.utcnow(), 0)
-        # 发送开始数据
-        yield dict(type='bootstrap-start', database=db_name, table=table_name,
-                   topic=f'{db_name}-{table_name}', ts=ts.time, data={})
+        # 每张表开始读取的时间
+        timestamps = {}
+        # 每张表的分片完成情况
+        chunks = {}
+        # 每张表读取的列与类型，数据按元组读取，列名只保存一份
+        schemas = {}
 
-        # 防止影响数据库缓存，禁止缓存查询结果
-        sql = f'select sql_no_cache * from {db_name}.{table_name}'
+        plans = []
+        for key in keys:
+            bp = progress.get(key) or {}
+            if bp.get('complete'):
+                # 上次已经读取完成，只是没来得及记录时间
+                self._ts[key] = bp['ts']
+                continue
+            schemas[key] = self.get_schema(key)
+            tasks = self.plan_tasks(key, bp.get('pk'), list(schemas[key]))
+            chunks[key] = ChunkProgress([task.position for task in tasks])
+            plans.append((key, tasks))
+
+        # 非并行模式下直接使用当前的快照连接
+        contexts = self.snapshots or [self.conn]
+        self.throttle = self.open_throttle()
+        scanner = ParallelScanner(contexts, throttle=self.throttle)
+        scheduler = BootstrapScheduler(scanner, self.bootstrap_tables)
 
         try:
-            # 读取数据
-            for msg in self.conn.read(sql, buffered=False):
-                data = dict(type='bootstrap-insert', database=db_name,
-                            table=table_name, topic=f'{db_name}-{table_name}',
-                            ts=ts.time, data=msg)
-                yield data
-                # 添加采样数据到日志
-                counter += 1
-                if counter % 50_000 == 0:
-                    logger.info(f"MySQL counter = {counter}, data={data}")
-        except Exception:
-            logger.error(f'MySQL error in {db_name}.{table_name}')
+            for status, key, value in scheduler.run(plans):
+                db_name, table_name = key.split('.')
+                topic = f'{db_name}-{table_name}'
+                if status == scheduler.START:
+                    bp = progress.get(key) or {}
+                    ts = timestamps[key] = bp.get('ts') or Timestamp(datetime.utcnow(), 0)
+                    # 发送开始数据
+                    yield dict(type='bootstrap-start', database=db_name,
+                               table=table_name, topic=topic, ts=ts.time, data={})
+                elif status == scheduler.ROWS:
+                    ts = timestamps[key]
+                    columns = list(schemas[key])
+                    if self.batch_mode:
+                        # 整批共用一个信封，数据保持元组，写入时才转为字典
+                        yield RowBatch(dict(type='bootstrap-insert', database=db_name,
+                                            table=table_name, topic=topic,
+                                            ts=ts.time), value,
+                                       columns=columns, types=list(schemas[key].values()))
+                        counter += len(value)
+                        continue
+                    for msg in value:
+                        data = dict(type='bootstrap-insert', database=db_name,
+                                    table=table_name, topic=topic,
+                                    ts=ts.time, data=dict(zip(columns, msg)))
+                        yield data
+                        # 添加采样数据到日志
+                        counter += 1
+                        if counter % 50_000 == 0:
+                            logger.info(f"MySQL counter = {counter}, data={data}")
+                elif status == scheduler.DONE:
+                    pk = chunks[key].finish(value.position)
+                    if pk is not None and self.is_resume:
+                        # 之前的分片都已读取，提交后记录进度
+                        yield self.checkpoint(key, timestamps[key], pk=pk)
+                else:
+                    yield from self._bootstrap_complete(key, timestamps.pop(key))
+        except Exception as e:
+            # 只有读取完成的表才发送结束数据，未完成的表保留已提交的分片进度，由调用方处理异常
+            logger.error(f'MySQL bootstrap error in {list(timestamps)}: {e}')
+            raise
         finally:
-            # 发送结束数据
-            yield dict(type='bootstrap-complete', database=db_name,
-                       table=table_name,
-                       topic=f'{db_name}-{table_name}', ts=ts.time, data={})
-            # 记录时间
-            self._ts.update({
-                f'{db_name}.{table_name}': ts
-            })
-            logger.info(f'MySQL timestamp={self._ts}')
+            # 扫描线程可能还在快照连接上读取，退出之后调用方才能提交与关闭快照连接
+            scanner.stop()
+            self.close_monitor()
+
+    def _bootstrap_complete(self, key, ts):
+        """发送结束数据并记录时间"""
+        db_name, table_name = key.split('.')
+        yield dict(type='bootstrap-complete', database=db_name,
+                   table=table_name,
+                   topic=f'{db_name}-{table_name}', ts=ts.time, data={})
+        # 记录时间
+        self._ts.update({
+            key: ts
+        })
+        logger.info(f'MySQL timestamp={self._ts}')
+        if self.is_resume:
+            yield self.checkpoint(key, ts, complete=True)
+
+    def checkpoint(self, key, ts, **kwargs):
+        """生成全量读取的断点，随 CommitPoint 在数据写入之后保存"""
+        bp = dict(position=self.auto_position, ts=ts, **kwargs)
+        return CommitPoint({key: bp})
+
+    def plan_tasks(self, key, start=None, columns=None):
+        """按主键把表切分为多个范围，仅支持单列整数主键，不能切分的表整表读取
+        :param key: 要读取的表
+        :param start: 上次中断时已经读取完成的主键
+        :param columns: 要读取的列，决定元组中各列的顺序
+        :return: [ScanTask, ...]
+        """
+        db_name, table_name = key.split('.')
+        full_scan = [ScanTask(key, self.read_chunk, key, columns)]
+
+        pks = self.conn.get_primary_keys(db_name, table_name)
+        if len(pks) != 1:
+            return full_scan
+
+        pk = pks[0]
+        columns_type = self.registry.get_columns_type(db_name, table_name)
+        if columns_type.get(pk) not in self.chunk_types:
+            return full_scan
+
+        min_value, max_value = self.conn.get_column_range(db_name, table_name, pk)
+        if min_value is None or max_value is None:
+            return full_scan
+
+        # 主键可能不连续，按估算的行数计算分片跨度，使每个分片约 chunk_size 行
+        rows = self.conn.get_table_rows(db_name, table_name)
+        count = max(-(-rows // self.chunk_size), 1)
+        span = max(-(-(max_value - min_value + 1) // count), 1)
+
+        if start is not None:
+            min_value = max(min_value, start + 1)
+
+        chunks = split_range(min_value, max_value, span)
+        logger.info(f'MySQL {key} split into {len(chunks)} chunks')
+        return [ScanTask(key, self.read_chunk, key, columns, pk, lower, upper,
+                         position=upper)
+                for lower, upper in chunks]
+
+    def read_chunk(self, conn, key, columns=None, pk=None, lower=None, upper=None):
+        """在快照连接上读取一个主键分片，不指定主键时读取整张表
+        数据使用元组游标读取，列的顺序与 columns 一致
+        """
+        if pk is None:
+            yield from conn.read_tuples(self.build_select(key, columns=columns))
+        else:
+            sql = self.build_select(key, f'`{pk}` between %s and %s', columns=columns)
+            yield from conn.read_tuples(sql, (lower, upper))
+
+    def build_select(self, key, *conditions, columns=None):
+        """构造全量读取的查询语句，下推列裁剪与过滤条件
+        :param key: 要读取的表
+        :param conditions: 其他查询条件，例如主键范围
+        :param columns: 要读取的列，默认使用配置的列
+        """
+        db_name, table_name = key.split('.')
+        columns = columns or self.projections.get(key)
+        fields = ', '.join(f'`{col}`' for col in columns) if columns else '*'
+        conditions = list(conditions)
+        if self.filters.get(key):
+            conditions.append(f'({self.filters[key]})')
+
+        # 防止影响数据库缓存，禁止缓存查询结果
+        sql = f'select sql_no_cache {fields} from {db_name}.{table_name}'
+        if conditions:
+            sql += ' where ' + ' and '.join(conditions)
+        return sql
+
+    def message_key(self, event):
+        """按主键或者配置的列生成消息的 key，同一行的变化写入同一个分区
+        一个 rows event 的批量数据包含多行，返回每一行的 key，与全量读取及逐行输出时相同
+        """
+        key = f"{event.get('database')}.{event.get('table')}"
+        rows = event.get('rows')
+        if not rows and not event.get('data'):
+            return None
+        columns = self.message_keys.get(key) or self.registry.get_primary_keys(*key.split('.'))
+        if not columns:
+            return None
+        if rows:
+            return [obj2bytes([data.get(col) for col in columns]) for data in rows]
+        return obj2bytes([event['data'].get(col) for col in columns])
+
+    def get_projection(self, key, columns):
+        """需要读取的列，补齐主键，保证增量数据可以更新与删除"""
+        if not columns:
+            return None
+        db_name, table_name = key.split('.')
+        pks = self.conn.get_primary_keys(db_name, table_name)
+        return [pk for pk in pks if pk not in columns] + list(columns)
+
+    def get_schema(self, key):
+        """要读取的列及其数据类型，未配置列时按表中列的顺序排列"""
+        db_name, table_name = key.split('.')
+        columns_type = self.registry.get_columns_type(db_name, table_name)
+        columns = self.projections.get(key)
+        if not columns:
+            return columns_type
+        return {col: columns_type.get(col) for col in columns}
+
+    def project(self, key, values):
+        """增量数据按相同的列裁剪"""
+        columns = self.projections.get(key)
+        if not columns:
+            return dict(values)
+        return {col: values[col] for col in columns if col in values}
 
     @cached_property
     def _log_file(self):
@@ -205,11 +742,64 @@ class MySQLReader(DBReader):
         """
         stream_config = self.build_stream_config()
         logging.info(stream_config)
-        self.stream = BinLogStreamReader(**stream_config)
+        # 无锁快照需要在当前进程中读取分片，快照期间不使用流水线
+        if self.binlog_pipeline and not self.snapshotting:
+            yield from self.watch_pipeline(stream_config)
+            return
+        if self.binlog_shared and not self.snapshotting:
+            yield from self.watch_shared(stream_config)
+            return
+
+        self.stream = self.open_stream(stream_config)
 
+        # watermark 方式下开始读取第一个分片
+        yield from self.next_chunk()
         for binlog_event in self.stream:
             yield from self.parse_binlog(binlog_event)
 
+    def watch_pipeline(self, stream_config):
+        """流水线模式：子进程读取并解析 binlog，当前进程按顺序输出并更新断点"""
+        self.decoder = BinlogDecoder(self, stream_config)
+        self.decoder.start()
+        try:
+            for items in self.decoder:
+                for item, rt, ts in items:
+                    yield item
+                    self._rt.update(rt)
+                    self._ts.update(ts)
+        finally:
+            self.decoder.stop()
+
+    def watch_shared(self, stream_config):
+        """共用模式：订阅同一个实例上共享的 binlog 连接，event 已经按表过滤"""
+        self.multiplexer = BinlogMultiplexer.get(self.mysql_settings, self.conn_settings,
+                                                 self.only_events)
+        position = dict(
+            log_file=stream_config['log_file'],
+            log_pos=stream_config['log_pos'],
+            # 同时提供 GTID，其他订阅者只有 GTID 时，从两者都处理过的事务开始
+            auto_position=self._rt.get('auto_position') or self.auto_position,
+        ) if self.is_resume else {}
+        self.subscription = self.multiplexer.subscribe(self.client_id, self.stream_tables(),
+                                                       position)
+        try:
+            for binlog_event in self.subscription:
+                yield from self.parse_binlog(binlog_event)
+        finally:
+            self.multiplexer.unsubscribe(self.subscription)
+
+    def stream_tables(self):
+        """需要解析的表 {(schema, table), ...}"""
+        tables = {tuple(key.split('.')) for key in self.inc_tables}
+        if self.snapshot_mode == self.WATERMARK:
+            tables.add(tuple(self.watermark_table.split('.')))
+        return tables
+
+    def open_stream(self, stream_config):
+        """创建 binlog stream，表结构从 SchemaRegistry 获取"""
+        return RegistryBinLogStreamReader(registry=self.registry, tables=self.stream_tables(),
+                                          **stream_config)
+
     def build_stream_config(self):
         """构建 stream 的参数"""
         blocking = True
@@ -241,7 +831,7 @@ class MySQLReader(DBReader):
             log_pos=log_pos,
             auto_position=auto_position,
             resume_stream=resume_stream,
-            # 暂不读取 DDL, 效率高
+            # 已知 table_id 不再重复解析，DDL 由 parse_ddl 使缓存失效
             freeze_schema=freeze_schema,
         )
 
@@ -252,6 +842,30 @@ class MySQLReader(DBReader):
             if not self.has_aligned and not Gtid(gtid) in self.gtid_set:
                 self.has_aligned = True
                 logger.info(f'has_aligned gtid: {gtid}')
+            if self.binlog_transaction:
+                self.begin_transaction(gtid)
+            return
+
+        if isinstance(binlog_event, XidEvent):
+            yield from self.end_transaction(binlog_event, binlog_event.xid)
+            return
+
+        if isinstance(binlog_event, QueryEvent):
+            query = binlog_event.query
+            if not self.binlog_transaction:
+                self.parse_ddl(binlog_event)
+            elif query == 'BEGIN':
+                # 没有开启 GTID 时，事务从 BEGIN 开始
+                if self.binlog_transaction and self.txn is None:
+                    self.begin_transaction(None)
+            elif query == 'COMMIT':
+                # 非事务引擎的提交
+                yield from self.end_transaction(binlog_event)
+            else:
+                self.parse_ddl(binlog_event)
+                if DDL_PATTERN.match(query):
+                    # DDL 自成一个事务，GTID 之后没有 XidEvent
+                    yield from self.end_transaction(binlog_event)
             return
 
         if isinstance(binlog_event, RotateEvent):
@@ -271,16 +885,20 @@ class MySQLReader(DBReader):
                 logging.info(f'all_rt: {self._rt}, new_rt:{rt}')
             return
 
-        # 过滤掉不需要的表：最近一次移除的
         key = f'{binlog_event.schema}.{binlog_event.table}'
+        if self.snapshot_mode == self.WATERMARK and key == self.watermark_table:
+            yield from self.parse_watermark(binlog_event)
+            return
+
+        # 过滤掉不需要的表：最近一次移除的
         if key not in self.inc_tables:
             return
         # 过滤掉不需要的表：上次中断的历史数据尚未补齐，新表数据不新增
         if not self.has_aligned and key in self.new_tables:
             return
 
-        # # 过滤掉不需要的数据
-        if self.is_resume:
+        # # 过滤掉不需要的数据，正在无锁快照的表由分片范围过滤
+        if self.is_resume and key not in self.snapshotting:
             cached_ts = self._ts[key]
             ts = binlog_event.timestamp
             # 先判断时间戳是否满足条件
@@ -292,6 +910,13 @@ class MySQLReader(DBReader):
                 #             f'rows={binlog_event.rows}')
                 return
 
+        if self.txn is not None:
+            # 事务模式下先缓存，事务结束时再输出并更新位置
+            self.txn.extend(self.parse_binlog_rows(binlog_event))
+            if len(self.txn) >= MAX_LEN:
+                yield from self.flush_transaction()
+            return
+
         self._rt.update({
             'resume_stream': int(True),
             'log_pos': binlog_event.packet.log_pos,
@@ -299,6 +924,82 @@ class MySQLReader(DBReader):
         logger.info(self._rt)
         yield from self.parse_binlog_rows(binlog_event)
 
+    def advance(self, key, ts, offset):
+        """更新表读取到的时间戳，事务模式下在事务结束时统一更新"""
+        if self.txn is not None:
+            self.txn_ts[key] = Timestamp(ts, 0)
+        else:
+            self._ts[key] = Timestamp(ts, offset)
+
+    def begin_transaction(self, gtid):
+        """事务模式：开始缓存一个事务的数据"""
+        self.txn = []
+        self.txn_gtid = gtid
+        self.txn_ts = {}
+        self.txn_offset = 0
+
+    def flush_transaction(self, xid=None):
+        """事务模式：按顺序输出缓存的数据
+        每个 topic 只在该事务内的最后一条数据上标记 commit，其余数据标记事务内的 offset
+        :param xid: 事务 ID，为 None 时表示事务过大，只输出已经缓存的部分，不标记 commit
+        """
+        events, self.txn = self.txn, []
+        last = {}
+        if xid is not None:
+            last = {event['topic']: i for i, event in enumerate(events)}
+
+        for i, event in enumerate(events):
+            event.pop('commit', None)
+            event['offset'] = self.txn_offset + i + 1
+            event['gtid'] = self.txn_gtid
+            if xid is not None:
+                event['xid'] = xid
+                if last[event['topic']] == i:
+                    event['commit'] = True
+            yield event
+        self.txn_offset += len(events)
+
+    def end_transaction(self, binlog_event, xid=None):
+        """事务模式：事务结束，输出事务内的数据，更新位置与时间戳"""
+        if self.txn is None:
+            return
+
+        yield from self.flush_transaction(xid or 0)
+        self._rt.update({
+            'resume_stream': int(True),
+            'log_pos': binlog_event.packet.log_pos,
+        })
+        self._ts.update(self.txn_ts)
+        self.txn = None
+        self.txn_gtid = None
+        self.txn_ts = {}
+
+    def parse_ddl(self, binlog_event):
+        """表结构变化时，使表结构缓存与 table_map 中的表失效
+        共用模式下 table_map 属于共享的 stream，由 BinlogMultiplexer 处理
+        """
+        query = binlog_event.query
+        if not DDL_PATTERN.match(query):
+            return
+
+        schema = b2s(binlog_event.schema)
+        tables = parse_ddl_tables(query, schema)
+        if tables is None:
+            # 无法解析具体的表，例如 drop database，整个库失效
+            if schema in self.db_names:
+                self.registry.invalidate(schema)
+                if self.stream is not None:
+                    self.stream.forget_tables(schema)
+            return
+
+        for db_name, table_name in tables:
+            if db_name not in self.db_names:
+                continue
+            logger.info(f'MySQL DDL on {db_name}.{table_name}: {query}')
+            self.registry.invalidate(db_name, table_name)
+            if self.stream is not None:
+                self.stream.forget_tables(db_name, table_name)
+
     def parse_binlog_rows(self, binlog_event):
         """按 row 解析 binlog"""
         database = binlog_event.schema
@@ -307,12 +1008,21 @@ class MySQLReader(DBReader):
         topic = f'{database}-{table}'
 
         ts = binlog_event.timestamp
-        last_row = len(binlog_event.rows)
+        rows = binlog_event.rows
+        snapshotting = key in self.snapshotting
+        if snapshotting:
+            rows = [row for row in rows
+                    if self.accept_row(key, row.get('after_values') or row['values'])]
+        last_row = len(rows)
+
+        if self.binlog_batch:
+            yield from self.parse_binlog_batch(binlog_event, rows, snapshotting)
+            return
 
-        for i, row in enumerate(binlog_event.rows):
+        for i, row in enumerate(rows):
             offset = i + 1
             # 判断偏移量是否满足
-            if self.is_resume and offset < self._ts[key].inc:
+            if self.is_resume and not snapshotting and offset < self._ts[key].inc:
                 logger.info(f'Expired msg, table={key},event timestamp={ts},'
                             f'offset={offset},cached timestamp={self._ts[key]}')
                 continue
@@ -327,19 +1037,63 @@ class MySQLReader(DBReader):
 
             if isinstance(binlog_event, DeleteRowsEvent):
                 event['type'] = 'delete'
-                event['data'] = dict(row['values'])
+                event['data'] = self.project(key, row['values'])
             elif isinstance(binlog_event, UpdateRowsEvent):
                 event['type'] = 'update'
-                event['old'] = dict(row['before_values'])
-                event['data'] = dict(row['after_values'])
+                event['old'] = self.project(key, row['before_values'])
+                event['data'] = self.project(key, row['after_values'])
             elif isinstance(binlog_event, WriteRowsEvent):
                 event['type'] = 'insert'
-                event['data'] = dict(row['values'])
+                event['data'] = self.project(key, row['values'])
 
             yield event
-            self._ts[key] = Timestamp(ts, offset)
+            if not snapshotting:
+                self.advance(key, ts, offset)
+
+    def parse_binlog_batch(self, binlog_event, rows, snapshotting=False):
+        """一个 rows event 作为一条批量数据输出，整批提交
+        数据放在 rows 中，update 的旧数据按相同顺序放在 olds 中
+        """
+        database = binlog_event.schema
+        table = binlog_event.table
+        key = f'{database}.{table}'
+        ts = binlog_event.timestamp
+
+        # 上次在这个 event 中间中断，跳过已经输出的行
+        if self.is_resume and not snapshotting:
+            cached_ts = self._ts[key]
+            if cached_ts.time == ts and cached_ts.inc:
+                logger.info(f'Expired msg, table={key},event timestamp={ts},'
+                            f'offset={cached_ts.inc},cached timestamp={cached_ts}')
+                rows = rows[cached_ts.inc - 1:]
+        if not rows:
+            return
+
+        event = dict(database=database, table=table,
+                     topic=f'{database}-{table}', ts=ts, commit=True)
+        if isinstance(binlog_event, DeleteRowsEvent):
+            event['type'] = 'delete'
+            event['rows'] = [self.project(key, row['values']) for row in rows]
+        elif isinstance(binlog_event, UpdateRowsEvent):
+            event['type'] = 'update'
+            event['olds'] = [self.project(key, row['before_values']) for row in rows]
+            event['rows'] = [self.project(key, row['after_values']) for row in rows]
+        elif isinstance(binlog_event, WriteRowsEvent):
+            event['type'] = 'insert'
+            event['rows'] = [self.project(key, row['values']) for row in rows]
+
+        yield event
+        if not snapshotting:
+            self.advance(key, ts, 0)
 
     def disconnect(self, *args, **kwargs):
+        self.close_snapshots()
+        self.close_monitor()
+        self.registry.close()
+        if self.decoder:
+            self.decoder.stop()
+        if self.subscription:
+            self.multiplexer.unsubscribe(self.subscription)
         if self.stream:
             self.stream.close()
             logger.info('MySQL stream closed')
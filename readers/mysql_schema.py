@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: mysql_schema
+@date: 2019-09-16
+@note: 带版本的表结构缓存，binlog 解析与全量读取共用，DDL 后失效重新加载
+"""
+import os
+import re
+import logging
+from threading import RLock
+
+from pymysql.cursors import DictCursor
+from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.row_event import TableMapEvent
+
+from connectors.mysql_connector import MySQLConnector
+
+logger = logging.getLogger(__name__)
+
+# 语句开头的注释，例如 gh-ost、pt-online-schema-change 等工具添加的 /* ... */
+LEADING_COMMENTS = r'^(?:\s+|/\*(?!!).*?\*/|(?:--|#)[^\n]*(?:\n|$))*'
+# 会修改表结构的语句
+DDL_PATTERN = re.compile(rf'{LEADING_COMMENTS}(alter|create|drop|rename|truncate)\s', re.I | re.S)
+# 标识符
+IDENT = r'(?:`[^`]+`|[\w$]+)'
+# 表名，格式 [schema.]table
+NAME = rf'{IDENT}(?:\s*\.\s*{IDENT})?'
+# 逗号分隔的多个表名
+NAME_LIST = rf'{NAME}(?:\s*,\s*{NAME})*'
+# 语句中涉及的表
+TABLE_PATTERN = re.compile(rf'\btable\s+(?:if\s+(?:not\s+)?exists\s+)?({NAME})', re.I)
+# rename table a to b, c to d
+RENAME_PATTERN = re.compile(rf'({NAME})\s+to\s+({NAME})', re.I)
+# drop [temporary] table [if exists] a, b
+DROP_TABLE_PATTERN = re.compile(
+    rf'^\s*drop\s+(?:temporary\s+)?tables?\s+(?:if\s+exists\s+)?({NAME_LIST})', re.I)
+# truncate [table] a
+TRUNCATE_PATTERN = re.compile(rf'^\s*truncate\s+(?:table\s+)?({NAME})', re.I)
+# create [unique|fulltext|spatial] index i on a, drop index i on a
+INDEX_PATTERN = re.compile(
+    rf'^\s*(?:create|drop)\s+(?:(?:unique|fulltext|spatial)\s+)?index\s+{IDENT}\s+on\s+({NAME})',
+    re.I)
+# alter table a ... rename [to|as] b，不包括 rename column/index/key
+ALTER_RENAME_PATTERN = re.compile(
+    rf'\brename\s+(?!(?:column|index|key)\b)(?:(?:to|as)\s+)?({NAME})', re.I)
+
+
+def strip_comments(query):
+    """去掉语句开头的注释与空白"""
+    return query[re.match(LEADING_COMMENTS, query, re.S).end():]
+
+
+def parse_ddl_tables(query, default_schema):
+    """解析 DDL 涉及的表
+    :param query: str, DDL 语句
+    :param default_schema: str, 执行语句时的默认库
+    :return: [(schema, table), ...], 无法解析时返回 None
+    """
+    query = strip_comments(query)
+    statement = query[:8].lower()
+    if statement.startswith('rename'):
+        names = [name for match in RENAME_PATTERN.finditer(query) for name in match.groups()]
+    elif DROP_TABLE_PATTERN.match(query):
+        names = re.findall(NAME, DROP_TABLE_PATTERN.match(query).group(1))
+    elif statement.startswith('truncate'):
+        names = [match.group(1) for match in TRUNCATE_PATTERN.finditer(query)]
+    elif INDEX_PATTERN.match(query):
+        names = [INDEX_PATTERN.match(query).group(1)]
+    else:
+        names = [match.group(1) for match in TABLE_PATTERN.finditer(query)]
+        if statement.startswith('alter'):
+            # 改名后的表也要失效，可能是之前删除过的同名表
+            names += [match.group(1) for match in ALTER_RENAME_PATTERN.finditer(query)]
+
+    tables = []
+    for name in names:
+        parts = [p.strip().strip('`') for p in name.split('.')]
+        if len(parts) == 1:
+            parts.insert(0, default_schema)
+        if tuple(parts) not in tables:
+            tables.append(tuple(parts))
+    return tables or None
+
+
+class SchemaRegistry:
+    """\
+    表结构缓存，按 (schema, table, version) 保存每张表的列信息
+    启动时一次查询预加载所有库的表结构，DDL 之后版本号加一，下次使用时重新加载
+    列信息的格式与 pymysqlreplication 查询 information_schema 的结果相同
+    """
+    def __init__(self, conn_settings):
+        """
+        :param conn_settings: dict, 连接 MySQL 的参数
+        """
+        self.conn_settings = dict(conn_settings, cursorclass=DictCursor)
+        self.conn = None
+        self.pid = None
+        self.lock = RLock()
+        # {(schema, table): version}
+        self.versions = {}
+        # {(schema, table, version): [column, ...]}
+        self.tables = {}
+        # 不为 None 时记录失效的表，子进程中解析的 DDL 由父进程同步失效
+        self.journal = None
+
+    def __getstate__(self):
+        """传给子进程时不包含连接与锁，子进程中重新连接"""
+        state = dict(self.__dict__)
+        state.update(conn=None, pid=None)
+        state.pop('lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = RLock()
+
+    def connect(self):
+        """fork 出的子进程不能与父进程共用连接"""
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = MySQLConnector(**self.conn_settings)
+            self.pid = os.getpid()
+        return self.conn
+
+    def query(self, conditions, args):
+        """按条件查询 information_schema
+        :param conditions: str, 查询条件，值使用 %s 占位
+        :param args: 条件中的值，由驱动转义
+        """
+        sql = f"""
+             select
+                 table_schema as TABLE_SCHEMA
+                 ,table_name as TABLE_NAME
+                 ,column_name as COLUMN_NAME
+                 ,collation_name as COLLATION_NAME
+                 ,character_set_name as CHARACTER_SET_NAME
+                 ,column_comment as COLUMN_COMMENT
+                 ,column_type as COLUMN_TYPE
+                 ,column_key as COLUMN_KEY
+                 ,data_type as DATA_TYPE
+             from information_schema.columns
+             where {conditions}
+             order by table_schema, table_name, ordinal_position
+         """
+        columns = {}
+        for item in self.connect().read(sql, args):
+            key = (item.pop('TABLE_SCHEMA'), item.pop('TABLE_NAME'))
+            columns.setdefault(key, []).append(item)
+        return columns
+
+    def preload(self, schemas):
+        """一次查询加载多个库的表结构"""
+        if not schemas:
+            return
+        schemas = list(schemas)
+        placeholders = ', '.join(['%s'] * len(schemas))
+        columns = self.query(f'table_schema in ({placeholders})', schemas)
+        with self.lock:
+            for key, cols in columns.items():
+                version = self.versions.setdefault(key, 0)
+                self.tables[key + (version, )] = cols
+        logger.info(f'Schema registry preload {len(columns)} tables')
+
+    def get_table_information(self, schema, table):
+        """获取表的列信息，缓存中没有时从 information_schema 加载"""
+        with self.lock:
+            version = self.versions.setdefault((schema, table), 0)
+            key = (schema, table, version)
+            if key not in self.tables:
+                columns = self.query('table_schema=%s and table_name=%s', (schema, table))
+                self.tables[key] = columns.get((schema, table)) or []
+            return self.tables[key]
+
+    def get_columns_type(self, schema, table):
+        """与 MySQLConnector.get_columns_type 相同，按列的顺序返回 {列名: 数据类型}"""
+        return {col['COLUMN_NAME']: col['DATA_TYPE']
+                for col in self.get_table_information(schema, table)}
+
+    def get_primary_keys(self, schema, table):
+        """按列的顺序返回主键列"""
+        return [col['COLUMN_NAME'] for col in self.get_table_information(schema, table)
+                if col.get('COLUMN_KEY') == 'PRI']
+
+    def invalidate(self, schema, table=None):
+        """表结构变化后使缓存失效，不指定表时整个库失效"""
+        with self.lock:
+            keys = [k for k in self.versions
+                    if k[0] == schema and (table is None or k[1] == table)]
+            if table is not None and (schema, table) not in self.versions:
+                keys.append((schema, table))
+            for key in keys:
+                version = self.versions.get(key, 0)
+                self.tables.pop(key + (version, ), None)
+                self.versions[key] = version + 1
+            if self.journal is not None:
+                self.journal.append((schema, table))
+        logger.info(f'Schema registry invalidate {schema}.{table or "*"}')
+
+    def close(self):
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+
+
+class RegistryBinLogStreamReader(BinLogStreamReader):
+    """\
+    表结构从 SchemaRegistry 获取的 BinLogStreamReader
+    only_schemas 与 only_tables 是分别过滤的，a.x 与 b.y 会放行 a.y 与 b.x，
+    这里在 TableMapEvent 上按 (schema, table) 精确过滤：不需要的表不读取列信息，
+    也不进入 table_map，之后的 rows event 找不到 table_id，不会解析行数据
+    """
+    def __init__(self, *args, registry=None, tables=None, **kwargs):
+        """
+        :param registry: SchemaRegistry 实例
+        :param tables: set, 需要解析的表 {(schema, table), ...}，None 表示不过滤
+        """
+        only_events = kwargs.get('only_events')
+        # 调用方是否需要 TableMapEvent
+        self.emit_table_map = only_events is None or TableMapEvent in only_events
+        if tables is not None and not self.emit_table_map:
+            kwargs['only_events'] = list(only_events) + [TableMapEvent]
+        super().__init__(*args, **kwargs)
+        self.registry = registry
+        self.tables = tables
+
+    def _BinLogStreamReader__get_table_information(self, schema, table):
+        # 覆盖父类的私有方法，避免每个新的 table_id 都查询 information_schema
+        if self.tables is not None and (schema, table) not in self.tables:
+            return []
+        return self.registry.get_table_information(schema, table)
+
+    def fetchone(self):
+        while True:
+            binlog_event = super().fetchone()
+            if isinstance(binlog_event, TableMapEvent):
+                key = (binlog_event.schema, binlog_event.table)
+                if self.tables is not None and key not in self.tables:
+                    # 不需要的表移出 table_map，对应的 rows event 直接跳过
+                    self.table_map.pop(binlog_event.table_id, None)
+                if not self.emit_table_map:
+                    continue
+            return binlog_event
+
+    def forget_tables(self, schema, table=None):
+        """表结构变化后，移除 table_map 中缓存的表，下一个 TableMapEvent 会重新解析"""
+        for table_id, obj in list(self.table_map.items()):
+            if obj.schema == schema and (table is None or obj.table == table):
+                self.table_map.pop(table_id, None)
+
+
+if __name__ == '__main__':
+    print(parse_ddl_tables('alter table `a`.`b` add column c int', 'x'))
+    print(parse_ddl_tables('rename table a to b, c.d to e.f', 'x'))
+    print(parse_ddl_tables('create table if not exists t (id int)', 'x'))
+    print(parse_ddl_tables('drop table if exists x.y, x.z', 'x'))
+    print(parse_ddl_tables('alter table db.t rename to db.t2', 'x'))
+    print(parse_ddl_tables('drop database x', 'x'))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: throttle
+@date: 2019-09-06
+@note: 全量读取的自适应限速，根据复制延迟与查询耗时调整读取速度
+"""
+import time
+import logging
+from threading import Lock
+
+from config.sys_config import (
+    BOOTSTRAP_TARGET_LAG,
+    BOOTSTRAP_TARGET_LATENCY,
+    BOOTSTRAP_INITIAL_RATE,
+    BOOTSTRAP_MIN_RATE,
+    BOOTSTRAP_LAG_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveThrottle:
+    """\
+    基于 AIMD 的自适应限速
+    定期采样复制延迟，延迟或者查询耗时超过目标时速度减半，
+    延迟低于目标的一半时速度线性增加，使复制延迟维持在目标范围内
+    多个扫描线程共用同一个实例
+    """
+    def __init__(self, lag_fn, target_lag=BOOTSTRAP_TARGET_LAG,
+                 target_latency=BOOTSTRAP_TARGET_LATENCY,
+                 initial_rate=BOOTSTRAP_INITIAL_RATE,
+                 min_rate=BOOTSTRAP_MIN_RATE,
+                 interval=BOOTSTRAP_LAG_INTERVAL):
+        """
+        :param lag_fn: 获取复制延迟（秒）的函数，无法获取时返回 None
+        :param target_lag: 允许的最大复制延迟（秒）
+        :param target_latency: 每批数据允许的最大查询耗时（秒）
+        :param initial_rate: 初始速度（行/秒）
+        :param min_rate: 最低速度（行/秒）
+        :param interval: 采样复制延迟的间隔（秒）
+        """
+        self.lag_fn = lag_fn
+        self.target_lag = target_lag
+        self.target_latency = target_latency
+        self.min_rate = min_rate
+        self.rate = max(initial_rate, min_rate)
+        # 每次加速的步长
+        self.step = max(initial_rate // 10, min_rate)
+        self.interval = interval
+
+        self.lock = Lock()
+        # 下一批数据允许读取的时间
+        self.next_time = time.time()
+        # 采样周期内的行数与最大查询耗时
+        self.sample_time = time.time()
+        self.sample_rows = 0
+        self.sample_latency = 0.0
+
+    def acquire(self, rows, latency=0.0):
+        """读取一批数据后调用，按当前速度等待
+        :param rows: 这批数据的行数
+        :param latency: 读取这批数据的耗时（秒）
+        """
+        with self.lock:
+            now = time.time()
+            self.sample_rows += rows
+            self.sample_latency = max(self.sample_latency, latency)
+            if now - self.sample_time >= self.interval:
+                self.adjust(now)
+
+            # 按当前速度计算这批数据占用的时间，从开始读取这批数据时算起
+            self.next_time = max(self.next_time, now - latency) + rows / self.rate
+            wait = self.next_time - now
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def adjust(self, now):
+        """采样复制延迟并调整速度"""
+        elapsed = now - self.sample_time
+        try:
+            lag = self.lag_fn()
+        except Exception as e:
+            logger.error(f'Get replication lag error: {e}')
+            lag = None
+
+        if ((lag is not None and lag > self.target_lag)
+                or self.sample_latency > self.target_latency):
+            self.rate = max(self.rate / 2, self.min_rate)
+        elif lag is None or lag < self.target_lag / 2:
+            self.rate += self.step
+
+        logger.info(f'Bootstrap read {self.sample_rows / elapsed:.0f} rows/s, '
+                    f'lag={lag}, latency={self.sample_latency:.3f}s, '
+                    f'rate limit={self.rate:.0f} rows/s')
+        self.sample_time = now
+        self.sample_rows = 0
+        self.sample_latency = 0.0
+
+
+if __name__ == '__main__':
+    from utils.log import configure_logging
+    configure_logging()
+
+    t = AdaptiveThrottle(lambda: 0, target_lag=10, initial_rate=1_000, interval=1)
+    for _ in range(50):
+        t.acquire(100)
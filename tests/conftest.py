@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: conftest
+@date: 2019-10-08
+@note: 没有复制 config/*.py 时使用 *.py.default 中的默认配置
+"""
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+for name in ('sys_config', 'db_config'):
+    module_name = f'config.{name}'
+    filename = os.path.join(ROOT, 'config', f'{name}.py')
+    if os.path.exists(filename) or module_name in sys.modules:
+        continue
+    module = types.ModuleType(module_name)
+    module.__file__ = f'{filename}.default'
+    with open(module.__file__, encoding='utf-8') as f:
+        exec(compile(f.read(), module.__file__, 'exec'), module.__dict__)
+    sys.modules[module_name] = module
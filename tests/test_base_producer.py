@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: test_base_producer
+@date: 2019-10-08
+"""
+import itertools
+
+import pytest
+
+from operators.common import CommitPoint
+from operators.producers.base_producer import BaseProducer
+from readers.base import BaseReader
+from writers.base import BaseWriter
+
+
+class EndlessReader(BaseReader):
+    """先产生一个断点，之后一直产生数据"""
+    def __init__(self):
+        self.commits = []
+
+    def read(self):
+        yield {'id': 0}
+        yield CommitPoint(position={'rt': {}, 'ts': {}})
+        for i in itertools.count(1):
+            yield {'id': i}
+
+    def commit(self, token=None, position=None):
+        self.commits.append((token, position))
+
+    def disconnect(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class FailingWriter(BaseWriter):
+    """写入成功，提交时报告发送失败"""
+    def __init__(self):
+        self.written = []
+
+    def write(self, obj, key=None):
+        self.written.append(obj)
+
+    def commit(self):
+        raise RuntimeError('delivery failed')
+
+    def stop(self):
+        pass
+
+
+def test_delivery_failure_stops_producer():
+    reader, writer = EndlessReader(), FailingWriter()
+    producer = BaseProducer(reader, writer, checkpoint_interval=0, checkpoint_events=0,
+                            spool_path='')
+    # 写入失败后读线程阻塞在已满的缓冲队列上，run 仍然要结束并抛出异常
+    with pytest.raises(RuntimeError):
+        producer.run()
+    assert reader.commits == []
+    assert writer.written == [{'id': 0}]
+    producer.stop()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: test_bootstrap
+@date: 2019-10-08
+"""
+import itertools
+
+import pytest
+
+from readers.bootstrap import ParallelScanner, ScanTask, split_range
+
+
+@pytest.mark.parametrize('min_value, max_value, chunk_size, chunks', [
+    (1, 10, 5, [(1, 5), (6, 10)]),
+    (1, 11, 5, [(1, 5), (6, 10), (11, 11)]),
+    (3, 3, 100, [(3, 3)]),
+    (-5, 4, 4, [(-5, -2), (-1, 2), (3, 4)]),
+    (10, 1, 5, []),
+])
+def test_split_range(min_value, max_value, chunk_size, chunks):
+    assert split_range(min_value, max_value, chunk_size) == chunks
+
+
+def test_split_range_covers_every_value():
+    chunks = split_range(7, 1000, 33)
+    values = [v for lower, upper in chunks for v in range(lower, upper + 1)]
+    assert values == list(range(7, 1001))
+
+
+def test_scanner_stop_joins_threads():
+    closed = []
+
+    def endless(context):
+        try:
+            yield from itertools.count()
+        finally:
+            closed.append(context)
+
+    scanner = ParallelScanner(['a', 'b'], max_size=4, batch_size=2)
+    scanner.start()
+    scanner.submit(ScanTask('db.t', endless))
+    scanner.submit(ScanTask('db.s', endless))
+    task, rows = scanner.get()
+    assert len(rows) == 2
+
+    # 线程退出之后才返回，读取中的游标已经关闭
+    assert scanner.stop(timeout=5)
+    assert not any(thread.is_alive() for thread in scanner.threads)
+    assert sorted(closed) == ['a', 'b']
+    assert scanner.stop(timeout=5)
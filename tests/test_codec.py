@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: test_codec
+@date: 2019-10-08
+"""
+import base64
+from decimal import Decimal
+from datetime import datetime, date, timedelta, timezone
+
+import pytest
+
+from utils.codec import get_codec, available_codecs
+from utils.date_utils import t2s, d2s
+
+ROW = {
+    'database': 'statistics',
+    'table': 'StarUser',
+    'type': 'update',
+    'ts': 1569816000,
+    'data': {
+        'id': 1,
+        'utm_source': '小白信用分',
+        'birthday': date(1992, 1, 1),
+        'balance': Decimal('1234.56'),
+        'avatar': bytes(range(16)),
+        'created_time': datetime(2019, 9, 30, 12, 0, 0),
+    },
+    'old': {'balance': None},
+}
+
+
+def test_json_round_trip():
+    codec = get_codec('json')
+    data = codec.decode(codec.encode(ROW))['data']
+    assert data['birthday'] == d2s(ROW['data']['birthday'])
+    assert data['balance'] == '1234.56'
+    assert base64.b64decode(data['avatar']) == ROW['data']['avatar']
+    assert data['created_time'] == t2s(ROW['data']['created_time'])
+
+
+def test_orjson_same_as_json():
+    pytest.importorskip('orjson')
+    codec = get_codec('orjson')
+    assert codec.decode(codec.encode(ROW)) == get_codec('json').decode(get_codec('json').encode(ROW))
+
+
+def test_msgpack_keeps_types():
+    pytest.importorskip('msgpack')
+    codec = get_codec('msgpack')
+    assert codec.decode(codec.encode(ROW)) == ROW
+
+
+def test_msgpack_datetime_extensions():
+    pytest.importorskip('msgpack')
+    codec = get_codec('msgpack')
+    values = [
+        datetime(2019, 9, 30, 12, 0, 0, 123456),
+        datetime(1, 1, 1),
+        datetime(2019, 9, 30, 12, 0, tzinfo=timezone(timedelta(hours=8))),
+        datetime(2019, 9, 30, 12, 0, tzinfo=timezone(-timedelta(hours=3, minutes=30))),
+        date(1992, 1, 1),
+    ]
+    decoded = codec.decode(codec.encode(values))
+    assert decoded == values
+    assert [value.utcoffset() for value in decoded[:4]] == [
+        None, None, timedelta(hours=8), -timedelta(hours=3, minutes=30)]
+    assert type(decoded[4]) is date
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        get_codec('avro')
+    assert 'json' in available_codecs()
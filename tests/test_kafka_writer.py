@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: test_kafka_writer
+@date: 2019-10-08
+"""
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('confluent_kafka')
+
+from confluent_kafka import KafkaError, KafkaException
+
+from utils.codec import get_codec
+from writers.kafka_writer import KafkaWriter, partition_for
+
+
+class FakeProducer:
+    """记录发送的消息，不连接 Kafka"""
+    def __init__(self, partitions=None, max_bytes=None):
+        """
+        :param partitions: dict, 每个 topic 的分区数，没有的 topic 返回空的元数据
+        :param max_bytes: 消息的最大字节数
+        """
+        self.messages = []
+        self.partitions = partitions or {}
+        self.max_bytes = max_bytes
+
+    def produce(self, topic, value, **kwargs):
+        if self.max_bytes and len(value) > self.max_bytes:
+            raise KafkaException(KafkaError(KafkaError.MSG_SIZE_TOO_LARGE))
+        self.messages.append(dict(kwargs, topic=topic, value=value))
+
+    def list_topics(self, topic=None, timeout=None):
+        topics = {name: SimpleNamespace(partitions=dict.fromkeys(range(n)))
+                  for name, n in self.partitions.items() if name == topic}
+        return SimpleNamespace(topics=topics)
+
+    def poll(self, timeout=None):
+        return 0
+
+    def flush(self, timeout=None):
+        return 0
+
+    def __len__(self):
+        return 0
+
+
+class FakeMessage:
+    def topic(self):
+        return 't'
+
+
+def make_writer(producer, **kwargs):
+    writer = KafkaWriter(bootstrap_servers='localhost:1', **kwargs)
+    writer.producer = producer
+    return writer
+
+
+def test_commit_raises_after_failed_delivery():
+    writer = make_writer(FakeProducer())
+    writer.produced = 2
+    writer.on_deliver(None, FakeMessage())
+    writer.on_deliver(KafkaError(KafkaError._MSG_TIMED_OUT), FakeMessage())
+
+    with pytest.raises(KafkaException):
+        writer.commit()
+    # 之后的提交也不能保存断点
+    with pytest.raises(KafkaException):
+        writer.commit()
+    assert writer.produced == writer.delivered == 0
+
+
+def test_commit_after_successful_delivery():
+    writer = make_writer(FakeProducer())
+    writer.produced = 1
+    writer.on_deliver(None, FakeMessage())
+    writer.commit()
+    assert writer.produced == writer.delivered == 0
+
+
+def batch(n, with_olds=False):
+    obj = {'topic': 't', 'type': 'update', 'commit': True,
+           'rows': [{'id': i} for i in range(n)]}
+    if with_olds:
+        obj['olds'] = [{'id': i, 'old': True} for i in range(n)]
+    return obj
+
+
+def row_keys(n):
+    return [str(i).encode() for i in range(n)]
+
+
+def decode(message):
+    return get_codec('json').decode(message['value'])
+
+
+def test_rows_split_by_partition():
+    producer = FakeProducer({'t': 4})
+    writer = make_writer(producer, codec='json')
+    keys = row_keys(10)
+    writer.write(batch(10, with_olds=True), keys)
+
+    partitions = [partition_for(key, 4) for key in keys]
+    assert len(set(partitions)) > 1
+    assert len(producer.messages) == len(set(partitions))
+    seen = []
+    for message in producer.messages:
+        obj = decode(message)
+        ids = [row['id'] for row in obj['rows']]
+        # 一条消息中的行都属于这个分区，并且保持原来的顺序
+        assert {partitions[i] for i in ids} == {message['partition']}
+        assert ids == sorted(ids)
+        assert [old['id'] for old in obj['olds']] == ids
+        assert message['key'] == keys[ids[0]]
+        seen += ids
+    assert sorted(seen) == list(range(10))
+
+
+def test_rows_without_topic_metadata():
+    producer = FakeProducer({})
+    writer = make_writer(producer, codec='json')
+    writer.write(batch(3), row_keys(3))
+    assert len(producer.messages) == 1
+    assert 'partition' not in producer.messages[0]
+    assert producer.messages[0]['key'] == b'0'
+
+
+def test_partitions_refreshed_after_expiry():
+    producer = FakeProducer({'t': 1})
+    writer = make_writer(producer, codec='json')
+    writer.write(batch(10), row_keys(10))
+    assert len(producer.messages) == 1
+
+    producer.partitions['t'] = 4
+    writer.metadata_max_age = 0
+    producer.messages = []
+    writer.write(batch(10), row_keys(10))
+    assert len(producer.messages) == len({partition_for(key, 4) for key in row_keys(10)})
+
+
+def test_large_batch_split_in_half():
+    producer = FakeProducer({'t': 1}, max_bytes=200)
+    writer = make_writer(producer, codec='json')
+    writer.write(batch(20, with_olds=True), row_keys(20))
+    assert len(producer.messages) > 1
+    ids = [row['id'] for message in producer.messages for row in decode(message)['rows']]
+    assert ids == list(range(20))
+    assert all(message['partition'] == 0 for message in producer.messages)
+
+    producer.max_bytes = 10
+    with pytest.raises(KafkaException):
+        writer.write(batch(2), row_keys(2))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: test_multiplexer
+@date: 2019-10-08
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from pymysqlreplication.gtid import GtidSet
+from pymysqlreplication.row_event import RowsEvent
+
+from readers.multiplexer import BinlogMultiplexer, Subscription, intersect_gtid_sets
+
+A = '3E11FA47-71CA-11E1-9E33-C80AA9429562'
+B = '4E11FA47-71CA-11E1-9E33-C80AA9429562'
+
+
+@pytest.mark.parametrize('gtid_sets, expected', [
+    ([f'{A}:1-10'], f'{A}:1-10'),
+    ([f'{A}:1-10', f'{A}:1-7'], f'{A}:1-7'),
+    ([f'{A}:1-10,{B}:1-5', f'{A}:1-7:9-12'], f'{A}:1-7:9-10'),
+    ([f'{A}:1-10', f'{B}:1-10'], ''),
+    ([f'{A}:1-3', f'{A}:4-6'], ''),
+    ([f'{A}:1-10,{B}:1-5', f'{A}:5-20,{B}:3-9', f'{A}:1-6,{B}:1-4'], f'{A}:5-6,{B}:3-4'),
+    ([], ''),
+])
+def test_intersect_gtid_sets(gtid_sets, expected):
+    assert str(intersect_gtid_sets([GtidSet(s) for s in gtid_sets])) == expected
+
+
+class FakeRowsEvent(RowsEvent):
+    """不需要 packet 的 RowsEvent，记录 rows 的解析次数"""
+    def __init__(self, schema, table, rows, log_pos):
+        self.schema = schema
+        self.table = table
+        self.packet = SimpleNamespace(log_pos=log_pos)
+        self._RowsEvent__rows = None
+        self.values = rows
+        self.fetched = 0
+
+    def _fetch_rows(self):
+        self.fetched += 1
+        self._RowsEvent__rows = []
+        for row in self.values:
+            self._RowsEvent__rows.append(row)
+
+
+def test_dispatch_decodes_rows_once():
+    multiplexer = BinlogMultiplexer({'host': 'localhost', 'port': 3306}, {}, ())
+    position = {'log_file': 'mysql-bin.000001', 'log_pos': 4}
+    subscriptions = [Subscription(name, {('db', 't')}, position) for name in ('a', 'b')]
+    multiplexer.log_file = 'mysql-bin.000001'
+
+    rows = [{'values': {'id': i}} for i in range(3)]
+    binlog_event = FakeRowsEvent('db', 't', rows, log_pos=100)
+    multiplexer.dispatch(binlog_event, subscriptions)
+
+    assert binlog_event.fetched == 1
+    for subscription in subscriptions:
+        received = subscription.queue.get_nowait()
+        assert received is binlog_event
+        assert received.rows == rows
+    assert binlog_event.fetched == 1
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: test_mysql_reader
+@date: 2019-10-08
+@note: 不连接 MySQL，用合成的 binlog event 测试 watermark 分片与事务模式
+"""
+import re
+from collections import deque
+from types import SimpleNamespace
+
+from bson import Timestamp
+from pymysqlreplication.event import GtidEvent, XidEvent, QueryEvent
+from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+
+from readers.bootstrap import WatermarkChunk
+from readers.mysql_reader import MySQLReader
+from readers.mysql_schema import SchemaRegistry
+
+WATERMARK_TABLE = 'dblog.watermark'
+
+
+class FakeConnector:
+    """按 keyset 分页返回内存中的表数据，记录写入的水位线"""
+    def __init__(self, tables):
+        """
+        :param tables: dict, {schema.table: [row, ...]}，每行按主键 id 排序
+        """
+        self.tables = tables
+        self.watermarks = []
+
+    def write_watermark(self, table, server_id, value):
+        self.watermarks.append(value)
+
+    def read(self, sql, args=None):
+        key = re.search(r'from (\S+)', sql).group(1)
+        *lower, limit = args
+        rows = [row for row in self.tables[key] if not lower or row['id'] > lower[0]]
+        return [dict(row) for row in rows[:limit]]
+
+
+def make_reader(tables=None, **kwargs):
+    """跳过 __init__，只设置解析 binlog 与 watermark 分片需要的属性"""
+    reader = MySQLReader.__new__(MySQLReader)
+    reader.__dict__.update(
+        conn=FakeConnector(tables or {}),
+        is_resume=False,
+        batch_mode=False,
+        binlog_batch=False,
+        binlog_transaction=False,
+        snapshot_mode=MySQLReader.WATERMARK,
+        watermark_table=WATERMARK_TABLE,
+        server_id=1,
+        chunk_size=2,
+        bootstrap_tables=1,
+        throttle=None,
+        monitor=None,
+        projections={},
+        filters={},
+        snapshotting={},
+        watermark_tables=deque(),
+        chunk=None,
+        auto_position='',
+        _rt={},
+        _ts={},
+        has_aligned=True,
+        new_tables=set(),
+        inc_tables=set(tables or ()),
+        txn=None,
+        txn_gtid=None,
+        txn_ts={},
+        txn_offset=0,
+        stream=None,
+    )
+    reader.__dict__.update(kwargs)
+    for key in tables or ():
+        reader.snapshotting[key] = {'pk': 'id', 'high': None,
+                                    'ts': Timestamp(1, 0), 'started': False}
+        reader.watermark_tables.append(key)
+    return reader
+
+
+def rows_event(cls, key, rows, ts=100, log_pos=4):
+    """合成的 rows event，rows 已经解析"""
+    binlog_event = cls.__new__(cls)
+    binlog_event.schema, binlog_event.table = key.split('.')
+    binlog_event.timestamp = ts
+    binlog_event.packet = SimpleNamespace(log_pos=log_pos)
+    binlog_event._RowsEvent__rows = rows
+    return binlog_event
+
+
+def watermark_event(value):
+    return rows_event(WriteRowsEvent, WATERMARK_TABLE, [{'values': {'id': 1, 'value': value}}])
+
+
+def run_chunks(reader, between=None):
+    """依次读取所有分片，每个分片的两条水位线之间插入 between(chunk) 返回的 event"""
+    events = list(reader.next_chunk())
+    while reader.chunk is not None:
+        chunk = reader.chunk
+        events += reader.parse_binlog(watermark_event(chunk.low))
+        for binlog_event in (between(chunk) if between else ()):
+            events += reader.parse_binlog(binlog_event)
+        events += reader.parse_binlog(watermark_event(chunk.high))
+    return events
+
+
+def table_rows(n):
+    return [{'id': i, 'v': f'v{i}'} for i in range(1, n + 1)]
+
+
+def completed(events):
+    return [event['table'] for event in events if event.get('type') == 'bootstrap-complete']
+
+
+def test_watermark_tables_read_one_by_one():
+    reader = make_reader({'db.big': table_rows(5), 'db.small': table_rows(1)})
+    assert completed(run_chunks(reader)) == ['big', 'small']
+
+
+def test_watermark_tables_take_turns():
+    # 两张表轮流读取分片，小表不等大表读取完成
+    reader = make_reader({'db.big': table_rows(5), 'db.small': table_rows(1)},
+                         bootstrap_tables=2)
+    events = run_chunks(reader)
+    assert completed(events) == ['small', 'big']
+    rows = [(event['table'], event['data']['id']) for event in events
+            if event.get('type') == 'bootstrap-insert']
+    assert [row for row in rows if row[0] == 'big'] == [('big', i) for i in range(1, 6)]
+
+
+def inserted(events):
+    return [event['data'] for event in events if event.get('type') == 'bootstrap-insert']
+
+
+def changes(events):
+    return [(event['type'], event['data']) for event in events
+            if event.get('type') in ('insert', 'update', 'delete')]
+
+
+def test_watermark_chunk_boundaries():
+    reader = make_reader({'db.t': table_rows(5)})
+    bounds = []
+
+    def between(chunk):
+        bounds.append(chunk.lower)
+        return ()
+
+    events = run_chunks(reader, between)
+    assert bounds == [None, 2, 4]
+    assert inserted(events) == table_rows(5)
+    assert [event['type'] for event in events if 'bootstrap' in event['type']] == (
+        ['bootstrap-start'] + ['bootstrap-insert'] * 5 + ['bootstrap-complete'])
+    assert 'db.t' not in reader.snapshotting
+    # 每个分片前后各一条水位线
+    assert len(reader.conn.watermarks) == 6
+
+
+def test_watermark_drops_rows_changed_inside_window():
+    reader = make_reader({'db.t': table_rows(4)})
+
+    def between(chunk):
+        if chunk.lower is None:
+            # 当前分片内：更新 1、删除 2，分片中读到的旧数据不再输出
+            yield rows_event(UpdateRowsEvent, 'db.t', [{'before_values': {'id': 1, 'v': 'v1'},
+                                                       'after_values': {'id': 1, 'v': 'new'}}])
+            yield rows_event(DeleteRowsEvent, 'db.t', [{'values': {'id': 2, 'v': 'v2'}}])
+
+    events = run_chunks(reader, between)
+    assert changes(events) == [('update', {'id': 1, 'v': 'new'}),
+                               ('delete', {'id': 2, 'v': 'v2'})]
+    assert inserted(events) == table_rows(4)[2:]
+
+
+def test_watermark_row_changes_outside_window():
+    table = table_rows(6)
+    reader = make_reader({'db.t': table})
+
+    def between(chunk):
+        if chunk.lower == 2:
+            # 已经输出的范围直接输出
+            yield rows_event(UpdateRowsEvent, 'db.t', [{'before_values': {'id': 1, 'v': 'v1'},
+                                                       'after_values': {'id': 1, 'v': 'a'}}])
+            # 尚未读取的范围不输出，之后的分片读到最新的数据
+            table[4] = {'id': 5, 'v': 'b'}
+            yield rows_event(UpdateRowsEvent, 'db.t', [{'before_values': {'id': 5, 'v': 'v5'},
+                                                       'after_values': {'id': 5, 'v': 'b'}}])
+
+    events = run_chunks(reader, between)
+    assert changes(events) == [('update', {'id': 1, 'v': 'a'})]
+    assert {'id': 5, 'v': 'b'} in inserted(events)
+
+
+def test_watermark_ignores_changes_before_low_watermark():
+    reader = make_reader({'db.t': table_rows(2)})
+    list(reader.next_chunk())
+    # 低水位线之前的变化已经包含在分片中
+    events = list(reader.parse_binlog(rows_event(
+        UpdateRowsEvent, 'db.t', [{'before_values': {'id': 1, 'v': 'v1'},
+                                   'after_values': {'id': 1, 'v': 'v1'}}])))
+    assert events == []
+    assert len(reader.chunk.rows) == 2
+
+
+def test_watermark_table_without_primary_key():
+    reader = make_reader({'db.t': table_rows(3)})
+    reader.snapshotting['db.t']['pk'] = None
+    reader.conn.read = lambda sql, args=None: table_rows(3)
+
+    def between(chunk):
+        yield rows_event(WriteRowsEvent, 'db.t', [{'values': {'id': 4, 'v': 'v4'}}])
+
+    events = run_chunks(reader, between)
+    assert changes(events) == [('insert', {'id': 4, 'v': 'v4'})]
+    assert inserted(events) == table_rows(3)
+
+
+def test_watermark_chunk_with_composite_key():
+    chunk = WatermarkChunk('db.t', ('a', 'b'), lower=(1, 2))
+    chunk.fill([{'a': 1, 'b': 3}, {'a': 2, 'b': 1}], limit=2)
+    assert chunk.upper == (2, 1) and not chunk.last
+    assert not chunk.covers((1, 2))
+    assert chunk.covers((1, 3)) and chunk.covers((2, 0)) and chunk.covers((2, 1))
+    assert not chunk.covers((2, 2))
+    chunk.discard((1, 3))
+    assert list(chunk.rows) == [(2, 1)]
+
+
+def gtid_event(gno):
+    binlog_event = GtidEvent.__new__(GtidEvent)
+    binlog_event.sid = bytes(16)
+    binlog_event.gno = gno
+    return binlog_event
+
+
+def xid_event(xid, log_pos):
+    binlog_event = XidEvent.__new__(XidEvent)
+    binlog_event.xid = xid
+    binlog_event.packet = SimpleNamespace(log_pos=log_pos)
+    return binlog_event
+
+
+def query_event(query, log_pos, schema=b'db'):
+    binlog_event = QueryEvent.__new__(QueryEvent)
+    binlog_event.query = query
+    binlog_event.schema = schema
+    binlog_event.packet = SimpleNamespace(log_pos=log_pos)
+    return binlog_event
+
+
+def make_txn_reader(**kwargs):
+    return make_reader(binlog_transaction=True, inc_tables={'db.a', 'db.b'},
+                       registry=SchemaRegistry({}), db_names={'db'}, **kwargs)
+
+
+def parse_all(reader, binlog_events):
+    events = []
+    for binlog_event in binlog_events:
+        events += reader.parse_binlog(binlog_event)
+    return events
+
+
+def test_transaction_commit_once_per_topic():
+    reader = make_txn_reader()
+    events = parse_all(reader, [
+        gtid_event(1),
+        rows_event(WriteRowsEvent, 'db.a', [{'values': {'id': 1}}, {'values': {'id': 2}}]),
+        rows_event(WriteRowsEvent, 'db.b', [{'values': {'id': 1}}]),
+        rows_event(WriteRowsEvent, 'db.a', [{'values': {'id': 3}}]),
+    ])
+    # 事务结束前不输出
+    assert events == []
+
+    events = parse_all(reader, [xid_event(9, log_pos=200)])
+    assert [(event['topic'], event['data']['id']) for event in events] == [
+        ('db-a', 1), ('db-a', 2), ('db-b', 1), ('db-a', 3)]
+    assert [event['offset'] for event in events] == [1, 2, 3, 4]
+    assert [event.get('commit', False) for event in events] == [False, False, True, True]
+    assert {event['xid'] for event in events} == {9}
+    assert {event['gtid'] for event in events} == {gtid_event(1).gtid}
+    assert reader.txn is None
+
+
+def test_transaction_position_updated_at_xid():
+    reader = make_txn_reader(_rt={'log_file': 'mysql-bin.000001', 'log_pos': 4})
+    parse_all(reader, [gtid_event(1),
+                       rows_event(WriteRowsEvent, 'db.a', [{'values': {'id': 1}}], log_pos=120)])
+    assert reader._rt['log_pos'] == 4
+    assert reader._ts == {}
+
+    parse_all(reader, [xid_event(9, log_pos=200)])
+    assert reader._rt['log_pos'] == 200
+    assert reader._ts == {'db.a': Timestamp(100, 0)}
+
+
+def test_large_transaction_flushed_in_parts(monkeypatch):
+    monkeypatch.setattr('readers.mysql_reader.MAX_LEN', 2)
+    reader = make_txn_reader()
+    parse_all(reader, [gtid_event(1)])
+    parts = [parse_all(reader, [rows_event(WriteRowsEvent, 'db.a',
+                                           [{'values': {'id': i}}, {'values': {'id': i + 1}}])])
+             for i in (1, 3)]
+    parts.append(parse_all(reader, [rows_event(WriteRowsEvent, 'db.a', [{'values': {'id': 5}}]),
+                                    xid_event(9, log_pos=200)]))
+
+    assert [len(part) for part in parts] == [2, 2, 1]
+    events = [event for part in parts for event in part]
+    # 分多次输出，offset 连续，只在事务结束时标记 commit
+    assert [event['offset'] for event in events] == [1, 2, 3, 4, 5]
+    assert [event.get('commit', False) for event in events] == [False] * 4 + [True]
+    assert [event.get('xid') for event in events] == [None] * 4 + [9]
+
+
+def test_ddl_transaction_without_xid():
+    reader = make_txn_reader(_rt={'log_file': 'mysql-bin.000001', 'log_pos': 4})
+    events = parse_all(reader, [gtid_event(1),
+                                query_event('alter table a add column c int', log_pos=150)])
+    assert events == []
+    # DDL 结束了 GTID 开始的事务，位置移到 DDL 之后
+    assert reader.txn is None
+    assert reader._rt['log_pos'] == 150
+    assert reader.registry.versions == {('db', 'a'): 1}
+
+    events = parse_all(reader, [
+        gtid_event(2),
+        query_event('BEGIN', log_pos=180),
+        rows_event(WriteRowsEvent, 'db.a', [{'values': {'id': 1}}]),
+        xid_event(9, log_pos=200),
+    ])
+    assert [(event['offset'], event['commit'], event['gtid']) for event in events] == [
+        (1, True, gtid_event(2).gtid)]
+    assert reader._rt['log_pos'] == 200
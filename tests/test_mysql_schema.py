@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: test_mysql_schema
+@date: 2019-10-08
+"""
+import pytest
+
+from readers.mysql_schema import DDL_PATTERN, parse_ddl_tables
+
+
+@pytest.mark.parametrize('query, tables', [
+    ('alter table `a`.`b` add column c int', [('a', 'b')]),
+    ('create table if not exists t (id int)', [('x', 't')]),
+    ('create table t like s', [('x', 't')]),
+    ('rename table a to b, c.d to e.f', [('x', 'a'), ('x', 'b'), ('c', 'd'), ('e', 'f')]),
+    ('drop table a, b', [('x', 'a'), ('x', 'b')]),
+    ('DROP TABLE IF EXISTS x.y, `x`.`z`', [('x', 'y'), ('x', 'z')]),
+    ('drop temporary table if exists tmp', [('x', 'tmp')]),
+    ('alter table db.t rename to db.t2', [('db', 't'), ('db', 't2')]),
+    ('alter table t rename as t2', [('x', 't'), ('x', 't2')]),
+    ('alter table t add column c int, rename t2', [('x', 't'), ('x', 't2')]),
+    ('alter table t rename column a to b', [('x', 't')]),
+    ('alter table t rename index i to j', [('x', 't')]),
+    ('truncate table db.t', [('db', 't')]),
+    ('truncate t', [('x', 't')]),
+    ('create index i on t (c)', [('x', 't')]),
+    ('create unique index `i` on `db`.`t` (c)', [('db', 't')]),
+    ('drop index i on db.t', [('db', 't')]),
+])
+def test_parse_ddl_tables(query, tables):
+    assert DDL_PATTERN.match(query)
+    assert parse_ddl_tables(query, 'x') == tables
+
+
+@pytest.mark.parametrize('query', [
+    'drop database x',
+    'create database y',
+])
+def test_parse_ddl_tables_unknown(query):
+    assert parse_ddl_tables(query, 'x') is None
+
+
+@pytest.mark.parametrize('query, tables', [
+    ('/* gh-ost */ ALTER TABLE `db`.`_t_gho` add column c int', [('db', '_t_gho')]),
+    ('/* a */ /* b */\nrename table a to b', [('x', 'a'), ('x', 'b')]),
+    ('-- migration 42\nalter table t add c int', [('x', 't')]),
+    ('# comment\n  drop table a, b', [('x', 'a'), ('x', 'b')]),
+    ('/* multi\nline */truncate t', [('x', 't')]),
+])
+def test_parse_ddl_tables_with_leading_comments(query, tables):
+    assert DDL_PATTERN.match(query)
+    assert parse_ddl_tables(query, 'x') == tables
+
+
+@pytest.mark.parametrize('query', [
+    'BEGIN',
+    '/* gh-ost */ insert into t values (1)',
+    '/* alter table t */ update t set c = 1',
+    '/*!40000 ALTER TABLE t DISABLE KEYS */',
+])
+def test_ddl_pattern_ignores_dml(query):
+    assert not DDL_PATTERN.match(query)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: test_spool
+@date: 2019-10-08
+"""
+import os
+
+from utils.spool import Spool
+
+
+def segments(path):
+    return sorted(name for name in os.listdir(path) if name.endswith('.seg'))
+
+
+def test_read_in_order_across_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=64)
+    records = [f'record-{i}'.encode() for i in range(10)]
+    for record in records:
+        spool.append(record)
+    assert len(spool) == 10
+    assert len(segments(tmp_path)) > 1
+    assert [spool.read() for _ in range(10)] == records
+    assert spool.read(timeout=0.01) is None
+    spool.close()
+
+
+def test_restart_replays_unacked_records(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=64)
+    records = [f'record-{i}'.encode() for i in range(10)]
+    for record in records:
+        spool.append(record)
+    assert [spool.read() for _ in range(4)] == records[:4]
+    spool.ack()
+    # 读取但没有确认的记录重启后重新读取
+    assert spool.read() == records[4]
+    spool.close()
+
+    spool = Spool(str(tmp_path), segment_size=64)
+    assert len(spool) == 6
+    assert [spool.read() for _ in range(6)] == records[4:]
+    spool.ack()
+    spool.close()
+
+    spool = Spool(str(tmp_path), segment_size=64)
+    assert len(spool) == 0
+    spool.append(b'next')
+    assert spool.read() == b'next'
+    spool.close()
+
+
+def test_ack_removes_read_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=64)
+    for i in range(10):
+        spool.append(f'record-{i}'.encode())
+    before = segments(tmp_path)
+    for _ in range(10):
+        spool.read()
+    spool.ack()
+    after = segments(tmp_path)
+    assert len(after) == 1 and after[0] == before[-1]
+    spool.close()
+
+
+def test_record_larger_than_segment(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=64)
+    spool.append(b'small')
+    big = os.urandom(1000)
+    spool.append(big)
+    spool.append(b'after')
+    assert [spool.read() for _ in range(3)] == [b'small', big, b'after']
+    spool.ack()
+    spool.close()
+
+    spool = Spool(str(tmp_path), segment_size=64)
+    assert len(spool) == 0
+    spool.close()
+
+
+def test_recover_with_empty_segment(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=64)
+    for i in range(3):
+        spool.append(f'record-{i}'.encode())
+    assert spool.read() == b'record-0'
+    spool.ack()
+    last = max(spool.segments)
+    spool.close()
+
+    # 创建 segment 之后、分配空间之前中断留下的空文件
+    (tmp_path / f'{last + 1:010d}.seg').touch()
+    spool = Spool(str(tmp_path), segment_size=64)
+    assert len(spool) == 2
+    assert f'{last + 1:010d}.seg' not in segments(tmp_path)
+    records = [f'next-{i}'.encode() for i in range(10)]
+    for record in records:
+        spool.append(record)
+    assert [spool.read() for _ in range(12)] == [b'record-1', b'record-2'] + records
+    spool.close()
+
+
+def test_recover_when_acked_segment_is_empty(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=64)
+    spool.close()
+    (tmp_path / '0000000000.seg').write_bytes(b'')
+    spool = Spool(str(tmp_path), segment_size=64)
+    spool.append(b'a')
+    assert spool.read() == b'a'
+    spool.ack()
+    spool.close()
+    assert (tmp_path / 'ack').read_text() == '0 5'
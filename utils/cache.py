@@ -67,19 +67,21 @@ class Cache(object):
         """
         return self._cache.hgetall(self._name)
 
-    def setm(self, mapping):
+    def setm(self, mapping, pipe=None):
         """
         设置缓存
         :param mapping: {key1: value1, key2: value2}
+        :param pipe: pipeline 实例，指定时只加入 pipeline，由调用方统一执行
         :return:
         :example: setm({'key1': 'value1', 'key2': 'value2'})
         """
-        return self._cache.hmset(self._name, mapping)
+        return (pipe or self._cache).hmset(self._name, mapping)
 
-    def delm(self, keys):
+    def delm(self, keys, pipe=None):
         """
         删除缓存
         :param keys: list or tuple
+        :param pipe: pipeline 实例，指定时只加入 pipeline，由调用方统一执行
         :return: list
         :example: delm(('key1', 'key2'))
         """
@@ -89,7 +91,15 @@ class Cache(object):
                 keys = [keys]
         except TypeError:
             keys = [keys]
-        return self._cache.hdel(self._name, keys)
+        return (pipe or self._cache).hdel(self._name, *keys)
+
+    def pipeline(self):
+        """
+        获取 pipeline，同一个 redis 上的多个缓存可以一次写入
+        :return: pipeline
+        :example: pipe = pipeline(); setm(mapping, pipe); pipe.execute()
+        """
+        return self._cache.pipeline()
 
     def remove(self):
         """
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: codec
+@date: 2019-09-30
+@note: Kafka 消息的编解码方式，名称通过 codec header 传给 consumer，没有 header 时为 json
+"""
+import struct
+import logging
+import base64
+from decimal import Decimal
+from datetime import datetime, date, timedelta, timezone
+
+from .common import obj2bytes, bytes2obj, obj2bson, bson2obj
+from .date_utils import t2s, d2s
+from .str_utils import b2s
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# msgpack 扩展类型的编号
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_DECIMAL = 3
+# 扩展类型的二进制格式，不依赖 Python 3.7 的 fromisoformat
+# datetime: 年 月 日 时 分 秒 微秒，带时区时再加上 UTC 偏移的秒数
+DATETIME_STRUCT = struct.Struct('>HBBBBBI')
+UTC_OFFSET_STRUCT = struct.Struct('>i')
+# date: 年 月 日
+DATE_STRUCT = struct.Struct('>HBB')
+
+
+class Codec:
+    """编解码方式，子类实现 encode 与 decode"""
+    name = None
+
+    @staticmethod
+    def available():
+        """依赖的第三方库是否已安装"""
+        return True
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, bts: bytes):
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """标准库 json，datetime 转为字符串，bytes 转为 base64 字符串"""
+    name = 'json'
+
+    def encode(self, obj):
+        return obj2bytes(obj)
+
+    def decode(self, bts: bytes):
+        return bytes2obj(bts)
+
+
+class OrjsonCodec(Codec):
+    """\
+    orjson 编解码，输出与 json 相同，consumer 端仍按 json 的方式处理 datetime 与 binary 列
+    datetime 不使用 orjson 的 RFC 3339 格式，保持与 DateEncoder 一致
+    """
+    name = 'orjson'
+
+    @staticmethod
+    def available():
+        return orjson is not None
+
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, datetime):
+            return t2s(obj)
+        elif isinstance(obj, date):
+            return d2s(obj)
+        elif isinstance(obj, bytes):
+            return b2s(base64.b64encode(obj))
+        return str(obj)
+
+    def encode(self, obj):
+        if isinstance(obj, bytes):
+            return obj
+        return orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+
+    def decode(self, bts: bytes):
+        return orjson.loads(bts)
+
+
+class MsgpackCodec(Codec):
+    """\
+    msgpack 二进制编码，bytes 原样保存，不需要 base64；
+    datetime、date 与 Decimal 通过扩展类型保存，consumer 解码后得到原来的类型
+    """
+    name = 'msgpack'
+
+    @staticmethod
+    def available():
+        return msgpack is not None
+
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, datetime):
+            data = DATETIME_STRUCT.pack(obj.year, obj.month, obj.day, obj.hour,
+                                        obj.minute, obj.second, obj.microsecond)
+            offset = obj.utcoffset()
+            if offset is not None:
+                data += UTC_OFFSET_STRUCT.pack(int(offset.total_seconds()))
+            return msgpack.ExtType(EXT_DATETIME, data)
+        elif isinstance(obj, date):
+            return msgpack.ExtType(EXT_DATE, DATE_STRUCT.pack(obj.year, obj.month, obj.day))
+        elif isinstance(obj, Decimal):
+            return msgpack.ExtType(EXT_DECIMAL, str(obj).encode())
+        return str(obj)
+
+    @staticmethod
+    def ext_hook(code, data):
+        if code == EXT_DATETIME:
+            tz = None
+            if len(data) > DATETIME_STRUCT.size:
+                offset, = UTC_OFFSET_STRUCT.unpack_from(data, DATETIME_STRUCT.size)
+                tz = timezone(timedelta(seconds=offset))
+            return datetime(*DATETIME_STRUCT.unpack_from(data), tzinfo=tz)
+        elif code == EXT_DATE:
+            return date(*DATE_STRUCT.unpack(data))
+        elif code == EXT_DECIMAL:
+            return Decimal(data.decode())
+        return msgpack.ExtType(code, data)
+
+    def encode(self, obj):
+        return msgpack.packb(obj, default=self.default, use_bin_type=True)
+
+    def decode(self, bts: bytes):
+        return msgpack.unpackb(bts, ext_hook=self.ext_hook, raw=False,
+                               strict_map_key=False)
+
+
+class BsonCodec(Codec):
+    """BSON 编码，携带原始 BSON 文档时使用，嵌套的文档不解码"""
+    name = 'bson'
+
+    def encode(self, obj):
+        return obj2bson(obj)
+
+    def decode(self, bts: bytes):
+        return bson2obj(bts)
+
+
+CODECS = {codec.name: codec() for codec in (JsonCodec, OrjsonCodec, MsgpackCodec, BsonCodec)}
+
+
+def get_codec(name):
+    """按名称获取编解码方式
+    :param name: str, 编码方式的名称
+    :return: Codec
+    """
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f'Unknown codec: {name}, choices: {list(CODECS)}')
+    if not codec.available():
+        raise ValueError(f'Codec {name} is not available, install it first')
+    return codec
+
+
+def available_codecs():
+    """已安装依赖的编解码方式的名称"""
+    return [name for name, codec in CODECS.items() if codec.available()]
+
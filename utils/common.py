@@ -13,6 +13,9 @@ import base64
 from datetime import datetime, date
 from functools import wraps
 
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+
 from .date_utils import t2s, d2s
 from .str_utils import b2s
 
@@ -44,6 +47,21 @@ def bytes2obj(bts: bytes):
     return json.loads(bts)
 
 
+def obj2bson(obj):
+    """编码为 BSON，其中的 RawBSONDocument 直接复制原始字节，不需要解码"""
+    return BSON.encode(obj)
+
+
+def bson2obj(bts: bytes):
+    """只解码 BSON 的第一层，嵌套的文档保持为 RawBSONDocument"""
+    return dict(RawBSONDocument(bts))
+
+
+def is_raw(obj):
+    """是否携带原始 BSON 文档"""
+    return isinstance(obj, dict) and any(isinstance(v, RawBSONDocument) for v in obj.values())
+
+
 class DateEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime):
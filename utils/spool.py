@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+@author: Link
+@contact: zhenglong1992@126.com
+@module: spool
+@date: 2019-09-23
+@note: 基于内存映射的本地分段文件，写入不等待读取，读取确认后删除
+"""
+import os
+import mmap
+import struct
+import logging
+from threading import Condition
+
+logger = logging.getLogger(__name__)
+
+# 每条记录的长度前缀，长度为 0 表示 segment 中之后没有数据
+HEADER = struct.Struct('>I')
+
+
+class Segment:
+    """固定大小的 segment 文件，创建时预分配空间，通过 mmap 读写"""
+    def __init__(self, path, seq, size=None):
+        """
+        :param path: str, 所在目录
+        :param seq: int, 序号，决定文件名与先后顺序
+        :param size: int, 新建时的文件大小，None 表示打开已有的文件
+        """
+        self.seq = seq
+        self.filename = os.path.join(path, f'{seq:010d}.seg')
+        with open(self.filename, 'a+b') as f:
+            if size is not None:
+                f.truncate(size)
+            self.size = os.fstat(f.fileno()).st_size
+            self.mm = mmap.mmap(f.fileno(), self.size)
+
+    def write(self, offset, data):
+        """在 offset 处写入一条记录
+        :return: 下一条记录的 offset，空间不足时返回 None
+        """
+        end = offset + HEADER.size + len(data)
+        if end > self.size:
+            return None
+        self.mm[offset + HEADER.size:end] = data
+        # 先写数据再写长度，读取方看到长度时数据已经完整
+        self.mm[offset:offset + HEADER.size] = HEADER.pack(len(data))
+        return end
+
+    def read(self, offset):
+        """读取 offset 处的记录
+        :return: (data, 下一条记录的 offset)，没有数据时返回 (None, offset)
+        """
+        if offset + HEADER.size > self.size:
+            return None, offset
+        length, = HEADER.unpack_from(self.mm, offset)
+        if not length:
+            return None, offset
+        start = offset + HEADER.size
+        return self.mm[start:start + length], start + length
+
+    def scan(self, offset=0):
+        """从 offset 开始遍历记录，返回记录数以及末尾的 offset"""
+        count = 0
+        data, offset = self.read(offset)
+        while data is not None:
+            count += 1
+            data, offset = self.read(offset)
+        return count, offset
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.filename)
+
+
+class Spool:
+    """\
+    本地分段 spool
+    追加写入当前 segment，写满后新建下一个 segment；读取方从确认的位置开始按顺序读取，
+    确认 ack 后，读取位置之前的 segment 会被删除，确认的位置保存在 ack 文件中，重启后从这里继续读取
+    只保证进程内一个写入方与一个读取方的并发
+    """
+    ACK_FILE = 'ack'
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024):
+        """
+        :param path: str, 保存 segment 文件的目录
+        :param segment_size: int, 每个 segment 文件的大小（字节）
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.cond = Condition()
+        os.makedirs(path, exist_ok=True)
+
+        # 已确认的位置 (seq, offset)
+        self.acked = self.load_ack()
+        seqs = []
+        for name in sorted(os.listdir(path)):
+            if not name.endswith('.seg'):
+                continue
+            seq, filename = int(name[:-4]), os.path.join(path, name)
+            if seq < self.acked[0] or not os.path.getsize(filename):
+                # 已确认的 segment，以及创建后还没来得及分配空间就中断的空文件
+                os.remove(filename)
+            else:
+                seqs.append(seq)
+        self.segments = {seq: Segment(path, seq) for seq in seqs}
+
+        if not self.segments:
+            self.segments[self.acked[0]] = Segment(path, self.acked[0], segment_size)
+            self.acked = (self.acked[0], 0)
+        elif self.acked[0] not in self.segments:
+            # 确认位置所在的 segment 是被删除的空文件，从之后的第一个 segment 开始读取
+            self.acked = (min(self.segments), 0)
+
+        # 读取位置从确认的位置开始，写入位置在最后一个 segment 的末尾
+        self.reading = self.acked
+        self.unread = 0
+        for seq in sorted(self.segments):
+            count, offset = self.segments[seq].scan(self.acked[1] if seq == self.acked[0] else 0)
+            self.unread += count
+        self.writing = (max(self.segments), offset)
+        if self.unread:
+            logger.info(f'Spool {path} recovered {self.unread} records from {self.acked}')
+
+    def load_ack(self):
+        try:
+            with open(os.path.join(self.path, self.ACK_FILE)) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def save_ack(self):
+        """先写临时文件并刷到磁盘再替换，断电后 ack 文件要么是旧的位置，要么是新的位置"""
+        filename = os.path.join(self.path, self.ACK_FILE)
+        with open(f'{filename}.tmp', 'w') as f:
+            f.write('%d %d' % self.acked)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{filename}.tmp', filename)
+        # 改名本身记录在目录中，目录也要刷到磁盘
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, data):
+        """追加一条记录，不等待读取方
+        :param data: bytes
+        """
+        with self.cond:
+            seq, offset = self.writing
+            end = self.segments[seq].write(offset, data)
+            if end is None:
+                # 当前 segment 已满，超大的记录单独使用一个更大的 segment
+                seq += 1
+                size = max(self.segment_size, HEADER.size * 2 + len(data))
+                self.segments[seq] = Segment(self.path, seq, size)
+                end = self.segments[seq].write(0, data)
+            self.writing = (seq, end)
+            self.unread += 1
+            self.cond.notify()
+
+    def read(self, timeout=None):
+        """按顺序读取下一条记录，没有数据时等待
+        :param timeout: 最长等待时间（秒），None 表示一直等待
+        :return: bytes，超时返回 None
+        """
+        with self.cond:
+            if not self.unread and not self.cond.wait_for(lambda: self.unread, timeout):
+                return None
+
+            seq, offset = self.reading
+            data, end = self.segments[seq].read(offset)
+            if data is None:
+                # 当前 segment 中的数据已读完，转到下一个 segment
+                seq, end = seq + 1, 0
+                data, end = self.segments[seq].read(end)
+            self.reading = (seq, end)
+            self.unread -= 1
+            return data
+
+    def ack(self):
+        """确认已经读取的记录都已处理，删除之前的 segment"""
+        with self.cond:
+            self.acked = self.reading
+            done = [seq for seq in self.segments if seq < self.acked[0]]
+            for seq in done:
+                self.segments.pop(seq).remove()
+            self.save_ack()
+
+    def sync(self):
+        """把写入的数据刷到磁盘"""
+        with self.cond:
+            for segment in self.segments.values():
+                segment.flush()
+
+    def __len__(self):
+        """尚未读取的记录数"""
+        return self.unread
+
+    def close(self):
+        with self.cond:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments = {}
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    d = tempfile.mkdtemp()
+    s = Spool(d, segment_size=64)
+    for i in range(10):
+        s.append(f'record-{i}'.encode())
+    print([s.read() for _ in range(4)])
+    s.ack()
+    s.close()
+
+    s = Spool(d, segment_size=64)
+    print(len(s), [s.read() for _ in range(len(s))], os.listdir(d))
@@ -13,12 +13,35 @@ class BaseWriter:
     maxlen = MAX_LEN
 
     """base writer"""
+    def __new__(cls, *args, **kwargs):
+        # 记录创建时的参数，用于 clone
+        obj = super().__new__(cls)
+        obj._args = args
+        obj._kwargs = kwargs
+        return obj
+
+    def clone(self):
+        """使用相同的参数创建一个新的 writer，拥有独立的连接与缓存"""
+        return type(self)(*self._args, **self._kwargs)
+
     def write(self, *args, **kwargs):
         """使用两阶段提交方式，第一阶段准备阶段，通常保存到缓存队列"""
         raise NotImplementedError()
 
+    def write_batch(self, batch, key_fn=None):
+        """写入一批共用信封的数据 RowBatch，默认逐条展开后写入
+        :param key_fn: 计算每条数据消息 key 的函数，None 表示不指定 key
+        """
+        for event in batch.to_events():
+            if key_fn is None:
+                self.write(event)
+            else:
+                self.write(event, key_fn(event))
+
     def commit(self, *args, **kwargs):
-        """使用两阶段提交方式，第二阶段提交阶段，提交缓存队列中的数据"""
+        """使用两阶段提交方式，第二阶段提交阶段，提交缓存队列中的数据
+        有数据没有写入成功时抛出异常，调用方不能保存断点
+        """
         raise NotImplementedError()
 
     def stop(self):
@@ -9,25 +9,83 @@
 https://docs.confluent.io/current/clients/confluent-kafka-python/#confluent-kafka-confluent-s-python-client-for-apache-kafka
 https://github.com/edenhill/librdkafka/blob/master/CONFIGURATION.md
 """
+import time
+import zlib
 import logging
+from collections import OrderedDict
 
 from confluent_kafka import Producer, KafkaError, KafkaException
 from confluent_kafka.admin import AdminClient, NewTopic
 
 from writers.base import BaseWriter
-from utils.common import obj2bytes
+from utils.common import is_raw
+from utils.codec import get_codec
 from config.sys_config import (
     BROKER_VERSION,
     COMPRESSION_TYPE,
-    BOOTSTRAP_SERVERS
+    BOOTSTRAP_SERVERS,
+    PARTITIONER,
+    TOPIC_PARTITIONS,
+    PRODUCER_THROUGHPUT,
+    PRODUCER_LINGER_MS,
+    PRODUCER_BATCH_NUM_MESSAGES,
+    PRODUCER_QUEUE_MAX_MESSAGES,
+    PRODUCER_QUEUE_MAX_KBYTES,
+    PRODUCER_POLL_INTERVAL,
+    PRODUCER_IDEMPOTENCE,
+    PRODUCER_MESSAGE_TIMEOUT_MS,
+    MESSAGE_CODEC
 )
 
 logger = logging.getLogger(__name__)
 
 
+def murmur2(data):
+    """与 Java 客户端及 librdkafka murmur2 partitioner 相同的哈希"""
+    length = len(data)
+    m = 0x5bd1e995
+    h = (0x9747b28c ^ length) & 0xffffffff
+    for i in range(0, length - length % 4, 4):
+        k = data[i] | (data[i + 1] << 8) | (data[i + 2] << 16) | (data[i + 3] << 24)
+        k = (k * m) & 0xffffffff
+        k ^= k >> 24
+        k = (k * m) & 0xffffffff
+        h = (h * m) & 0xffffffff
+        h ^= k
+
+    tail = length - length % 4
+    extra = length % 4
+    if extra >= 3:
+        h ^= data[tail + 2] << 16
+    if extra >= 2:
+        h ^= data[tail + 1] << 8
+    if extra >= 1:
+        h ^= data[tail]
+        h = (h * m) & 0xffffffff
+
+    h ^= h >> 13
+    h = (h * m) & 0xffffffff
+    h ^= h >> 15
+    return h
+
+
+def partition_for(key, partitions, partitioner=PARTITIONER):
+    """按 partitioner 计算 key 所在的分区，不支持的 partitioner 返回 None"""
+    if partitioner.startswith('murmur2'):
+        return (murmur2(key) & 0x7fffffff) % partitions
+    if partitioner.startswith('consistent'):
+        return zlib.crc32(key) % partitions
+    return None
+
+
 class KafkaWriter(BaseWriter):
+    # 本地队列满时等待的最长间隔（秒）
+    max_backoff = 1.0
+    # topic 分区数的缓存时间（秒），与 librdkafka topic.metadata.refresh.interval.ms 的默认值相同
+    metadata_max_age = 300
+
     @staticmethod
-    def create_topics(topics, num_partitions=1, replication_factor=1,
+    def create_topics(topics, num_partitions=TOPIC_PARTITIONS, replication_factor=1,
                       bootstrap_servers=BOOTSTRAP_SERVERS):
         if not isinstance(topics, (list, tuple)):
             topics = [topics]
@@ -71,48 +129,194 @@ class KafkaWriter(BaseWriter):
         return results
 
     def __init__(self, topic=None, bootstrap_servers=BOOTSTRAP_SERVERS,
-                 *args, **kwargs):
+                 codec=None, throughput=PRODUCER_THROUGHPUT, *args, **kwargs):
+        """
+        :param topic: 指定时所有数据写入这个 topic，否则使用数据中的 topic
+        :param bootstrap_servers: Kafka 地址
+        :param codec: 消息的编码方式，见 utils.codec，None 表示携带原始 BSON 文档时使用 bson，否则使用 MESSAGE_CODEC
+        :param throughput: 是否使用高吞吐配置
+        """
         self.topic = topic
         self.bootstrap_servers = bootstrap_servers
+        self.codec = codec
+        # 提前检查编码方式是否可用
+        get_codec(codec or MESSAGE_CODEC)
+        self.throughput = throughput
+        # 上次提交之后写入与送达的消息数
+        self.produced = 0
+        self.delivered = 0
+        # 发送失败的消息数与最近一次的错误，不会清零，之后的提交都会失败，断点停在失败之前
+        self.failed = 0
+        self.error = None
+        # 每个 topic 的分区数以及获取的时间
+        self.partitions = {}
         self.producer = self.get_producer()
 
     def on_deliver(self, err, msg):
-        if err is not None:
-            logger.error(f'Message delivery failed: {err}, {msg}')
-            if err.code() == KafkaError._MSG_TIMED_OUT:
-                logger.error(f'{msg.topic()}, {msg}')
-                self.producer = self.get_producer()
-                self.producer.poll(0)
-                self.producer.produce(msg.topic(), msg.value())
-            else:
-                raise KafkaError(f'Message delivery failed: {err}, {msg}')
-        # else:
-        #     logger.info(f'{msg.topic()} {msg.partition()} {msg.offset()}')
+        if err is None:
+            self.delivered += 1
+            return
+
+        # 重试由 librdkafka 完成，这里收到的是超过 message.timeout.ms 或者不可重试的错误，
+        # 回调中不重新发送，否则会排在同一个 key 之后的消息后面；也不抛出异常，由 commit 统一处理
+        logger.error(f'Message delivery failed: {err}, {msg.topic()}')
+        self.failed += 1
+        self.error = err
 
     def get_producer(self):
-        return Producer({
+        config = {
             'bootstrap.servers': self.bootstrap_servers,
             'broker.version.fallback': BROKER_VERSION,
             'compression.type': COMPRESSION_TYPE,
+            'partitioner': PARTITIONER,
+            'enable.idempotence': PRODUCER_IDEMPOTENCE,
+            'message.timeout.ms': PRODUCER_MESSAGE_TIMEOUT_MS,
             'on_delivery': self.on_deliver
-        })
+        }
+        if self.throughput:
+            config.update({
+                'linger.ms': PRODUCER_LINGER_MS,
+                'batch.num.messages': PRODUCER_BATCH_NUM_MESSAGES,
+                'queue.buffering.max.messages': PRODUCER_QUEUE_MAX_MESSAGES,
+                'queue.buffering.max.kbytes': PRODUCER_QUEUE_MAX_KBYTES,
+            })
+        return Producer(config)
 
-    def write(self, obj):
-        self.producer.poll(0)
-        self.producer.produce(self.topic or obj.get('topic'), obj2bytes(obj))
+    def _produce(self, topic, value, **kwargs):
+        """本地队列满时处理发送结果腾出空间，等待时间指数增长"""
+        backoff = 0.01
+        while True:
+            try:
+                self.producer.produce(topic, value, **kwargs)
+            except BufferError:
+                logger.warning(f'Kafka local queue is full, {len(self.producer)} messages '
+                               f'in flight, wait {backoff}s')
+                self.producer.poll(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            else:
+                self.produced += 1
+                if not self.produced % PRODUCER_POLL_INTERVAL:
+                    self.producer.poll(0)
+                return
+
+    def get_codec(self, obj):
+        if self.codec:
+            return self.codec
+        return 'bson' if is_raw(obj) else MESSAGE_CODEC
+
+    def produce(self, topic, obj, codec, key=None, **kwargs):
+        """按 codec 编码，非 json 编码通过 codec header 告知 reader
+        批量数据超过 message.max.bytes 时对半拆分后按顺序发送
+        :param key: 消息的 key，由 partitioner 按 key 选择分区
+        :param kwargs: 其他发送参数，如 partition
+        """
+        value = get_codec(codec).encode(obj)
+        if codec != 'json':
+            kwargs['headers'] = {'codec': codec}
+        try:
+            self._produce(topic, value, key=key, **kwargs)
+        except KafkaException as e:
+            rows = obj.get('rows') if isinstance(obj, dict) else None
+            if e.args[0].code() != KafkaError.MSG_SIZE_TOO_LARGE or not rows or len(rows) < 2:
+                raise
+            logger.warning(f'Kafka message of {len(rows)} rows is too large ({len(value)} bytes), '
+                           f'split in half')
+            kwargs.pop('headers', None)
+            half = len(rows) // 2
+            for part in (slice(None, half), slice(half, None)):
+                sub = dict(obj, rows=rows[part])
+                if obj.get('olds'):
+                    sub['olds'] = obj['olds'][part]
+                self.produce(topic, sub, codec, key, **kwargs)
+
+    def write(self, obj, key=None):
+        """发送结果每写入 PRODUCER_POLL_INTERVAL 条消息处理一次
+        :param key: 消息的 key，包含多行的批量数据可以是每一行的 key 列表
+        """
+        topic = self.topic or obj.get('topic')
+        if isinstance(key, list):
+            self.produce_rows(topic, obj, self.get_codec(obj), key)
+        else:
+            self.produce(topic, obj, self.get_codec(obj), key)
+
+    def get_partitions(self, topic):
+        """topic 的分区数，缓存过期后从 broker 重新获取，分区增加后与 librdkafka 的分区选择保持一致
+        :return: int, topic 尚未创建或者获取失败时返回 0
+        """
+        cached = self.partitions.get(topic)
+        if cached and time.time() - cached[1] < self.metadata_max_age:
+            return cached[0]
+
+        try:
+            metadata = self.producer.list_topics(topic, timeout=10)
+        except KafkaException as e:
+            logger.warning(f'Kafka failed to get metadata of {topic}: {e}')
+            return 0
+        partitions = len(metadata.topics[topic].partitions) if topic in metadata.topics else 0
+        if partitions:
+            self.partitions[topic] = (partitions, time.time())
+        return partitions
+
+    def produce_rows(self, topic, obj, codec, keys):
+        """\
+        包含多行的批量数据按每一行的 key 所在的分区拆分，同一个分区的行仍然作为一条消息，
+        每一行与全量读取、逐行输出时写入同一个分区，保证同一行的变化有序
+        """
+        partitions = self.get_partitions(topic)
+        groups = OrderedDict()
+        if partitions:
+            for i, key in enumerate(keys):
+                groups.setdefault(partition_for(key, partitions), []).append(i)
+
+        if not partitions or None in groups:
+            # 分区数未知或者不支持的 partitioner 无法在这里计算分区，整批按第一行的 key 写入
+            self.produce(topic, obj, codec, keys[0])
+            return
+
+        for partition, indexes in groups.items():
+            part = dict(obj, rows=[obj['rows'][i] for i in indexes])
+            if obj.get('olds'):
+                part['olds'] = [obj['olds'][i] for i in indexes]
+            self.produce(topic, part, codec, keys[indexes[0]], partition=partition)
+
+    def write_batch(self, batch, key_fn=None):
+        """一批数据共用 topic，编码方式按每条数据选择"""
+        topic = self.topic or batch.envelope.get('topic')
+        for event in batch.to_events():
+            self.produce(topic, event, self.get_codec(event), key_fn(event) if key_fn else None)
 
     def commit(self):
-        self.producer.flush(5)
+        """阻塞直到所有消息都有发送结果
+        :raise KafkaException: 有发送失败的消息，调用方不能保存断点，应该停止
+        """
+        start = time.time()
+        remaining = self.producer.flush(5)
+        while remaining:
+            logger.warning(f'Waiting for {remaining} messages to be delivered, '
+                           f'{time.time() - start:.1f}s elapsed')
+            remaining = self.producer.flush(5)
+
+        if self.failed:
+            logger.error(f'Kafka delivered {self.delivered} of {self.produced} messages, '
+                         f'{self.failed} messages undelivered since start, checkpoint is not saved')
+            self.produced = self.delivered = 0
+            raise KafkaException(self.error)
+
+        logger.info(f'Kafka delivered {self.delivered} messages')
+        self.produced = self.delivered = 0
 
     def stop(self):
-        super().stop()
+        try:
+            super().stop()
+        except KafkaException as e:
+            # 发送失败已经在提交时抛出，停止时只记录
+            logger.error(f'Kafka writer stopped with undelivered messages: {e}')
         self.producer = None
         logger.info(f'Kafka writer stopped')
 
 
 if __name__ == '__main__':
     import json
-    import time
     from utils.log import configure_logging
 
     configure_logging()